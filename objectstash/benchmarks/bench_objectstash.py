@@ -0,0 +1,251 @@
+"""Throughput benchmarks for ObjectStash.
+
+Runs offline against a file system stash and a local S3 stand-in (a moto server started in-process), sweeping
+object size, number of keys, max_num_threads and the local disk cache (off / cold / warm). For each
+configuration and operation, one JSON object per line is written with the throughput and the p50 / p99 request
+latencies taken from ObjectStash.stats().
+
+Example:
+    python benchmarks/bench_objectstash.py --backends fs,s3 --sizes 1KB,1MB --num-keys 16,256 \\
+        --threads 1,16,64 --output results.jsonl
+
+Results from two runs (e.g., before and after a change) can be compared with:
+    python benchmarks/bench_objectstash.py --compare baseline.jsonl results.jsonl
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from objectstash import ObjectStash, __version__
+
+
+OPERATIONS = ['put', 'put_multiple', 'get', 'get_multiple', 'list', 'exists', 'delete']
+SIZE_UNITS = {'B': 1, 'KB': 2 ** 10, 'MB': 2 ** 20, 'GB': 2 ** 30}
+# Keys that identify a configuration when comparing two result files
+CONFIG_FIELDS = ['backend', 'operation', 'object_size', 'num_keys', 'max_num_threads', 'cache']
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for unit in sorted(SIZE_UNITS.keys(), key=len, reverse=True):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * SIZE_UNITS[unit])
+    return int(text)
+
+
+def parse_list(text, fn):
+    return [fn(x) for x in text.split(',') if len(x.strip()) > 0]
+
+
+@contextlib.contextmanager
+def moto_server():
+    # Starts a local S3 stand-in. Requires moto with server support (pip install "moto[server]").
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    try:
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        server.stop()
+
+
+def make_stash(backend, workdir, *, endpoint_url, bucket, max_num_threads, cache):
+    if backend == 'fs':
+        return ObjectStash(rootdir=workdir / 'fs_root')
+    cache_root_path = workdir / 'cache'
+    return ObjectStash(s3_bucket=bucket,
+                       endpoint_url=endpoint_url,
+                       region_name='us-east-1',
+                       max_num_threads=max_num_threads,
+                       cache_on_local_disk=(cache != 'off'),
+                       cache_root_path=cache_root_path if cache != 'off' else None,
+                       num_tries=3,
+                       initial_delay=0.1)
+
+
+def run_operation(stash, operation, keys, payload):
+    if operation == 'put':
+        for key in keys:
+            stash.put(key, payload)
+    elif operation == 'put_multiple':
+        stash.put({key: payload for key in keys})
+    elif operation == 'get':
+        for key in keys:
+            stash.get(key)
+    elif operation == 'get_multiple':
+        stash.get(keys)
+    elif operation == 'list':
+        stash.list_keys('bench/')
+    elif operation == 'exists':
+        for key in keys:
+            stash.exists(key)
+    elif operation == 'delete':
+        for key in keys:
+            stash.delete(key)
+    else:
+        raise ValueError(f'Unknown operation {operation}')
+
+
+def measure(stash, operation, keys, payload, repeats):
+    best = None
+    for _ in range(repeats):
+        if operation == 'delete':
+            stash.put({key: payload for key in keys})
+        stash.reset_stats()
+        start = timer()
+        run_operation(stash, operation, keys, payload)
+        elapsed = timer() - start
+        stats = stash.stats()
+        if best is None or elapsed < best[0]:
+            best = (elapsed, stats)
+    elapsed, stats = best
+    op_stats = {}
+    for name, summary in stats.get('operations', {}).items():
+        op_stats[name] = {'count': summary['count'], 'p50': summary['p50'], 'p99': summary['p99']}
+    transferred = stats.get('counters', {}).get('bytes_in', 0) + stats.get('counters', {}).get('bytes_out', 0)
+    num_items = 1 if operation == 'list' else len(keys)
+    return {'seconds': elapsed,
+            'ops_per_second': num_items / elapsed if elapsed > 0 else None,
+            'throughput_mb_per_second': transferred / 2 ** 20 / elapsed if elapsed > 0 else None,
+            'requests': op_stats,
+            'retries': stats.get('counters', {}).get('retries', 0),
+            'cache_hit_rate': stats.get('cache_hit_rate')}
+
+
+def run_configuration(backend, *, endpoint_url, object_size, num_keys, max_num_threads, cache, operations,
+                      repeats):
+    results = []
+    workdir = pathlib.Path(tempfile.mkdtemp(prefix='objectstash_bench_'))
+    bucket = f'bench-{os.getpid()}-{abs(hash((object_size, num_keys, max_num_threads, cache))) % 10 ** 8}'
+    try:
+        if backend == 's3':
+            import boto3
+            boto3.client('s3', endpoint_url=endpoint_url, region_name='us-east-1').create_bucket(Bucket=bucket)
+        stash = make_stash(backend, workdir, endpoint_url=endpoint_url, bucket=bucket,
+                           max_num_threads=max_num_threads, cache='off' if cache == 'off' else 'on')
+        payload = os.urandom(object_size)
+        keys = [f'bench/{ii:08d}' for ii in range(num_keys)]
+        for operation in operations:
+            if operation in ['get', 'get_multiple', 'list', 'exists']:
+                stash.put({key: payload for key in keys})
+            if cache == 'cold' and (workdir / 'cache').exists():
+                shutil.rmtree(workdir / 'cache')
+                (workdir / 'cache').mkdir()
+            if cache == 'warm' and operation in ['get', 'get_multiple']:
+                # Local copies less than two seconds newer than the S3 object are treated as outdated
+                time.sleep(2.5)
+                run_operation(stash, operation, keys, payload)
+            # A cold cache only stays cold for a single pass
+            cur_repeats = 1 if cache == 'cold' else repeats
+            result = {'backend': backend,
+                      'operation': operation,
+                      'object_size': object_size,
+                      'num_keys': num_keys,
+                      'max_num_threads': max_num_threads,
+                      'cache': cache}
+            result.update(measure(stash, operation, keys, payload, cur_repeats))
+            results.append(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(baseline_filename, candidate_filename):
+    def load(filename):
+        with open(filename, 'r') as f:
+            rows = [json.loads(line) for line in f if line.strip() and '"operation"' in line]
+        return {tuple(row[x] for x in CONFIG_FIELDS): row for row in rows}
+    baseline = load(baseline_filename)
+    candidate = load(candidate_filename)
+    print(f'{"configuration":<70} {"baseline ops/s":>15} {"candidate ops/s":>16} {"change":>8}')
+    for config in sorted(set(baseline.keys()) & set(candidate.keys()), key=str):
+        old = baseline[config]['ops_per_second']
+        new = candidate[config]['ops_per_second']
+        change = f'{(new / old - 1) * 100:+.1f}%' if old and new else 'n/a'
+        print(f'{" ".join(str(x) for x in config):<70} {old or 0:>15.1f} {new or 0:>16.1f} {change:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', default='fs,s3', help='Comma-separated subset of fs,s3')
+    parser.add_argument('--sizes', default='1KB,64KB,1MB,16MB', help='Object sizes, e.g., 1KB,1MB,1GB')
+    parser.add_argument('--num-keys', default='16,256', help='Numbers of keys per configuration')
+    parser.add_argument('--threads', default='1,16,64', help='Values of max_num_threads (S3 only)')
+    parser.add_argument('--cache', default='off,cold,warm', help='Disk cache states (S3 only): off,cold,warm')
+    parser.add_argument('--operations', default=','.join(OPERATIONS))
+    parser.add_argument('--repeats', type=int, default=3, help='Repetitions per measurement (the best is kept)')
+    parser.add_argument('--max-total-bytes', default='1GB', help='Skip configurations with more data than this')
+    parser.add_argument('--output', default=None, help='JSON lines output file (default: stdout)')
+    parser.add_argument('--s3-endpoint', default=None,
+                        help='Use an already running S3-compatible server instead of starting a moto server')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CANDIDATE'), default=None)
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare(*args.compare)
+        return
+
+    backends = parse_list(args.backends, str)
+    operations = parse_list(args.operations, str)
+    for operation in operations:
+        assert operation in OPERATIONS, f'Unknown operation {operation}'
+    max_total_bytes = parse_size(args.max_total_bytes)
+    output = open(args.output, 'w') if args.output is not None else sys.stdout
+    header = {'objectstash_version': __version__,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpu_count': os.cpu_count()}
+    output.write(json.dumps(header) + '\n')
+
+    with contextlib.ExitStack() as stack:
+        # Progress messages printed by the library go to stderr so that stdout only contains results
+        stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+        endpoint_url = args.s3_endpoint
+        if endpoint_url is None and 's3' in backends:
+            endpoint_url = stack.enter_context(moto_server())
+        for backend in backends:
+            threads = parse_list(args.threads, int) if backend == 's3' else [1]
+            cache_states = parse_list(args.cache, str) if backend == 's3' else ['off']
+            for object_size in parse_list(args.sizes, parse_size):
+                for num_keys in parse_list(args.num_keys, int):
+                    if object_size * num_keys > max_total_bytes:
+                        print(f'Skipping {backend} with {num_keys} keys of {object_size} bytes (over --max-total-bytes)',
+                              file=sys.stderr)
+                        continue
+                    for max_num_threads in threads:
+                        for cache in cache_states:
+                            results = run_configuration(backend,
+                                                        endpoint_url=endpoint_url,
+                                                        object_size=object_size,
+                                                        num_keys=num_keys,
+                                                        max_num_threads=max_num_threads,
+                                                        cache=cache,
+                                                        operations=operations,
+                                                        repeats=args.repeats)
+                            for result in results:
+                                output.write(json.dumps(result) + '\n')
+                            output.flush()
+    if output is not sys.stdout:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
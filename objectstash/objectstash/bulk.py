@@ -0,0 +1,206 @@
+import concurrent.futures
+import contextlib
+import threading
+import time
+
+from .tracing import submit_traced
+
+
+# How a bulk operation handles keys that fail:
+#   fail_fast  cancel the pending keys and raise BulkOperationError as soon as one key failed
+#   collect    finish all keys and return the errors next to the results
+ERROR_POLICIES = ['fail_fast', 'collect']
+
+# Holds the cancellation event and the deadline of the bulk operation the current thread is working for, and
+# whether its requests may retry
+bulk_context = threading.local()
+
+
+class BulkOperationError(Exception):
+    """Raised when a key of a fail-fast bulk operation failed or the operation ran past its deadline.
+
+    Attributes:
+        results (BulkResult): The results of the keys that completed, with the errors in results.errors.
+        errors (dictionary): Maps the keys that failed to their exceptions.
+    """
+    def __init__(self, results):
+        self.results = results
+        self.errors = results.errors
+        key, exc = next(iter(self.errors.items()))
+        super().__init__(f'{len(self.errors)} key(s) failed, e.g., {key}: {exc!r}')
+
+
+class DeadlineExceeded(TimeoutError):
+    """The error recorded for keys that did not complete before the deadline of a bulk operation."""
+
+
+class BulkCancelled(Exception):
+    """Raised inside tasks of a bulk operation that was cancelled, so that they stop retrying."""
+
+
+class RetriesDisabled(Exception):
+    """Raised instead of retrying a failed request inside single_try(), e.g., because another replica can serve it."""
+
+
+class BulkResult(dict):
+    """The results of a bulk operation (a dictionary from keys to results) and the errors of failed keys."""
+    def __init__(self, results=None, errors=None):
+        super().__init__(results if results is not None else {})
+        self.errors = errors if errors is not None else {}
+
+
+def deadline_from_timeout(timeout):
+    # Bulk operations take a timeout in seconds and share the absolute deadline with nested operations
+    return None if timeout is None else time.monotonic() + timeout
+
+
+@contextlib.contextmanager
+def single_try():
+    # Requests made by the current thread inside this block fail at their first error instead of retrying
+    previous = getattr(bulk_context, 'single_try', False)
+    bulk_context.single_try = True
+    try:
+        yield
+    finally:
+        bulk_context.single_try = previous
+
+
+def backoff_sleep(delay):
+    # Sleeps before the next retry of a request. Inside a bulk operation, the sleep ends early if the operation
+    # is cancelled, and retries that would start after its deadline are not attempted.
+    if getattr(bulk_context, 'single_try', False):
+        raise RetriesDisabled('The request failed and is not retried')
+    cancel = getattr(bulk_context, 'cancel', None)
+    deadline = getattr(bulk_context, 'deadline', None)
+    if deadline is not None and time.monotonic() + delay >= deadline:
+        raise DeadlineExceeded('The next retry would start after the deadline')
+    if cancel is None:
+        time.sleep(delay)
+    elif cancel.wait(delay):
+        raise BulkCancelled()
+
+
+def run_bulk(fn, keys, *, max_num_threads, on_error='fail_fast', deadline=None, callback=None):
+    """Runs fn(key) for each key on a thread pool.
+
+    Unlike waiting for the pool to shut down, this returns as soon as the operation failed (fail_fast) or
+    reached its deadline: pending keys are cancelled, and running tasks stop at their next retry.
+
+    Args:
+        fn (function): Called with one key, returns its result.
+        keys (list): The keys.
+        max_num_threads (int): The number of threads.
+        on_error (string): The error policy, "fail_fast" or "collect".
+        deadline (float, optional): The time.monotonic() value after which unfinished keys fail with
+                DeadlineExceeded.
+        callback (function, optional): Called with 1 after each key that completed successfully.
+
+    Raises:
+        BulkOperationError: If a key failed and on_error is "fail_fast". A single key run with one thread and no
+                deadline raises its own exception instead.
+
+    Returns:
+        BulkResult: The results of the keys that completed, and the errors of the others if on_error is "collect".
+    """
+    if on_error not in ERROR_POLICIES:
+        raise ValueError(f'Unknown error policy "{on_error}". Must be one of {ERROR_POLICIES}.')
+    result = BulkResult()
+    if len(keys) == 0:
+        return result
+    if len(keys) == 1 and max_num_threads <= 1 and deadline is None:
+        # A single request (e.g., S3Adapter.get) runs in the calling thread and raises its own exception
+        key = keys[0]
+        try:
+            result[key] = fn(key)
+        except Exception as exc:
+            if on_error == 'fail_fast':
+                raise
+            result.errors[key] = exc
+            return result
+        if callback:
+            callback(1)
+        return result
+    cancel = threading.Event()
+    # The tasks inherit single_try() from the calling thread
+    is_single_try = getattr(bulk_context, 'single_try', False)
+
+    def run(key):
+        bulk_context.cancel = cancel
+        bulk_context.deadline = deadline
+        bulk_context.single_try = is_single_try
+        try:
+            return fn(key)
+        finally:
+            bulk_context.cancel = None
+            bulk_context.deadline = None
+            bulk_context.single_try = False
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(keys), max_num_threads)))
+    future_to_key = {}
+    try:
+        for key in keys:
+            future_to_key[submit_traced(executor, run, key)] = key
+        pending = set(future_to_key.keys())
+        while pending:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            done, pending = concurrent.futures.wait(pending, timeout=timeout,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                key = future_to_key[future]
+                try:
+                    result[key] = future.result()
+                except Exception as exc:
+                    result.errors[key] = exc
+                    continue
+                if callback:
+                    callback(1)
+            if result.errors and on_error == 'fail_fast':
+                break
+            if pending and deadline is not None and time.monotonic() >= deadline:
+                for future in pending:
+                    result.errors[future_to_key[future]] = DeadlineExceeded(
+                        f'{future_to_key[future]} did not complete before the deadline')
+                break
+    finally:
+        cancel.set()
+        for future in future_to_key.keys():
+            future.cancel()
+        # Does not wait for running tasks, which end at their next retry
+        executor.shutdown(wait=False)
+    if result.errors and on_error == 'fail_fast':
+        raise BulkOperationError(result)
+    return result
+
+
+def run_sequential(fn, keys, *, on_error='fail_fast', deadline=None, callback=None):
+    # Like run_bulk, but runs the keys one after another in the calling thread (e.g., for local files).
+    # A running key is not interrupted at the deadline; the keys that did not start before it fail.
+    if on_error not in ERROR_POLICIES:
+        raise ValueError(f'Unknown error policy "{on_error}". Must be one of {ERROR_POLICIES}.')
+    keys = list(keys)
+    if len(keys) == 1 and deadline is None:
+        return run_bulk(fn, keys, max_num_threads=1, on_error=on_error, callback=callback)
+    result = BulkResult()
+    for ii, key in enumerate(keys):
+        if deadline is not None and time.monotonic() >= deadline:
+            for cur_key in keys[ii:]:
+                result.errors[cur_key] = DeadlineExceeded(f'{cur_key} did not complete before the deadline')
+            break
+        try:
+            result[key] = fn(key)
+        except Exception as exc:
+            result.errors[key] = exc
+            if on_error == 'fail_fast':
+                break
+            continue
+        if callback:
+            callback(1)
+    if result.errors and on_error == 'fail_fast':
+        raise BulkOperationError(result)
+    return result
+
+
+def pop_bulk_options(kwargs):
+    # Removes the error policy and the timeout from the keyword arguments of a bulk operation and returns
+    # (on_error, deadline)
+    return kwargs.pop('on_error', 'fail_fast'), deadline_from_timeout(kwargs.pop('timeout', None))
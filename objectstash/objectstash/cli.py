@@ -0,0 +1,432 @@
+"""Parallel bulk transfers between local files and stashes.
+
+Stash locations are written as s3://bucket/key for S3 stashes, or as stash:key for the stash selected with
+--rootdir or --s3-bucket. Everything else is a local path.
+
+Examples:
+    objectstash ls s3://my-bucket/models/
+    objectstash cp -r ./checkpoints s3://my-bucket/runs/7/checkpoints/
+    objectstash --rootdir /data/stash sync s3://my-bucket/datasets/cifar/ stash:cifar/ --manifest cifar.jsonl
+    objectstash rm -r s3://my-bucket/runs/6/
+    objectstash du s3://my-bucket/runs/
+
+cp and sync record every finished transfer in the file given with --manifest. Running the same command again
+with the same manifest skips the transfers that finished before the interruption.
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import pathlib
+import sys
+import threading
+from timeit import default_timer as timer
+
+from .objectstash import ObjectStash
+
+
+SIZE_UNITS = ['B', 'KiB', 'MiB', 'GiB', 'TiB']
+
+
+class CLIError(Exception):
+    pass
+
+
+def format_size(num_bytes):
+    size = float(num_bytes)
+    for unit in SIZE_UNITS[:-1]:
+        if size < 1024:
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} {SIZE_UNITS[-1]}'
+
+
+def join_key(prefix, suffix):
+    if prefix == '' or prefix.endswith('/'):
+        return prefix + suffix
+    return prefix + '/' + suffix
+
+
+def as_dir_prefix(prefix):
+    # "a/b" and "a/b/" both denote the "directory" a/b/ in recursive commands
+    return prefix if prefix == '' or prefix.endswith('/') else prefix + '/'
+
+
+class Location:
+    def __init__(self, stash_spec, path):
+        # stash_spec is None for local paths, ('s3', bucket) or ('rootdir', directory) otherwise
+        self.stash_spec = stash_spec
+        self.path = path
+
+    @property
+    def is_local(self):
+        return self.stash_spec is None
+
+    def __str__(self):
+        if self.is_local:
+            return self.path
+        kind, name = self.stash_spec
+        return f's3://{name}/{self.path}' if kind == 's3' else f'{name}:{self.path}'
+
+
+def parse_location(text, args):
+    if text.startswith('s3://'):
+        bucket, _, key = text[len('s3://'):].partition('/')
+        if not bucket:
+            raise CLIError(f'Missing bucket name in {text}')
+        return Location(('s3', bucket), key)
+    if text.startswith('stash:'):
+        if args.rootdir is not None:
+            return Location(('rootdir', str(pathlib.Path(args.rootdir).resolve())), text[len('stash:'):])
+        if args.s3_bucket is not None:
+            return Location(('s3', args.s3_bucket), text[len('stash:'):])
+        raise CLIError(f'{text} needs --rootdir or --s3-bucket to select the stash')
+    return Location(None, text)
+
+
+class StashPool:
+    """Opens each stash once, with the options given on the command line."""
+    def __init__(self, args):
+        self.args = args
+        self.stashes = {}
+
+    def get(self, location):
+        spec = location.stash_spec
+        if spec not in self.stashes:
+            kind, name = spec
+            kwargs = {'max_num_threads': self.args.threads}
+            if kind == 's3':
+                kwargs.update(s3_bucket=name, endpoint_url=self.args.endpoint_url, profile_name=self.args.profile)
+                if self.args.cache_dir is not None:
+                    kwargs.update(cache_on_local_disk=True, cache_root_path=self.args.cache_dir)
+            else:
+                kwargs.update(rootdir=name)
+            self.stashes[spec] = ObjectStash(**kwargs)
+        return self.stashes[spec]
+
+    def close(self):
+        for stash in self.stashes.values():
+            stash.close()
+
+
+class Progress:
+    """Prints the number of finished transfers and the throughput on one continuously updated line."""
+    def __init__(self, total_items, total_bytes, enabled=True, stream=None, interval=0.2):
+        self.total_items = total_items
+        self.total_bytes = total_bytes
+        self.enabled = enabled
+        self.stream = stream if stream is not None else sys.stderr
+        self.interval = interval
+        self.done_items = 0
+        self.done_bytes = 0
+        self.start = timer()
+        self.last_print = 0.0
+        self.last_length = 0
+        self.lock = threading.Lock()
+
+    def line(self):
+        elapsed = max(timer() - self.start, 1e-9)
+        return (f'{self.done_items}/{self.total_items} objects, {format_size(self.done_bytes)} / '
+                f'{format_size(self.total_bytes)}, {format_size(self.done_bytes / elapsed)}/s')
+
+    def write_line(self, line, end=''):
+        # Pads the line so that it covers a longer previous line
+        self.stream.write('\r' + line.ljust(self.last_length) + end)
+        self.stream.flush()
+        self.last_length = len(line)
+
+    def update(self, num_items, num_bytes):
+        with self.lock:
+            self.done_items += num_items
+            self.done_bytes += num_bytes
+            now = timer()
+            if self.enabled and now - self.last_print >= self.interval:
+                self.last_print = now
+                self.write_line(self.line())
+
+    def finish(self):
+        if self.enabled:
+            self.write_line(self.line() + f' in {timer() - self.start:.1f} s', end='\n')
+
+
+class TransferManifest:
+    """Records finished transfers, one JSON object per line, so that an interrupted command can resume."""
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.completed = set()
+        self.lock = threading.Lock()
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                lines = f.readlines()
+            for line in lines:
+                if line.endswith('\n'):
+                    entry = json.loads(line)
+                    self.completed.add((entry['src'], entry['dst']))
+            if lines and not lines[-1].endswith('\n'):
+                # The process was killed while writing the last line, so drop it before appending
+                with open(self.path, 'w') as f:
+                    f.writelines(lines[:-1])
+
+    def is_done(self, src, dst):
+        return (src, dst) in self.completed
+
+    def record(self, items):
+        with self.lock:
+            with open(self.path, 'a') as f:
+                for src, dst, _ in items:
+                    f.write(json.dumps({'src': src, 'dst': dst}) + '\n')
+                    self.completed.add((src, dst))
+
+
+def plan_transfers(src, dst, recursive, stashes):
+    # Returns a list of (source, destination, size) tuples, where sources and destinations are keys or
+    # local paths depending on the locations
+    if src.is_local:
+        src_path = pathlib.Path(src.path)
+        if src_path.is_dir():
+            if not recursive:
+                raise CLIError(f'{src} is a directory (use -r)')
+            items = []
+            for dirpath, _, filenames in os.walk(src_path):
+                for filename in sorted(filenames):
+                    fpath = pathlib.Path(dirpath) / filename
+                    rel = fpath.relative_to(src_path).as_posix()
+                    items.append((str(fpath), join_key(as_dir_prefix(dst.path), rel), fpath.stat().st_size))
+            return sorted(items)
+        if not src_path.is_file():
+            raise CLIError(f'{src} does not exist')
+        dst_key = dst.path + src_path.name if dst.path == '' or dst.path.endswith('/') else dst.path
+        return [(str(src_path), dst_key, src_path.stat().st_size)]
+
+    stash = stashes.get(src)
+    if recursive:
+        prefix = as_dir_prefix(src.path)
+        sizes = stash.list_sizes(prefix)
+        items = []
+        for key, size in sorted(sizes.items()):
+            rel = key[len(prefix):]
+            if dst.is_local:
+                items.append((key, os.path.join(dst.path, *rel.split('/')), size))
+            else:
+                items.append((key, join_key(as_dir_prefix(dst.path), rel), size))
+        return items
+    sizes = stash.list_sizes(src.path)
+    if src.path not in sizes:
+        raise CLIError(f'{src} does not exist' + (' (use -r for prefixes)' if sizes else ''))
+    basename = src.path.rsplit('/', 1)[-1]
+    if dst.is_local:
+        target = os.path.join(dst.path, basename) if os.path.isdir(dst.path) or dst.path.endswith(os.sep) \
+                 else dst.path
+    else:
+        target = dst.path + basename if dst.path == '' or dst.path.endswith('/') else dst.path
+    return [(src.path, target, sizes[src.path])]
+
+
+def batches(items, batch_size):
+    for ii in range(0, len(items), batch_size):
+        yield items[ii:ii + batch_size]
+
+
+def run_transfers(items, src, dst, stashes, args, progress, manifest=None):
+    if src.is_local and dst.is_local:
+        raise CLIError('Both locations are local paths, use cp')
+
+    def finish(batch):
+        if manifest is not None:
+            manifest.record(batch)
+        progress.update(len(batch), sum(size for _, _, size in batch))
+
+    if src.is_local:
+        # Each file is uploaded on its own, so the uploads run on a pool of --threads workers
+        stash = stashes.get(dst)
+        def upload(item):
+            stash.upload_file(item[1], item[0])
+            finish([item])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
+            futures = [executor.submit(upload, item) for item in items]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        return
+
+    src_stash = stashes.get(src)
+    for batch in batches(items, args.batch_size):
+        if dst.is_local:
+            for _, filename, _ in batch:
+                os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+            src_stash.download_file({key: filename for key, filename, _ in batch})
+        elif dst.stash_spec == src.stash_spec:
+            # Copies inside one stash never transfer the data to the client
+            src_stash.copy({key: dst_key for key, dst_key, _ in batch})
+        else:
+            data = src_stash.get([key for key, _, _ in batch])
+            stashes.get(dst).put({dst_key: data[key] for key, dst_key, _ in batch})
+        finish(batch)
+
+
+def list_destination_sizes(dst, stashes):
+    # Returns {key or local path: size} for everything under the destination of a sync
+    if dst.is_local:
+        sizes = {}
+        for dirpath, _, filenames in os.walk(dst.path):
+            for filename in filenames:
+                fpath = os.path.join(dirpath, filename)
+                sizes[fpath] = os.path.getsize(fpath)
+        return sizes
+    return stashes.get(dst).list_sizes(as_dir_prefix(dst.path))
+
+
+def transfer(items, src, dst, stashes, args):
+    manifest = TransferManifest(args.manifest) if args.manifest is not None else None
+    if manifest is not None:
+        items = [item for item in items if not manifest.is_done(item[0], item[1])]
+    progress = Progress(len(items), sum(size for _, _, size in items), enabled=not args.quiet)
+    try:
+        run_transfers(items, src, dst, stashes, args, progress, manifest)
+    except BaseException:
+        if manifest is not None and not args.quiet:
+            sys.stderr.write(f'\nInterrupted after {progress.done_items} objects. Run the command again to resume '
+                             f'from {manifest.path}.\n')
+        raise
+    progress.finish()
+
+
+def command_ls(args, stashes):
+    location = parse_location(args.location, args)
+    if location.is_local:
+        raise CLIError('ls expects a stash location')
+    stash = stashes.get(location)
+    if args.recursive:
+        for key, size in sorted(stash.list_sizes(location.path).items()):
+            print(f'{format_size(size):>12}  {key}' if args.long else key)
+        return
+    entries = sorted(stash.list_keys(location.path))
+    sizes = stash.list_sizes(location.path) if args.long else {}
+    for entry in entries:
+        if args.long:
+            print(f'{"DIR" if entry.endswith("/") else format_size(sizes.get(entry, 0)):>12}  {entry}')
+        else:
+            print(entry)
+
+
+def command_cp(args, stashes):
+    src = parse_location(args.src, args)
+    dst = parse_location(args.dst, args)
+    items = plan_transfers(src, dst, args.recursive, stashes)
+    transfer(items, src, dst, stashes, args)
+
+
+def command_sync(args, stashes):
+    src = parse_location(args.src, args)
+    dst = parse_location(args.dst, args)
+    items = plan_transfers(src, dst, True, stashes)
+    existing = list_destination_sizes(dst, stashes)
+    # Objects of the same size are considered unchanged
+    changed = [item for item in items if existing.get(item[1]) != item[2]]
+    if not args.quiet:
+        sys.stderr.write(f'{len(items) - len(changed)} of {len(items)} objects are up to date\n')
+    transfer(changed, src, dst, stashes, args)
+    if args.delete:
+        targets = set(dst_name for _, dst_name, _ in items)
+        extra = sorted(name for name in existing if name not in targets)
+        if dst.is_local:
+            for fpath in extra:
+                os.remove(fpath)
+        elif extra:
+            stashes.get(dst).delete(extra)
+        if not args.quiet:
+            sys.stderr.write(f'Deleted {len(extra)} objects that are not in the source\n')
+
+
+def command_rm(args, stashes):
+    location = parse_location(args.location, args)
+    if location.is_local:
+        raise CLIError('rm expects a stash location')
+    stash = stashes.get(location)
+    if not args.recursive:
+        stash.delete(location.path)
+        return
+    sizes = stash.list_sizes(as_dir_prefix(location.path))
+    keys = sorted(sizes.keys())
+    progress = Progress(len(keys), sum(sizes.values()), enabled=not args.quiet)
+    for batch in batches(keys, args.batch_size):
+        stash.delete(batch)
+        progress.update(len(batch), sum(sizes[key] for key in batch))
+    progress.finish()
+
+
+def command_du(args, stashes):
+    location = parse_location(args.location, args)
+    if location.is_local:
+        raise CLIError('du expects a stash location')
+    prefix = location.path
+    sizes = stashes.get(location).list_sizes(prefix)
+    if not args.summarize:
+        # One line per entry directly under the prefix
+        groups = {}
+        for key, size in sizes.items():
+            rest = key[len(prefix):]
+            entry = prefix + rest.split('/', 1)[0] + ('/' if '/' in rest else '')
+            total = groups.setdefault(entry, [0, 0])
+            total[0] += size
+            total[1] += 1
+        for entry, (num_bytes, count) in sorted(groups.items()):
+            print(f'{format_size(num_bytes):>12}  {count:>8}  {entry}')
+    print(f'{format_size(sum(sizes.values())):>12}  {len(sizes):>8}  {prefix or "."} (total)')
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='objectstash', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rootdir', help='file system stash that stash:key locations refer to')
+    parser.add_argument('--s3-bucket', help='S3 bucket that stash:key locations refer to')
+    parser.add_argument('--endpoint-url', help='S3 endpoint, e.g., for MinIO')
+    parser.add_argument('--profile', help='AWS profile name')
+    parser.add_argument('--cache-dir', help='local disk cache for S3 stashes (default: no cache)')
+    parser.add_argument('--threads', type=int, default=32, help='number of parallel requests (default: 32)')
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help='number of objects per bulk request and manifest update (default: 256)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not print progress')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ls_parser = subparsers.add_parser('ls', help='list keys')
+    ls_parser.add_argument('location')
+    ls_parser.add_argument('-r', '--recursive', action='store_true', help='list keys in nested prefixes')
+    ls_parser.add_argument('-l', '--long', action='store_true', help='show sizes')
+    ls_parser.set_defaults(fn=command_ls)
+
+    for name, fn, description in [('cp', command_cp, 'copy objects'),
+                                  ('sync', command_sync, 'copy new and changed objects of a prefix')]:
+        cur_parser = subparsers.add_parser(name, help=description)
+        cur_parser.add_argument('src')
+        cur_parser.add_argument('dst')
+        if name == 'cp':
+            cur_parser.add_argument('-r', '--recursive', action='store_true', help='copy a prefix or directory')
+        else:
+            cur_parser.add_argument('--delete', action='store_true',
+                                    help='delete destination objects that are not in the source')
+        cur_parser.add_argument('--manifest', help='file recording finished transfers, for resuming')
+        cur_parser.set_defaults(fn=fn)
+
+    rm_parser = subparsers.add_parser('rm', help='delete keys')
+    rm_parser.add_argument('location')
+    rm_parser.add_argument('-r', '--recursive', action='store_true', help='delete all keys under a prefix')
+    rm_parser.set_defaults(fn=command_rm)
+
+    du_parser = subparsers.add_parser('du', help='show the space used under a prefix')
+    du_parser.add_argument('location')
+    du_parser.add_argument('-s', '--summarize', action='store_true', help='only show the total')
+    du_parser.set_defaults(fn=command_du)
+    return parser
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    stashes = StashPool(args)
+    try:
+        args.fn(args, stashes)
+    except CLIError as exc:
+        parser.error(str(exc))
+    finally:
+        stashes.close()
+    return 0
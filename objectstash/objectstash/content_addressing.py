@@ -0,0 +1,151 @@
+import concurrent.futures
+import hashlib
+import os
+import threading
+
+
+# In content-addressed mode, the data is stored once under a key derived from its SHA-256 hash:
+#   <blob prefix><first two hex digits>/<hex digest>
+# and the logical key holds a small reference object pointing to the blob.
+REF_MAGIC = b'OSREF1:'
+HASH_HEX_LENGTH = 64
+REF_LENGTH = len(REF_MAGIC) + HASH_HEX_LENGTH
+DEFAULT_BLOB_PREFIX = '.cas/sha256/'
+
+
+def hash_data(data):
+    # hashlib releases the GIL for large inputs, so this parallelizes well on threads
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_ref(digest):
+    return REF_MAGIC + digest.encode('ascii')
+
+
+def parse_ref(data):
+    # Returns the digest if data is a reference object, otherwise None
+    if len(data) == REF_LENGTH and data[:len(REF_MAGIC)] == REF_MAGIC:
+        return bytes(data[len(REF_MAGIC):]).decode('ascii')
+    return None
+
+
+class ContentAddressedStore:
+    """Deduplicates puts by storing each distinct value once under a hash-derived key.
+
+    Which blobs already exist is tracked in an in-memory index. The index is filled by listing the blob
+    prefix one shard (first two hex digits) at a time, so checking many hashes costs at most one listing
+    per shard instead of one HEAD request per object.
+    Deleting a logical key only deletes its reference; the blob itself is kept.
+    """
+    def __init__(self, adapter, blob_prefix=DEFAULT_BLOB_PREFIX, hash_num_threads=None):
+        self.adapter = adapter
+        self.blob_prefix = blob_prefix
+        self.hash_num_threads = hash_num_threads if hash_num_threads is not None else (os.cpu_count() or 1)
+        self.known_digests = set()
+        self.listed_shards = set()
+        self.lock = threading.Lock()
+
+    def blob_key(self, digest):
+        return f'{self.blob_prefix}{digest[:2]}/{digest}'
+
+    def is_hidden(self, key, prefix):
+        # Blobs are internal, so they only show up in listings of prefixes inside the top-level blob "directory"
+        hidden_prefix = self.blob_prefix[:self.blob_prefix.find('/') + 1]
+        return key.startswith(hidden_prefix) and not prefix.startswith(hidden_prefix)
+
+    def filter_keys(self, keys, prefix):
+        return [key for key in keys if not self.is_hidden(key, prefix)]
+
+    def key_sizes(self, keys):
+        # Sizes of individual keys (None for missing keys), each from a listing of the key as prefix
+        keys = list(keys)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(keys), 16))) as executor:
+            listings = list(executor.map(self.adapter.list_sizes, keys))
+        return {key: listing.get(key) for key, listing in zip(keys, listings)}
+
+    def resolve_keys(self, keys, sizes=None):
+        # Maps logical keys to the keys holding their data: the blob for references, the key itself otherwise.
+        # Only keys of the size of a reference are read.
+        keys = list(keys)
+        if sizes is None:
+            sizes = self.key_sizes(keys)
+        candidates = [key for key in keys if sizes.get(key) == REF_LENGTH]
+        heads = self.adapter.get_ranges([(key, 0, REF_LENGTH) for key in candidates]) if candidates else []
+        result = {key: key for key in keys}
+        for key, head in zip(candidates, heads):
+            digest = parse_ref(head)
+            if digest is not None:
+                result[key] = self.blob_key(digest)
+        return result
+
+    def resolve_sizes(self, sizes, prefix):
+        # Replaces the sizes of references in a listing {key: size} by the sizes of their blobs
+        sizes = {key: size for key, size in sizes.items() if not self.is_hidden(key, prefix)}
+        sources = {key: source for key, source in self.resolve_keys(sizes.keys(), sizes).items() if source != key}
+        if not sources:
+            return sizes
+        blob_sizes = self.key_sizes(sorted(set(sources.values())))
+        for key, blob_key in sources.items():
+            if blob_sizes[blob_key] is not None:
+                sizes[key] = blob_sizes[blob_key]
+        return sizes
+
+    def hash_multiple(self, data_dict):
+        if len(data_dict) <= 1 or self.hash_num_threads <= 1:
+            return {key: hash_data(data) for key, data in data_dict.items()}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.hash_num_threads) as executor:
+            future_to_key = {executor.submit(hash_data, data): key for key, data in data_dict.items()}
+            return {future_to_key[future]: future.result()
+                    for future in concurrent.futures.as_completed(future_to_key)}
+
+    def existing_digests(self, digests):
+        with self.lock:
+            unknown = [x for x in digests if x not in self.known_digests]
+            shards_to_list = sorted(set(x[:2] for x in unknown) - self.listed_shards)
+        for shard in shards_to_list:
+            shard_prefix = f'{self.blob_prefix}{shard}/'
+            listed = [x[len(shard_prefix):] for x in self.adapter.list_keys(shard_prefix)]
+            with self.lock:
+                self.known_digests.update(x for x in listed if len(x) == HASH_HEX_LENGTH)
+                self.listed_shards.add(shard)
+        with self.lock:
+            return set(x for x in digests if x in self.known_digests)
+
+    def put_multiple(self, data_dict, **kwargs):
+        digests = self.hash_multiple(data_dict)
+        existing = self.existing_digests(set(digests.values()))
+        blobs = {}
+        for key, digest in digests.items():
+            if digest not in existing and self.blob_key(digest) not in blobs:
+                blobs[self.blob_key(digest)] = data_dict[key]
+        if blobs:
+            self.adapter.put_multiple(blobs, **kwargs)
+            with self.lock:
+                self.known_digests.update(digests.values())
+        self.adapter.put_multiple({key: make_ref(digest) for key, digest in digests.items()}, **kwargs)
+        return len(blobs)
+
+    def resolve_multiple(self, results, **kwargs):
+        # Replaces reference objects in a dictionary of get results by the data of their blobs
+        refs = {}
+        for key, data in results.items():
+            digest = parse_ref(data)
+            if digest is not None:
+                refs[key] = self.blob_key(digest)
+        if refs:
+            blobs = self.adapter.get_multiple(sorted(set(refs.values())), **kwargs)
+            # With on_error='collect', blobs that failed are reported for the keys referencing them
+            errors = getattr(blobs, 'errors', {})
+            for key, blob_key in refs.items():
+                if blob_key in errors:
+                    del results[key]
+                    results.errors[key] = errors[blob_key]
+                else:
+                    results[key] = blobs[blob_key]
+        return results
+
+    def resolve(self, data, **kwargs):
+        digest = parse_ref(data)
+        if digest is None:
+            return data
+        return self.adapter.get(self.blob_key(digest), **kwargs)
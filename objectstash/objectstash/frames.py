@@ -0,0 +1,100 @@
+import io
+
+
+def as_byte_view(buf):
+    # Returns a flat, byte-typed memoryview over buf without copying
+    view = memoryview(buf)
+    if view.ndim != 1 or view.format != 'B':
+        view = view.cast('B')
+    return view
+
+
+def readinto_exact(f, buffer):
+    # Reads the rest of a file-like object into buffer and returns the number of bytes read.
+    # Raises ValueError if the data does not fit into the buffer.
+    view = as_byte_view(buffer)
+    readinto = getattr(f, 'readinto', None)
+    total = 0
+    while total < view.nbytes:
+        if readinto is not None:
+            num_bytes = readinto(view[total:])
+        else:
+            chunk = f.read(view.nbytes - total)
+            num_bytes = len(chunk)
+            view[total:total + num_bytes] = chunk
+        if not num_bytes:
+            break
+        total += num_bytes
+    if total == view.nbytes and len(f.read(1)) > 0:
+        raise ValueError(f'The data is larger than the buffer of {view.nbytes} bytes')
+    return total
+
+
+def copy_into(data, buffer):
+    # Copies data into the start of buffer and returns the number of bytes copied
+    view = as_byte_view(buffer)
+    num_bytes = len(data)
+    if num_bytes > view.nbytes:
+        raise ValueError(f'The data ({num_bytes} bytes) is larger than the buffer of {view.nbytes} bytes')
+    view[:num_bytes] = data
+    return num_bytes
+
+
+def frames_nbytes(frames):
+    return sum(as_byte_view(x).nbytes for x in frames)
+
+
+class FramesReader(io.RawIOBase):
+    """A read-only file-like object over a sequence of buffers.
+
+    Lets the upload code stream a list of frames (e.g., a header followed by the memory of a NumPy array)
+    without first concatenating them into one bytes object.
+    """
+    def __init__(self, frames):
+        self.frames = [as_byte_view(x) for x in frames]
+        self.total = sum(x.nbytes for x in self.frames)
+        self.frame_index = 0
+        self.frame_offset = 0
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            target = offset
+        elif whence == io.SEEK_CUR:
+            target = self.position + offset
+        elif whence == io.SEEK_END:
+            target = self.total + offset
+        else:
+            raise ValueError(f'Unknown whence value {whence}')
+        target = max(0, min(target, self.total))
+        self.frame_index = 0
+        self.frame_offset = target
+        while self.frame_index < len(self.frames) and self.frame_offset >= self.frames[self.frame_index].nbytes:
+            self.frame_offset -= self.frames[self.frame_index].nbytes
+            self.frame_index += 1
+        self.position = target
+        return self.position
+
+    def readinto(self, b):
+        out = as_byte_view(b)
+        written = 0
+        while written < out.nbytes and self.frame_index < len(self.frames):
+            frame = self.frames[self.frame_index]
+            n = min(out.nbytes - written, frame.nbytes - self.frame_offset)
+            out[written:written + n] = frame[self.frame_offset:self.frame_offset + n]
+            written += n
+            self.frame_offset += n
+            if self.frame_offset == frame.nbytes:
+                self.frame_index += 1
+                self.frame_offset = 0
+        self.position += written
+        return written
@@ -1,17 +1,90 @@
+import concurrent.futures
+import errno
+import os
 import pathlib
-import shutil
+import threading
+import uuid
 from loguru import logger
 
+from .bulk import deadline_from_timeout, run_bulk, run_sequential
+from .frames import frames_nbytes, readinto_exact
+from .local_files import TMP_SUFFIX, create_temp_file, fast_copy, link_file
+from .metrics import Metrics
 from .storage_adapter import StorageAdapter
+from .streaming import iter_chunks
+from .tracing import submit_traced
+
+
+DURABILITY_LEVELS = ['none', 'file', 'directory']
+
+
+def fsync_directory(dirpath):
+    fd = os.open(dirpath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 
 class FSAdapter(StorageAdapter):
-    def __init__(self, rootdir):
+    def __init__(self, rootdir, durability='none', max_num_threads=8):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f'Unknown durability level "{durability}". Must be one of {DURABILITY_LEVELS}.')
         self.rootdir = pathlib.Path(rootdir).resolve()
         if self.rootdir.exists():
             assert self.rootdir.is_dir(), "Root dir must be dir"
         else:
             self.rootdir.mkdir(parents=True)
+        self.durability = durability
+        self.max_num_threads = max_num_threads
+        self.metrics = Metrics()
+        # Directories known to exist, so that writes skip the mkdir system calls
+        self.created_dirs = set()
+        self.created_dirs_lock = threading.Lock()
+
+    def backend_id(self):
+        return f'fs:{self.rootdir}'
+
+    def key_path(self, key):
+        # Normalizing the path is much cheaper than resolve() and still rejects keys that escape the root dir
+        fpath = pathlib.Path(os.path.normpath(os.path.join(self.rootdir, key)))
+        assert str(fpath).startswith(str(self.rootdir))
+        return fpath
+
+    def ensure_parent(self, fpath):
+        parent = fpath.parent
+        if parent in self.created_dirs:
+            return
+        parent.mkdir(parents=True, exist_ok=True)
+        with self.created_dirs_lock:
+            self.created_dirs.add(parent)
 
+    def atomic_write(self, fpath, write_fn):
+        # Writes to a temporary file in the target directory and renames it, so readers never see partial data
+        self.ensure_parent(fpath)
+        try:
+            fd, tmp_path = create_temp_file(fpath.parent, fpath.name)
+        except FileNotFoundError:
+            # The directory was removed since we created it
+            with self.created_dirs_lock:
+                self.created_dirs.discard(fpath.parent)
+            self.ensure_parent(fpath)
+            fd, tmp_path = create_temp_file(fpath.parent, fpath.name)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_fn(f)
+                if self.durability != 'none':
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, fpath)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        if self.durability == 'directory':
+            fsync_directory(fpath.parent)
 
     def list_keys(self, prefix):
         if len(prefix) == 0:
@@ -19,53 +92,198 @@ class FSAdapter(StorageAdapter):
         elif prefix[0] == "/":
             logger.warning(f"Prefix / not supported for FSAdapter returning []")
             return []
-        glob_res = list(self.rootdir.glob(f"{prefix}*"))
-        files = [str(x.relative_to(self.rootdir)) for x in glob_res if x.is_file()]
-        dirs = [str(x.relative_to(self.rootdir)) + "/" for x in glob_res if x.is_dir()]
+        with self.metrics.timed('list', key=prefix):
+            glob_res = list(self.rootdir.glob(f"{prefix}*"))
+            files = [str(x.relative_to(self.rootdir)) for x in glob_res
+                     if x.is_file() and not x.name.endswith(TMP_SUFFIX)]
+            dirs = [str(x.relative_to(self.rootdir)) + "/" for x in glob_res if x.is_dir()]
         return files + dirs
 
+    def list_sizes(self, prefix):
+        if prefix.startswith('/'):
+            return {}
+        # Keys under the prefix are in the prefix's directory (or below it if the prefix ends with "/")
+        base = self.key_path(prefix[:prefix.rfind('/') + 1])
+        sizes = {}
+        with self.metrics.timed('list', key=prefix):
+            for dirpath, _, filenames in os.walk(base):
+                for filename in filenames:
+                    if filename.endswith(TMP_SUFFIX):
+                        continue
+                    fpath = os.path.join(dirpath, filename)
+                    key = os.path.relpath(fpath, self.rootdir)
+                    if key.startswith(prefix):
+                        sizes[key] = os.path.getsize(fpath)
+        return sizes
+
     def exists(self, key):
-        return (self.rootdir / key).exists()
+        with self.metrics.timed('head', key=key):
+            return (self.rootdir / key).exists()
 
     def put(self, key, data):
-        fpath = (self.rootdir / key).resolve()
-        assert str(fpath).startswith(str(self.rootdir))
-        if not fpath.parent.exists():
-            fpath.parent.mkdir(parents=True)
-        with fpath.open("wb") as f:
-            f.write(data)
+        fpath = self.key_path(key)
+        with self.metrics.timed('put', key=key) as transfer:
+            self.atomic_write(fpath, lambda f: f.write(data))
+            transfer['bytes_out'] = len(data)
+
+    def put_frames(self, key, frames):
+        fpath = self.key_path(key)
+        def write_frames(f):
+            for frame in frames:
+                f.write(frame)
+        with self.metrics.timed('put', key=key) as transfer:
+            self.atomic_write(fpath, write_frames)
+            transfer['bytes_out'] = frames_nbytes(frames)
+
+    def put_stream(self, key, source):
+        fpath = self.key_path(key)
+        def write_chunks(f):
+            for chunk in iter_chunks(source):
+                f.write(chunk)
+        with self.metrics.timed('put', key=key) as transfer:
+            self.atomic_write(fpath, write_chunks)
+            transfer['bytes_out'] = os.path.getsize(fpath)
 
     def put_multiple(self, data_dict):
-        for key, data in data_dict.items():
-            self.put(key, data)
+        if self.max_num_threads <= 1 or len(data_dict) <= 1:
+            for key, data in data_dict.items():
+                self.put(key, data)
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_num_threads) as executor:
+            futures = [submit_traced(executor, self.put, key, data) for key, data in data_dict.items()]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
 
     def upload_file(self, key, filename):
-        fpath = (self.rootdir / key).resolve()
-        assert str(fpath).startswith(str(self.rootdir))
-        shutil.copyfile(filename, fpath)
+        fpath = self.key_path(key)
+        with self.metrics.timed('upload', key=key) as transfer:
+            with open(filename, 'rb') as fsrc:
+                self.atomic_write(fpath, lambda f: fast_copy(fsrc, f))
+            transfer['bytes_out'] = os.path.getsize(fpath)
     
     def get(self, key):
-        fpath = (self.rootdir / key).resolve()
-        assert str(fpath).startswith(str(self.rootdir))
-        with fpath.open("rb") as f:
-            return f.read()
+        fpath = self.key_path(key)
+        with self.metrics.timed('get', key=key) as transfer:
+            with fpath.open("rb") as f:
+                data = f.read()
+            transfer['bytes_in'] = len(data)
+        return data
+
+    def get_into(self, key, buffer):
+        fpath = self.key_path(key)
+        with self.metrics.timed('get', key=key) as transfer:
+            with fpath.open("rb", buffering=0) as f:
+                num_bytes = readinto_exact(f, buffer)
+            transfer['bytes_in'] = num_bytes
+        return num_bytes
+
+    def get_multiple_into(self, buffers, callback=None, on_error='fail_fast', timeout=None):
+        return run_sequential(lambda key: self.get_into(key, buffers[key]), buffers.keys(),
+                              on_error=on_error, deadline=deadline_from_timeout(timeout), callback=callback)
+
+    def get_local_path(self, key):
+        return self.key_path(key)
 
-    def get_multiple(self, keys):
-        ret = {}
-        for key in keys:
-            ret[key] = self.get(key)
+    def get_ranges(self, ranges):
+        ret = []
+        for key, start, length in ranges:
+            fpath = self.key_path(key)
+            with self.metrics.timed('get_range', key=key) as transfer:
+                with fpath.open("rb") as f:
+                    f.seek(start)
+                    ret.append(f.read(length))
+                transfer['bytes_in'] = len(ret[-1])
         return ret
+
+    def get_multiple(self, keys, callback=None, on_error='fail_fast', timeout=None):
+        return run_sequential(self.get, keys, on_error=on_error, deadline=deadline_from_timeout(timeout),
+                              callback=callback)
     
-    def download_file(self, key, filename):
-        fpath = (self.rootdir / key).resolve()
-        assert str(fpath).startswith(str(self.rootdir))
-        shutil.copyfile(fpath, filename)
+    def download_file(self, key, filename, link_mode='copy'):
+        fpath = self.key_path(key)
+        with self.metrics.timed('download', key=key) as transfer:
+            if link_mode != link_file(fpath, filename, link_mode):
+                self.metrics.increment('link_fallbacks')
+            transfer['bytes_in'] = os.path.getsize(filename)
+
+    def download_multiple(self, filenames, link_mode='copy', callback=None, on_error='fail_fast', timeout=None):
+        # Returns {key: exception} for the keys that failed with on_error='collect'
+        return run_sequential(lambda key: self.download_file(key, filenames[key], link_mode=link_mode),
+                              filenames.keys(), on_error=on_error, deadline=deadline_from_timeout(timeout),
+                              callback=callback).errors
     
+    def link_or_copy(self, src_path, dst_path):
+        # Objects are never modified in place (writes replace the file), so a hardlink is a safe copy.
+        # The link is created under a temporary name and renamed, so an existing destination is replaced atomically.
+        self.ensure_parent(dst_path)
+        tmp_path = dst_path.parent / f'.{dst_path.name}.{uuid.uuid4().hex}{TMP_SUFFIX}'
+        try:
+            os.link(src_path, tmp_path)
+        except OSError as exc:
+            if exc.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP]:
+                raise
+            # No hardlinks here, so clone or copy the data instead
+            with open(src_path, 'rb') as fsrc:
+                self.atomic_write(dst_path, lambda f: fast_copy(fsrc, f))
+            return
+        try:
+            os.replace(tmp_path, dst_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        if self.durability == 'directory':
+            fsync_directory(dst_path.parent)
+
+    def copy(self, src, dst):
+        src_path = self.key_path(src)
+        dst_path = self.key_path(dst)
+        with self.metrics.timed('copy', key=dst):
+            self.link_or_copy(src_path, dst_path)
+
+    def copy_multiple(self, pairs, on_error='fail_fast', timeout=None):
+        # Returns {source key: exception} for the keys that failed with on_error='collect'
+        deadline = deadline_from_timeout(timeout)
+        if self.max_num_threads <= 1 or len(pairs) <= 1:
+            return run_sequential(lambda src: self.copy(src, pairs[src]), pairs.keys(),
+                                  on_error=on_error, deadline=deadline).errors
+        return run_bulk(lambda src: self.copy(src, pairs[src]), list(pairs.keys()),
+                        max_num_threads=self.max_num_threads, on_error=on_error, deadline=deadline).errors
+
+    def copy_from(self, source, keys, on_error='fail_fast', timeout=None):
+        # Files of another FSAdapter are hardlinked (or cloned) like copies inside the root dir
+        if not isinstance(source, FSAdapter):
+            return super().copy_from(source, keys, on_error=on_error, timeout=timeout)
+        def copy_key(key):
+            with self.metrics.timed('copy', key=key):
+                self.link_or_copy(source.key_path(key), self.key_path(key))
+        return run_bulk(copy_key, list(keys), max_num_threads=self.max_num_threads, on_error=on_error,
+                        deadline=deadline_from_timeout(timeout)).errors
+
+    def move(self, src, dst):
+        src_path = self.key_path(src)
+        dst_path = self.key_path(dst)
+        with self.metrics.timed('move', key=dst):
+            self.ensure_parent(dst_path)
+            try:
+                os.replace(src_path, dst_path)
+            except OSError as exc:
+                # The root dir spans several file systems
+                if exc.errno != errno.EXDEV:
+                    raise
+                self.link_or_copy(src_path, dst_path)
+                src_path.unlink()
+            if self.durability == 'directory':
+                fsync_directory(dst_path.parent)
+                fsync_directory(src_path.parent)
+
+    def move_multiple(self, pairs, on_error='fail_fast', timeout=None):
+        return run_sequential(lambda src: self.move(src, pairs[src]), pairs.keys(),
+                              on_error=on_error, deadline=deadline_from_timeout(timeout)).errors
+
     def delete(self, key):
-        fpath = (self.rootdir / key).resolve()
-        assert str(fpath).startswith(str(self.rootdir))
-        fpath.unlink()
+        fpath = self.key_path(key)
+        with self.metrics.timed('delete', key=key):
+            fpath.unlink()
 
-    def delete_multiple(self, keys):
-        for key in keys:
-            self.delete(key)
+    def delete_multiple(self, keys, on_error='fail_fast', timeout=None):
+        return run_sequential(self.delete, keys, on_error=on_error, deadline=deadline_from_timeout(timeout)).errors
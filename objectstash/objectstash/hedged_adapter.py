@@ -0,0 +1,225 @@
+import concurrent.futures
+import threading
+from timeit import default_timer as timer
+
+from .bulk import pop_bulk_options, run_bulk, single_try
+from .metrics import LatencyHistogram, Metrics
+from .storage_adapter import StorageAdapter
+from .tracing import submit_traced
+
+
+class HedgedAdapter(StorageAdapter):
+    """Cuts the tail latency of gets with hedged requests, and fails over between replicas.
+
+    A get is sent to the first replica. If it has not finished after the hedging threshold, a duplicate request
+    is sent to the next replica (or to the same adapter again if there is only one) and the first response is
+    used. Requests to a replica fail at their first error (without the retries and backoff of the child adapter)
+    and are retried on the next replica right away; only the request to the last untried replica uses the
+    retries of its adapter. Writes and deletes go to all replicas.
+
+    The threshold is either fixed (hedge_after, in seconds) or the hedge_percentile-th percentile of the
+    latencies observed so far (after min_samples requests; hedge_after is used until then).
+
+    Args:
+        replicas (StorageAdapter or list of StorageAdapter): The adapters holding copies of the data, e.g.,
+                S3Adapters for buckets in different regions. The first one is preferred.
+        hedge_after (float, optional): Fixed hedging threshold in seconds.
+        hedge_percentile (float, optional): Percentile of the observed latencies used as threshold, e.g., 95.
+        max_hedges (int): The largest number of duplicate requests per get.
+    """
+    def __init__(self, replicas, *,
+                 hedge_after=None,
+                 hedge_percentile=None,
+                 min_samples=20,
+                 max_hedges=1,
+                 num_threads=32):
+        if isinstance(replicas, StorageAdapter):
+            replicas = [replicas]
+        assert len(replicas) > 0, 'Need at least one replica'
+        self.replicas = list(replicas)
+        self.hedge_after = hedge_after
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.max_hedges = max_hedges
+        self.num_threads = num_threads
+        self.metrics = Metrics()
+        self.latency_lock = threading.Lock()
+        self.latencies = LatencyHistogram()
+        # Requests that lost the race keep running on these threads until they finish
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+
+    def hedge_threshold(self):
+        if self.hedge_percentile is not None:
+            with self.latency_lock:
+                if self.latencies.count >= self.min_samples:
+                    return self.latencies.percentile(self.hedge_percentile)
+        return self.hedge_after
+
+    def timed_call(self, fn, replica, is_single_try):
+        start = timer()
+        if is_single_try:
+            with single_try():
+                result = fn(replica)
+        else:
+            result = fn(replica)
+        with self.latency_lock:
+            self.latencies.record(timer() - start)
+        return result
+
+    def read(self, call, hedge=True):
+        # Calls call(replica) with hedging and failover, and returns the first successful result
+        threshold = self.hedge_threshold() if hedge else None
+        num_hedges = 0
+        next_replica = 0
+        num_started = 0
+        futures = {}
+        last_exc = None
+
+        def start(is_hedge):
+            nonlocal next_replica, num_started
+            replica = self.replicas[next_replica % len(self.replicas)]
+            # Failed requests are retried on the remaining replicas instead of after a backoff
+            is_single_try = next_replica < len(self.replicas) - 1
+            future = submit_traced(self.executor, self.timed_call, call, replica, is_single_try)
+            futures[future] = is_hedge
+            next_replica += 1
+            num_started += 1
+
+        start(False)
+        while True:
+            timeout = threshold if threshold is not None and num_hedges < self.max_hedges else None
+            done, _ = concurrent.futures.wait(futures, timeout=timeout,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                num_hedges += 1
+                self.metrics.increment('hedged_requests')
+                start(True)
+                continue
+            for future in done:
+                is_hedge = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    last_exc = exc
+                    continue
+                if is_hedge:
+                    self.metrics.increment('hedge_wins')
+                return result
+            # All finished requests failed: try the replicas that were not tried yet
+            if num_started < len(self.replicas) + num_hedges:
+                self.metrics.increment('failovers')
+                start(False)
+            elif not futures:
+                raise last_exc
+
+    def write_all(self, call):
+        # Applies a write to every replica in parallel, raises the first error and returns the results
+        if len(self.replicas) == 1:
+            return [call(self.replicas[0])]
+        futures = [submit_traced(self.executor, call, replica) for replica in self.replicas]
+        return [future.result() for future in futures]
+
+    def write_all_multiple(self, call):
+        # Bulk writes with on_error='collect' return {key: exception}; a key fails if it failed on any replica
+        errors = {}
+        for replica_errors in self.write_all(call):
+            errors.update(replica_errors or {})
+        return errors
+
+    def add_trace_hook(self, hook):
+        for replica in self.replicas:
+            if replica.metrics is not None:
+                replica.add_trace_hook(hook)
+
+    def remove_trace_hook(self, hook):
+        for replica in self.replicas:
+            if replica.metrics is not None:
+                replica.remove_trace_hook(hook)
+
+    def backend_id(self):
+        return 'hedged(' + ','.join(replica.backend_id() for replica in self.replicas) + ')'
+
+    def flush(self):
+        for replica in self.replicas:
+            replica.flush()
+
+    def close(self):
+        for replica in self.replicas:
+            replica.close()
+        self.executor.shutdown(wait=False)
+
+    def list_keys(self, prefix, **kwargs):
+        return self.read(lambda replica: replica.list_keys(prefix, **kwargs), hedge=False)
+
+    def list_sizes(self, prefix, **kwargs):
+        return self.read(lambda replica: replica.list_sizes(prefix, **kwargs), hedge=False)
+
+    def list_metadata(self, prefix, start_after=None, **kwargs):
+        return self.read(lambda replica: replica.list_metadata(prefix, start_after, **kwargs), hedge=False)
+
+    def exists(self, key, **kwargs):
+        return self.read(lambda replica: replica.exists(key, **kwargs))
+
+    def put(self, key, data, **kwargs):
+        self.write_all(lambda replica: replica.put(key, data, **kwargs))
+
+    def put_frames(self, key, frames, **kwargs):
+        self.write_all(lambda replica: replica.put_frames(key, frames, **kwargs))
+
+    def put_multiple(self, data_dict, **kwargs):
+        self.write_all(lambda replica: replica.put_multiple(data_dict, **kwargs))
+
+    def upload_file(self, key, filename, **kwargs):
+        self.write_all(lambda replica: replica.upload_file(key, filename, **kwargs))
+
+    def get(self, key, **kwargs):
+        return self.read(lambda replica: replica.get(key, **kwargs))
+
+    def get_multiple(self, keys, **kwargs):
+        # Each key is hedged on its own, so one straggler does not hold up the whole batch
+        callback = kwargs.pop('callback', None)
+        on_error, deadline = pop_bulk_options(kwargs)
+        return run_bulk(lambda key: self.get(key, **kwargs), list(keys),
+                        max_num_threads=self.num_threads, on_error=on_error, deadline=deadline, callback=callback)
+
+    def get_into(self, key, buffer, **kwargs):
+        # Two requests must not write into the same buffer, so reads into buffers only fail over
+        return self.read(lambda replica: replica.get_into(key, buffer, **kwargs), hedge=False)
+
+    def get_multiple_into(self, buffers, **kwargs):
+        callback = kwargs.pop('callback', None)
+        on_error, deadline = pop_bulk_options(kwargs)
+        return run_bulk(lambda key: self.get_into(key, buffers[key], **kwargs), list(buffers.keys()),
+                        max_num_threads=self.num_threads, on_error=on_error, deadline=deadline, callback=callback)
+
+    def get_local_path(self, key, **kwargs):
+        return self.replicas[0].get_local_path(key, **kwargs)
+
+    def get_ranges(self, ranges, **kwargs):
+        return self.read(lambda replica: replica.get_ranges(ranges, **kwargs))
+
+    def download_file(self, key, filename, **kwargs):
+        # Two requests must not write the same file, so downloads only fail over
+        return self.read(lambda replica: replica.download_file(key, filename, **kwargs), hedge=False)
+
+    def copy(self, src, dst, **kwargs):
+        self.write_all(lambda replica: replica.copy(src, dst, **kwargs))
+
+    def copy_multiple(self, pairs, **kwargs):
+        return self.write_all_multiple(lambda replica: replica.copy_multiple(pairs, **kwargs))
+
+    def move(self, src, dst, **kwargs):
+        self.write_all(lambda replica: replica.move(src, dst, **kwargs))
+
+    def move_multiple(self, pairs, **kwargs):
+        return self.write_all_multiple(lambda replica: replica.move_multiple(pairs, **kwargs))
+
+    def copy_prefix(self, src_prefix, dst_prefix, **kwargs):
+        # Every replica holds the same keys, so the counts agree
+        return self.write_all(lambda replica: replica.copy_prefix(src_prefix, dst_prefix, **kwargs))[0]
+
+    def delete(self, key, **kwargs):
+        self.write_all(lambda replica: replica.delete(key, **kwargs))
+
+    def delete_multiple(self, keys, **kwargs):
+        return self.write_all_multiple(lambda replica: replica.delete_multiple(keys, **kwargs))
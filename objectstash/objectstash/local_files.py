@@ -0,0 +1,117 @@
+import errno
+import os
+import shutil
+import stat
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where files are copied instead of cloned
+    fcntl = None
+
+
+LINK_MODES = ['copy', 'hardlink', 'reflink', 'symlink']
+# Suffix of the temporary files that writes are renamed from. FSAdapter.list_keys skips them.
+TMP_SUFFIX = '.objectstash-tmp'
+# ioctl request that clones a file (reflink) on file systems that support it (btrfs, XFS, ...)
+FICLONE = 0x40049409
+# Errors meaning that the file system (or the pair of paths) does not support a kind of link
+UNSUPPORTED_LINK_ERRNOS = [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                           errno.ENOSYS]
+
+
+def create_temp_file(directory, name):
+    # Creates the temporary file of an atomic write of directory/name and returns (file descriptor, path).
+    # Unlike mkstemp (owner-only files), creating the file with mode 0o666 lets the kernel apply the umask,
+    # so the data gets the usual permissions.
+    tmp_path = os.path.join(directory, f'.{name}.{uuid.uuid4().hex}{TMP_SUFFIX}')
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    return fd, tmp_path
+
+
+def fast_copy(fsrc, fdst):
+    # Copies between two open files with a reflink if possible, otherwise with an in-kernel copy
+    # (copy_file_range), and falls back to a buffered copy
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+    if hasattr(os, 'copy_file_range'):
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        try:
+            while copied < size:
+                num_bytes = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                if num_bytes == 0:
+                    break
+                copied += num_bytes
+            if copied == size:
+                return
+        except OSError as exc:
+            if exc.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM]:
+                raise
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+    shutil.copyfileobj(fsrc, fdst, 2 ** 20)
+
+
+def copy_file(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fast_copy(fsrc, fdst)
+
+
+def make_read_only(path):
+    mode = os.stat(path).st_mode
+    os.chmod(path, stat.S_IMODE(mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def link_file(src, dst, link_mode='copy'):
+    """Makes dst a copy of the local file src (e.g., a cached object) and returns the link mode that was used.
+
+    hardlink and symlink share the data with src, so the shared file is made read-only to keep writes meant for
+    dst from changing src. reflink shares the data blocks copy-on-write, which is safe without further checks.
+    If the file system does not support the requested mode, the file is copied instead.
+
+    dst is always replaced with a rename, so an existing dst that is a link to src is replaced instead of
+    written through.
+    """
+    if link_mode not in LINK_MODES:
+        raise ValueError(f'Unknown link mode "{link_mode}". Must be one of {LINK_MODES}.')
+    src = os.path.abspath(src)
+    dst = os.path.abspath(dst)
+    if src == dst:
+        raise ValueError(f'The target {dst} is the source file itself')
+    tmp_path = os.path.join(os.path.dirname(dst), f'.{os.path.basename(dst)}.{uuid.uuid4().hex}{TMP_SUFFIX}')
+    mode_used = link_mode
+    try:
+        try:
+            if link_mode == 'hardlink':
+                os.link(src, tmp_path)
+                make_read_only(tmp_path)
+            elif link_mode == 'symlink':
+                os.symlink(src, tmp_path)
+                make_read_only(src)
+            elif link_mode == 'reflink':
+                if fcntl is None:
+                    raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform')
+                with open(src, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            else:
+                copy_file(src, tmp_path)
+        except OSError as exc:
+            if link_mode == 'copy' or exc.errno not in UNSUPPORTED_LINK_ERRNOS:
+                raise
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+            copy_file(src, tmp_path)
+            mode_used = 'copy'
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return mode_used
@@ -0,0 +1,191 @@
+import mmap
+import os
+import pathlib
+import struct
+import time
+
+from .local_files import create_temp_file
+
+
+# A manifest file lists the keys under one prefix, sorted by their UTF-8 bytes (the order of S3 listings):
+#   magic | header (count, creation time, prefix length) | prefix | offsets of the records | records
+# Each record is (size, key length, ETag length) followed by the key and the ETag. The fixed-size offsets
+# allow a binary search directly in the memory-mapped file, so loading does not decode the entries.
+MANIFEST_MAGIC = b'OSMANI1\n'
+MANIFEST_HEADER = struct.Struct('<QdH')
+MANIFEST_OFFSET = struct.Struct('<Q')
+MANIFEST_RECORD = struct.Struct('<QHH')
+
+
+def encode_manifest(prefix, metadata, created=None):
+    # metadata maps keys to {'Size': ..., 'ETag': ...} (the ETag may be None)
+    records = []
+    for key, entry in metadata.items():
+        key_bytes = key.encode('utf-8')
+        etag_bytes = (entry.get('ETag') or '').encode('utf-8')
+        records.append((key_bytes, MANIFEST_RECORD.pack(entry['Size'], len(key_bytes), len(etag_bytes))
+                        + key_bytes + etag_bytes))
+    records.sort()
+    prefix_bytes = prefix.encode('utf-8')
+    header = MANIFEST_MAGIC + MANIFEST_HEADER.pack(len(records), created if created is not None else time.time(),
+                                                   len(prefix_bytes)) + prefix_bytes
+    offset = len(header) + MANIFEST_OFFSET.size * len(records)
+    offsets = []
+    for _, record in records:
+        offsets.append(MANIFEST_OFFSET.pack(offset))
+        offset += len(record)
+    return b''.join([header] + offsets + [record for _, record in records])
+
+
+class KeyManifest:
+    """A sorted index of the keys under a prefix with their sizes and ETags, stored in a local file.
+
+    The file is memory-mapped and searched in place, so even manifests of millions of keys load instantly and
+    answer membership, size and listing queries without requests to the back-end.
+
+    Args:
+        path (string or pathlib.Path): The manifest file, written by KeyManifest.write.
+    """
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        with open(self.path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MANIFEST_MAGIC)] != MANIFEST_MAGIC:
+            self.data.close()
+            raise ValueError(f'{self.path} is not a key manifest.')
+        pos = len(MANIFEST_MAGIC)
+        self.count, self.created, prefix_length = MANIFEST_HEADER.unpack_from(self.data, pos)
+        pos += MANIFEST_HEADER.size
+        self.prefix = self.data[pos:pos + prefix_length].decode('utf-8')
+        self.offsets_start = pos + prefix_length
+
+    @classmethod
+    def write(cls, path, prefix, metadata, created=None):
+        """Writes a manifest file (atomically) and returns the loaded manifest.
+
+        Args:
+            path (string or pathlib.Path): The manifest file.
+            prefix (string): The prefix that the manifest covers. All keys must start with it.
+            metadata (dictionary): Maps keys to dictionaries with the entries 'Size' and 'ETag'.
+            created (float, optional): The time of the listing (default: now).
+        """
+        path = pathlib.Path(path)
+        assert all(key.startswith(prefix) for key in metadata), 'All keys must start with the prefix'
+        data = encode_manifest(prefix, metadata, created)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = create_temp_file(path.parent, path.name)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return cls(path)
+
+    def __getstate__(self):
+        # Another process maps the same file
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return self.count
+
+    def record_offset(self, index):
+        return MANIFEST_OFFSET.unpack_from(self.data, self.offsets_start + MANIFEST_OFFSET.size * index)[0]
+
+    def key_bytes_at(self, index):
+        pos = self.record_offset(index)
+        _, key_length, _ = MANIFEST_RECORD.unpack_from(self.data, pos)
+        pos += MANIFEST_RECORD.size
+        return self.data[pos:pos + key_length]
+
+    def entry_at(self, index):
+        # Returns (key, size, ETag) of the index-th key in sorted order
+        pos = self.record_offset(index)
+        size, key_length, etag_length = MANIFEST_RECORD.unpack_from(self.data, pos)
+        pos += MANIFEST_RECORD.size
+        key = self.data[pos:pos + key_length].decode('utf-8')
+        pos += key_length
+        etag = self.data[pos:pos + etag_length].decode('utf-8') if etag_length > 0 else None
+        return key, size, etag
+
+    def lower_bound(self, key_bytes, start=0):
+        # Index of the first key that is not smaller than key_bytes
+        lo, hi = start, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key_bytes_at(mid) < key_bytes:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, key):
+        # Returns the index of the key, or None if the manifest does not contain it
+        key_bytes = key.encode('utf-8')
+        index = self.lower_bound(key_bytes)
+        if index < self.count and self.key_bytes_at(index) == key_bytes:
+            return index
+        return None
+
+    def covers(self, prefix):
+        # Whether every key under prefix is also under the prefix of the manifest
+        return prefix.startswith(self.prefix)
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def metadata(self, key):
+        index = self.find(key)
+        if index is None:
+            raise KeyError(key)
+        _, size, etag = self.entry_at(index)
+        return {'Size': size, 'ETag': etag}
+
+    def size(self, key):
+        return self.metadata(key)['Size']
+
+    def last_key(self):
+        return self.entry_at(self.count - 1)[0] if self.count > 0 else None
+
+    def entries(self, prefix=''):
+        # Yields (key, size, ETag) for the keys under prefix in sorted order
+        prefix_bytes = prefix.encode('utf-8')
+        index = self.lower_bound(prefix_bytes)
+        while index < self.count and self.key_bytes_at(index).startswith(prefix_bytes):
+            yield self.entry_at(index)
+            index += 1
+
+    def all_metadata(self):
+        return {key: {'Size': size, 'ETag': etag} for key, size, etag in self.entries()}
+
+    def sizes(self, prefix=''):
+        return {key: size for key, size, _ in self.entries(prefix)}
+
+    def list_keys(self, prefix=''):
+        # Lists like S3 with the delimiter "/": keys directly under the prefix and the "directories" below it,
+        # which are skipped with a binary search instead of a scan
+        prefix_bytes = prefix.encode('utf-8')
+        files = []
+        dirs = []
+        index = self.lower_bound(prefix_bytes)
+        while index < self.count:
+            key_bytes = self.key_bytes_at(index)
+            if not key_bytes.startswith(prefix_bytes):
+                break
+            slash = key_bytes.find(b'/', len(prefix_bytes))
+            if slash < 0:
+                files.append(key_bytes.decode('utf-8'))
+                index += 1
+            else:
+                dirs.append(key_bytes[:slash + 1].decode('utf-8'))
+                # "0" is the byte after "/", so this is the first key outside the directory
+                index = self.lower_bound(key_bytes[:slash] + b'0', index)
+        return files + dirs
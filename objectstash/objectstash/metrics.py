@@ -0,0 +1,150 @@
+import bisect
+import collections
+import contextlib
+import threading
+from timeit import default_timer as timer
+
+from .tracing import TraceEvent
+
+
+# Upper bounds (in seconds) of the latency histogram buckets: 50 microseconds to about 100 seconds,
+# growing by a factor of 1.5. The last bucket collects everything above the largest bound.
+LATENCY_BUCKET_BOUNDS = [50e-6 * 1.5 ** ii for ii in range(36)]
+
+
+class LatencyHistogram:
+    """A fixed-bucket latency histogram. Recording a value is one bisect and a few additions."""
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        # Returns the upper bound of the bucket containing the q-th percentile (clamped to the observed range)
+        if self.count == 0:
+            return None
+        target = q / 100.0 * self.count
+        cumulative = 0
+        for ii, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count > 0:
+                bound = LATENCY_BUCKET_BOUNDS[ii] if ii < len(LATENCY_BUCKET_BOUNDS) else self.max
+                return min(max(bound, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'total_time': self.total,
+                'mean': self.total / self.count if self.count > 0 else None,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99)}
+
+
+class Metrics:
+    """Thread-safe counters and per-operation latency histograms for a storage adapter.
+
+    Operations (e.g., "get", "put", "head", "list", "delete") are recorded with their latency and the bytes
+    transferred. Other events (retries, backoff time, cache hits / misses / evictions) are plain counters.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = collections.defaultdict(LatencyHistogram)
+        self.counters = collections.defaultdict(int)
+        self.hooks = []
+
+    def add_hook(self, hook):
+        with self.lock:
+            self.hooks = self.hooks + [hook]
+
+    def remove_hook(self, hook):
+        with self.lock:
+            self.hooks = [x for x in self.hooks if x is not hook]
+
+    def record(self, operation, seconds, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.histograms[operation].record(seconds)
+            if bytes_in:
+                self.counters['bytes_in'] += bytes_in
+            if bytes_out:
+                self.counters['bytes_out'] += bytes_out
+
+    def increment(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    @contextlib.contextmanager
+    def timed(self, operation, key=None, attempt=1):
+        # Records the latency of the enclosed block and reports it to the trace hooks.
+        # Byte counts can be added to the yielded dictionary.
+        transfer = {'bytes_in': 0, 'bytes_out': 0}
+        hooks = self.hooks
+        event = None
+        if hooks:
+            event = TraceEvent(operation, key=key, attempt=attempt)
+            for hook in hooks:
+                hook.on_start(event)
+        start = timer()
+        try:
+            yield transfer
+        except BaseException as exc:
+            self.increment(f'{operation}_errors')
+            if event is not None:
+                event.error = exc
+            raise
+        finally:
+            end = timer()
+            self.record(operation, end - start, **transfer)
+            if event is not None:
+                event.start_time = start
+                event.end_time = end
+                event.bytes_in = transfer['bytes_in']
+                event.bytes_out = transfer['bytes_out']
+                for hook in hooks:
+                    hook.on_end(event)
+
+    def snapshot(self, reset=False):
+        with self.lock:
+            counters = dict(self.counters)
+            operations = {op: hist.summary() for op, hist in self.histograms.items()}
+            if reset:
+                self.histograms = collections.defaultdict(LatencyHistogram)
+                self.counters = collections.defaultdict(int)
+        result = {'operations': operations, 'counters': counters}
+        hits = counters.get('cache_hits', 0)
+        lookups = hits + counters.get('cache_misses', 0)
+        result['cache_hit_rate'] = hits / lookups if lookups > 0 else None
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.histograms = collections.defaultdict(LatencyHistogram)
+            self.counters = collections.defaultdict(int)
+
+
+def record_retry(metrics, delay):
+    if metrics is not None:
+        metrics.increment('retries')
+        metrics.increment('retry_sleep_time', delay)
+
+
+@contextlib.contextmanager
+def maybe_timed(metrics, operation, key=None, attempt=1):
+    if metrics is None:
+        yield {'bytes_in': 0, 'bytes_out': 0}
+    else:
+        with metrics.timed(operation, key=key, attempt=attempt) as transfer:
+            yield transfer
@@ -1,5 +1,25 @@
+import os
+import time
+
+from .storage_adapter import StorageAdapter
 from .s3_adapter import S3Adapter
 from .fs_adapter import FSAdapter
+from .tiered_adapter import TieredAdapter
+from .sharded_adapter import ShardedAdapter, HashRing
+from .hedged_adapter import HedgedAdapter
+from .shared_cache import SharedMemoryCache, SharedCacheAdapter
+from .serialization import (Serializer, BytesSerializer, NumpySerializer, PickleSerializer,
+                            register_serializer, serialize, deserialize, deserialize_file)
+from .content_addressing import ContentAddressedStore
+from .write_behind import WriteBehindBuffer, WriteBehindError
+from .bulk import BulkOperationError, BulkResult, DeadlineExceeded
+from .prefetch import Prefetcher
+from .tracing import TraceHook, TraceEvent, ChromeTraceSink
+from .process_pool import get_multiple_transformed
+from .frames import copy_into
+from .streaming import is_stream_like, read_all
+from .manifest import KeyManifest
+from .packing import PackIndex, build_pack, coalesce_ranges, pack_data_key, pack_index_key
     
 
 def is_get_list_like(x):
@@ -19,17 +39,150 @@ class ObjectStash:
         If one keyword is "s3_bucket", constructs an S3-based object stash for the given bucket. The S3 back-end
             currently supports the following options: TODO: document this.
 
+        If one keyword is "rootdir", constructs a file system stash. Writes are atomic (write to a temporary file,
+            then rename). The option "durability" selects "none" (default), "file" (fsync the file), or "directory"
+            (also fsync the directory), and "max_num_threads" (default 8) the parallelism of put_multiple.
+
+        If one keyword is "adapter", the given StorageAdapter is used as the back-end. For instance,
+            adapter=TieredAdapter(FSAdapter(nvme_dir), S3Adapter(bucket)) keeps the working set on a local disk.
+
+        If the keyword "content_addressed" is True, values are deduplicated: each distinct value is stored once
+            under a key derived from its SHA-256 hash (below the prefix given by "content_blob_prefix", default
+            ".cas/sha256/"), and the key passed to put holds a small reference to it. Uploads of values that are
+            already stored are skipped. Hashing uses "hash_num_threads" threads (default: number of CPUs).
+
+        If the keyword "write_behind" is True, put only enqueues the data and returns immediately, and background
+            threads (number given by "write_behind_num_threads", default 8) upload it. At most
+            "write_behind_max_bytes" bytes (default 256 MiB) are buffered; put blocks while the buffer is full.
+            Use flush() or close() to wait for the uploads. Upload errors are raised by the next call.
+
+        If the keyword "shared_cache" is given, reads go through a host-level cache in shared memory that all
+            processes on the host share (e.g., the workers of a data loader), and get_view returns zero-copy views
+            of cached objects. The value is True (cache in /dev/shm/objectstash), a directory, or a
+            SharedMemoryCache. "shared_cache_max_bytes" (default 1 GiB) limits the total size of a cache created
+            from a directory; the least recently used objects are evicted beyond it.
+
+        The keyword "pack_coalesce_gap" (default 0) is the largest number of unrequested bytes that may be read
+            to merge two byte-range reads of packed keys into one request.
+
         Raises:
             ValueError: If the keyword arguments do not contain a recognized keyword that determines the back-end.
         """        
+        self.pack_coalesce_gap = kwargs.pop('pack_coalesce_gap', 0)
+        self.pack_indices = {}
+        self.manifests = {}
+        content_addressed = kwargs.pop('content_addressed', False)
+        content_blob_prefix = kwargs.pop('content_blob_prefix', None)
+        hash_num_threads = kwargs.pop('hash_num_threads', None)
+        write_behind = kwargs.pop('write_behind', False)
+        write_behind_max_bytes = kwargs.pop('write_behind_max_bytes', 256 * 2 ** 20)
+        write_behind_num_threads = kwargs.pop('write_behind_num_threads', 8)
+        shared_cache = kwargs.pop('shared_cache', None)
+        shared_cache_max_bytes = kwargs.pop('shared_cache_max_bytes', 2 ** 30)
         if 's3_bucket' in kwargs:
             bucket = kwargs.pop('s3_bucket')
             self.adapter = S3Adapter(bucket, **kwargs)
         elif 'rootdir' in kwargs:
             rootdir = kwargs.pop('rootdir')
-            self.adapter = FSAdapter(rootdir)
+            self.adapter = FSAdapter(rootdir, **kwargs)
+        elif 'adapter' in kwargs:
+            self.adapter = kwargs.pop('adapter')
+        else:
+            raise ValueError(f'Currently supported keywords: "s3_bucket", "rootdir", and "adapter".')
+        if shared_cache is not None and shared_cache is not False:
+            if not isinstance(shared_cache, SharedMemoryCache):
+                directory = None if shared_cache is True else shared_cache
+                shared_cache = SharedMemoryCache(directory, max_bytes=shared_cache_max_bytes)
+            self.adapter = SharedCacheAdapter(self.adapter, shared_cache)
+        if content_addressed:
+            cas_kwargs = {} if content_blob_prefix is None else {'blob_prefix': content_blob_prefix}
+            self.content_store = ContentAddressedStore(self.adapter, hash_num_threads=hash_num_threads, **cas_kwargs)
+        else:
+            self.content_store = None
+        if write_behind:
+            self.write_behind = WriteBehindBuffer(self.put_unbuffered,
+                                                  max_bytes=write_behind_max_bytes,
+                                                  num_threads=write_behind_num_threads)
         else:
-            raise ValueError(f'Currently supported keywords: "s3_bucket" and "rootdir".')
+            self.write_behind = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def flush(self):
+        """Waits until all data buffered by a write-behind stash or by the back-end adapter has been stored.
+
+        Raises:
+            WriteBehindError: If uploading buffered data failed.
+        """
+        self.flush_write_behind()
+        self.adapter.flush()
+
+    def flush_write_behind(self):
+        # Makes pending write-behind puts visible to the back-end before operations that bypass the buffer
+        if self.write_behind is not None:
+            self.write_behind.flush()
+
+    def close(self):
+        """Flushes buffered data and stops the background threads of a write-behind stash and the back-end adapter.
+
+        Raises:
+            WriteBehindError: If uploading buffered data failed.
+        """
+        if self.write_behind is not None:
+            self.write_behind.close()
+        self.adapter.close()
+        for manifest in self.manifests.values():
+            manifest.close()
+        self.manifests = {}
+
+    def stats(self, reset=False):
+        """Returns a snapshot of the metrics recorded by the back-end adapter.
+
+        The snapshot contains, for each operation (e.g., "get", "put", "head", "list", "delete", "download",
+        "upload"), the number of requests and latency statistics (mean, min, max, p50, p90, p99 in seconds), as well
+        as counters for bytes in and out, retries and the time spent in backoff sleeps, and disk cache hits,
+        misses and evictions.
+
+        Args:
+            reset (bool): Whether to reset the metrics after taking the snapshot.
+
+        Returns:
+            dictionary: The metrics snapshot (empty if the adapter does not record metrics).
+        """
+        if self.adapter.metrics is None:
+            return {}
+        return self.adapter.metrics.snapshot(reset=reset)
+
+    def reset_stats(self):
+        """Resets the metrics recorded by the back-end adapter."""
+        if self.adapter.metrics is not None:
+            self.adapter.metrics.reset()
+
+    def add_trace_hook(self, hook):
+        """Registers a hook that is called at the start and end of every back-end call.
+
+        Each call (one attempt of an S3 get_object, head_object, upload_fileobj, list_objects or delete_object,
+        or one read or write of a file system stash) produces a TraceEvent with the operation, key, attempt
+        number, thread, bytes transferred, the time the call waited in the thread pool queue (queue_wait) and
+        the time the call itself took (service_time).
+        For instance, stash.add_trace_hook(sink) with sink = ChromeTraceSink() followed by
+        sink.write('trace.json') produces a timeline that can be viewed in chrome://tracing.
+
+        Args:
+            hook (TraceHook): The hook to register.
+
+        Returns:
+            The function does not return values.
+        """
+        self.adapter.add_trace_hook(hook)
+
+    def remove_trace_hook(self, hook):
+        """Unregisters a hook added with add_trace_hook."""
+        self.adapter.remove_trace_hook(hook)
 
     def list_keys(self, prefix, **kwargs):
         """Lists keys in the stash under the given prefix.
@@ -43,9 +196,37 @@ class ObjectStash:
         Returns:
             [list of strings]: The list of keys in the stash under the prefix.
         """        
-        return self.adapter.list_keys(prefix, **kwargs)
+        manifest = self.find_manifest(prefix)
+        if manifest is not None:
+            keys = manifest.list_keys(prefix)
+        else:
+            self.flush_write_behind()
+            keys = self.adapter.list_keys(prefix, **kwargs)
+        if self.content_store is not None:
+            keys = self.content_store.filter_keys(keys, prefix)
+        return keys
 
     # TODO: add a version that supports multiple keys? 
+    def list_sizes(self, prefix, **kwargs):
+        """Returns the sizes of all keys under a prefix, including keys in nested "directories".
+
+        Args:
+            prefix (string): The prefix of the keys.
+
+        Returns:
+            dictionary: A dictionary mapping keys to their sizes in bytes.
+        """
+        manifest = self.find_manifest(prefix)
+        if manifest is not None:
+            sizes = manifest.sizes(prefix)
+        else:
+            self.flush_write_behind()
+            sizes = self.adapter.list_sizes(prefix, **kwargs)
+        if self.content_store is not None:
+            # Reports the sizes of the data instead of the references
+            sizes = self.content_store.resolve_sizes(sizes, prefix)
+        return sizes
+
     def exists(self, key, **kwargs):
         """Checks if a given key exists in the stash.
 
@@ -57,19 +238,26 @@ class ObjectStash:
         Returns:
             [bool]: Whether the key exists or not.
         """        
+        if self.write_behind is not None and self.write_behind.get_pending(key) is not None:
+            return True
+        manifest = self.find_manifest(key)
+        if manifest is not None:
+            return key in manifest
         return self.adapter.exists(key, **kwargs)
 
-    # TODO: add support for passing in file-like objects
     def put(self, key_or_data_dict, *args, **kwargs):
         """Inserts one or multiple values into the stash.
 
         For instance, stash.put(key, value) and stash.put(key_value_dict) both work,
         where key_value_dict is a dictionary mapping from keys (strings) to data (bytes).
+        Instead of bytes, a value can also be a file-like object opened in binary mode or an iterable of chunks
+        (e.g., a generator producing a tar stream). Such values are streamed to the back-end (with a multipart
+        upload for S3) without holding the entire data in memory.
 
         Args:
             key_or_data_dict (string or a dictionary from string to bytes): For a single (key, value) pair, the first argument is the key.
                     For multiple (key, value) pairs, this is a dictionary from the keys (strings) to the data (bytes) to be inserted.
-            data (bytes): If the first argument is a single key (string), the second argument must be the data (bytes) to be inserted.
+            data (bytes, file-like object, or iterable of bytes): If the first argument is a single key (string), the second argument must be the data to be inserted.
 
         Raises:
             ValueError: If the arguments passed in do not match the format above.
@@ -79,17 +267,45 @@ class ObjectStash:
         """        
         if type(key_or_data_dict) is dict:
             assert len(args) == 0
-            return self.adapter.put_multiple(key_or_data_dict, **kwargs)
+            data_dict = key_or_data_dict
         elif type(key_or_data_dict) is str:
-            if len(args) == 1 and type(args[0]) is bytes:
+            if len(args) == 1:
                 data = args[0]
             else:
                 assert len(args) == 0
                 assert 'data' in kwargs, f'Must supply data as a positional or keyword argument if a single key is the target.'
                 data = kwargs.pop('data')
-            return self.adapter.put(key_or_data_dict, data, **kwargs)
+            data_dict = {key_or_data_dict: data}
         else:
-            raise ValueError(f'Unknown data type for data: f{type(data)}. Must be dictionary or bytes.')
+            raise ValueError(f'Unknown data type for data: f{type(key_or_data_dict)}. Must be dictionary or bytes.')
+        stream_keys = [key for key, data in data_dict.items() if is_stream_like(data)]
+        if stream_keys:
+            if self.content_store is not None:
+                # The data must be hashed before it is stored
+                data_dict = {key: read_all(data) if key in stream_keys else data for key, data in data_dict.items()}
+            else:
+                self.flush_write_behind()
+                for key in stream_keys:
+                    self.adapter.put_stream(key, data_dict[key], **kwargs)
+                data_dict = {key: data for key, data in data_dict.items() if key not in stream_keys}
+                if not data_dict:
+                    return
+        if self.write_behind is not None:
+            for key, data in data_dict.items():
+                self.write_behind.put(key, data, **kwargs)
+        elif self.content_store is not None:
+            self.content_store.put_multiple(data_dict, **kwargs)
+        elif type(key_or_data_dict) is str:
+            self.adapter.put(key_or_data_dict, data_dict[key_or_data_dict], **kwargs)
+        else:
+            self.adapter.put_multiple(data_dict, **kwargs)
+
+    def put_unbuffered(self, key, data, **kwargs):
+        # Stores a single value immediately, bypassing the write-behind buffer. Used by the buffer's threads.
+        if self.content_store is not None:
+            self.content_store.put_multiple({key: data}, **kwargs)
+        else:
+            self.adapter.put(key, data, **kwargs)
 
     # TODO: add a version that supports multiple keys? 
     def upload_file(self, key, filename , **kwargs):
@@ -103,43 +319,552 @@ class ObjectStash:
         Returns:
             The function does not return values.
         """        
+        self.flush_write_behind()
         return self.adapter.upload_file(key, filename, **kwargs)
     
+    def put_packed(self, prefix, data_dict, **kwargs):
+        """Stores many small values as one packed shard.
+
+        The values are written back to back into a single data object, together with a compact index of their
+        offsets and lengths. Afterwards, the value for name can be retrieved with stash.get(prefix + '/' + name),
+        which turns into a byte-range read of the data object.
+
+        Args:
+            prefix (string): The prefix of the shard. The shard is stored under the keys prefix + '.pack' and
+                    prefix + '.idx'.
+            data_dict (dictionary from string to bytes): The member names and their data.
+
+        Returns:
+            The function does not return values.
+        """
+        self.flush_write_behind()
+        frames, index = build_pack(data_dict)
+        self.adapter.put_frames(pack_data_key(prefix), frames, **kwargs)
+        self.adapter.put(pack_index_key(prefix), index.encode(), **kwargs)
+        self.pack_indices[prefix] = index
+
+    def open_packed(self, prefix, **kwargs):
+        """Loads the index of a packed shard written by put_packed so that get resolves keys under the prefix.
+
+        Shards written through this stash object with put_packed are opened automatically.
+
+        Args:
+            prefix (string): The prefix of the shard.
+
+        Returns:
+            [list of strings]: The member names of the shard.
+        """
+        index = PackIndex.decode(self.adapter.get(pack_index_key(prefix), **kwargs))
+        self.pack_indices[prefix] = index
+        return list(index.entries.keys())
+
+    def resolve_packed_key(self, key):
+        # Returns (prefix, member name) if the key belongs to an opened packed shard, otherwise None
+        if not self.pack_indices:
+            return None
+        pos = key.find('/')
+        while pos > 0:
+            prefix = key[:pos]
+            index = self.pack_indices.get(prefix)
+            if index is not None and key[pos + 1:] in index:
+                return prefix, key[pos + 1:]
+            pos = key.find('/', pos + 1)
+        return None
+
+    def open_manifest(self, prefix, path, refresh=False, **kwargs):
+        """Answers list_keys, exists and list_sizes under a prefix from a local manifest file instead of the back-end.
+
+        The manifest is a sorted index of the keys under the prefix with their sizes and ETags. It is
+        memory-mapped and searched in place, so opening it is instant even for millions of keys. If the file
+        does not exist yet, the prefix is listed once and the manifest is written to the file. Manifests are
+        meant for prefixes that do not change: keys written or deleted later (also through this stash) are only
+        seen after refresh_manifest.
+
+        Args:
+            prefix (string): The prefix covered by the manifest.
+            path (string or pathlib.Path): The local manifest file.
+            refresh (bool): Whether to add keys that were written after the manifest (see refresh_manifest).
+
+        Raises:
+            ValueError: If the file is not a manifest or belongs to a different prefix.
+
+        Returns:
+            int: The number of keys in the manifest.
+        """
+        if os.path.exists(path):
+            manifest = KeyManifest(path)
+            if manifest.prefix != prefix:
+                manifest.close()
+                raise ValueError(f'The manifest {path} is for the prefix "{manifest.prefix}", not "{prefix}".')
+            self.manifests[prefix] = manifest
+            if refresh:
+                self.refresh_manifest(prefix, **kwargs)
+        else:
+            self.flush_write_behind()
+            created = time.time()
+            metadata = self.adapter.list_metadata(prefix, **kwargs)
+            self.manifests[prefix] = KeyManifest.write(path, prefix, metadata, created)
+        return len(self.manifests[prefix])
+
+    def refresh_manifest(self, prefix, full=False, **kwargs):
+        """Updates the manifest file of a prefix opened with open_manifest.
+
+        The incremental refresh lists only the keys after the last key of the manifest (in the sorted order of
+        S3 listings), which finds new keys of a dataset that is only appended to with increasing names
+        (e.g., numbered shards) in a few requests. The full refresh lists the entire prefix again and also
+        picks up deleted, rewritten and other new keys.
+
+        Args:
+            prefix (string): The prefix of the manifest.
+            full (bool): Whether to list the entire prefix again.
+
+        Returns:
+            int: The number of keys added to the manifest (the number of keys in the manifest for a full refresh).
+        """
+        self.flush_write_behind()
+        manifest = self.manifests[prefix]
+        created = time.time()
+        if full:
+            metadata = self.adapter.list_metadata(prefix, **kwargs)
+            num_added = len(metadata)
+        else:
+            new_metadata = self.adapter.list_metadata(prefix, start_after=manifest.last_key(), **kwargs)
+            num_added = len(new_metadata)
+            if num_added == 0:
+                return 0
+            metadata = manifest.all_metadata()
+            metadata.update(new_metadata)
+            created = manifest.created
+        manifest.close()
+        self.manifests[prefix] = KeyManifest.write(manifest.path, prefix, metadata, created)
+        return num_added
+
+    def find_manifest(self, key_or_prefix):
+        # Returns the opened manifest with the longest prefix covering all keys under key_or_prefix, or None
+        best = None
+        for manifest in self.manifests.values():
+            if manifest.covers(key_or_prefix) and (best is None or len(manifest.prefix) > len(best.prefix)):
+                best = manifest
+        return best
+
+    def get_packed_multiple(self, packed_keys, **kwargs):
+        # packed_keys maps keys to (prefix, member name). Ranges in the same shard are coalesced.
+        requests = []
+        placements = {}
+        by_prefix = {}
+        for key, (prefix, name) in packed_keys.items():
+            by_prefix.setdefault(prefix, []).append((key, name))
+        for prefix, members in by_prefix.items():
+            index = self.pack_indices[prefix]
+            member_ranges = [index[name] for _, name in members]
+            for start, length, member_indices in coalesce_ranges(member_ranges, max_gap=self.pack_coalesce_gap):
+                for ii in member_indices:
+                    offset, member_length = member_ranges[ii]
+                    placements[members[ii][0]] = (len(requests), offset - start, member_length)
+                requests.append((pack_data_key(prefix), start, length))
+        range_data = self.adapter.get_ranges(requests, **kwargs)
+        result = {}
+        for key, (request_index, offset, length) in placements.items():
+            result[key] = bytes(memoryview(range_data[request_index])[offset:offset + length])
+        return result
+
     def get(self, key, **kwargs):
         """Retrieves data for one or multiple keys from the stash.
 
         For instance, stash.get(key) and stash.get(keys) both work,
         where keys is a list of keys (strings).
 
+        For a list of keys, get also accepts the keywords "on_error" and "timeout" (as do get_into, download_file,
+            copy, move and delete for multiple keys). With on_error="fail_fast" (default), the first failed key
+            cancels the pending requests and raises a BulkOperationError that holds the data of the keys already
+            retrieved. With on_error="collect", all keys are attempted and the returned dictionary has an attribute
+            "errors" mapping the failed keys to their exceptions, so that only those need to be retried. timeout (in
+            seconds) is the deadline of the whole call; keys not retrieved by then fail with DeadlineExceeded.
+            Local stashes (FSAdapter) read the keys one after another and do not interrupt a read that already
+            started, so only the keys after the deadline fail.
+
         Args:
             key (string or list of strings): Either a single key or a list of keys.
 
         Raises:
             ValueError: If the arguments passed in do not match the format above.
+            BulkOperationError: If a key failed with on_error="fail_fast".
 
         Returns:
             bytes or dictionary from string to bytes: The data for each key to be retrieved.
         """        
         if type(key) is str:
+            if self.write_behind is not None:
+                pending = self.write_behind.get_pending(key)
+                if pending is not None:
+                    return pending
+            packed = self.resolve_packed_key(key)
+            if packed is not None:
+                return self.get_packed_multiple({key: packed}, **kwargs)[key]
+            if self.content_store is not None:
+                return self.content_store.resolve(self.adapter.get(key, **kwargs), **kwargs)
             return self.adapter.get(key, **kwargs)
         elif is_get_list_like(key):
-            return self.adapter.get_multiple(key, **kwargs)
+            packed_keys = {}
+            other_keys = []
+            pending = {}
+            for cur_key in key:
+                if self.write_behind is not None:
+                    pending_data = self.write_behind.get_pending(cur_key)
+                    if pending_data is not None:
+                        pending[cur_key] = pending_data
+                        continue
+                packed = self.resolve_packed_key(cur_key)
+                if packed is None:
+                    other_keys.append(cur_key)
+                else:
+                    packed_keys[cur_key] = packed
+            result = self.adapter.get_multiple(other_keys, **kwargs)
+            callback = kwargs.pop('callback', None)
+            if self.content_store is not None:
+                self.content_store.resolve_multiple(result, **kwargs)
+            if packed_keys:
+                result.update(self.get_packed_multiple(packed_keys, **kwargs))
+            if callback and (packed_keys or pending):
+                callback(len(packed_keys) + len(pending))
+            result.update(pending)
+            return result
         else:
             raise ValueError(f'Unknown data type for key: f{type(key)}. Must be string or list.')
     
-    # TODO: add a version that supports multiple keys? 
-    def download_file(self, key, filename, **kwargs):
-        """Downloads the data corresponding to the given key into the given file.
+    def get_into(self, key_or_buffers, buffer=None, **kwargs):
+        """Reads data for one or multiple keys directly into caller-provided buffers.
+
+        For instance, stash.get_into(key, buffer) and stash.get_into({key: buffer}) both work, where buffer is a
+        writable buffer (e.g., a bytearray, a NumPy array, or a memoryview of a slice of a larger array).
+        The data is streamed from the S3 response, the file of a file system stash, or the local disk cache into
+        the buffer, without an intermediate bytes object.
+
+        Args:
+            key_or_buffers (string or dictionary from string to buffer): Either a single key or a dictionary from
+                    keys to buffers.
+            buffer (writable buffer): If the first argument is a single key, the buffer to read into.
+
+        Raises:
+            ValueError: If the data for a key is larger than its buffer, or the arguments do not match the
+                    format above.
+
+        Returns:
+            int or dictionary from string to int: The number of bytes written into each buffer.
+        """
+        if type(key_or_buffers) is str:
+            assert buffer is not None, 'Must supply a buffer if a single key is the target.'
+            buffers = {key_or_buffers: buffer}
+        elif type(key_or_buffers) is dict:
+            assert buffer is None
+            buffers = key_or_buffers
+        else:
+            raise ValueError(f'Unknown data type for key: f{type(key_or_buffers)}. Must be string or dictionary.')
+        # Pending writes, packed keys and content references are resolved by get and then copied
+        if self.content_store is not None:
+            copied_keys = list(buffers.keys())
+        else:
+            copied_keys = [key for key in buffers.keys() if self.resolve_packed_key(key) is not None
+                           or (self.write_behind is not None and self.write_behind.get_pending(key) is not None)]
+        result = {}
+        if copied_keys:
+            callback = kwargs.get('callback', None)
+            get_kwargs = {name: value for name, value in kwargs.items() if name != 'callback'}
+            for key, data in self.get(copied_keys, **get_kwargs).items():
+                result[key] = copy_into(data, buffers[key])
+            if callback:
+                callback(len(copied_keys))
+        direct = {key: cur_buffer for key, cur_buffer in buffers.items() if key not in result}
+        if type(key_or_buffers) is str:
+            if direct:
+                kwargs.pop('callback', None)
+                return self.adapter.get_into(key_or_buffers, buffer, **kwargs)
+            return result[key_or_buffers]
+        if direct:
+            # Keeps the errors of a get with on_error="collect"
+            direct_result = self.adapter.get_multiple_into(direct, **kwargs)
+            direct_result.update(result)
+            return direct_result
+        return result
+
+    def get_view(self, key, **kwargs):
+        """Retrieves read-only views of the data for one or multiple keys.
+
+        With a shared cache (the "shared_cache" option), cached objects are returned as views of the shared
+        memory without a copy, and all processes on the host read the same memory. The views stay valid after
+        the object is evicted or overwritten. Without a shared cache, the views wrap the data returned by get.
+
+        Args:
+            key (string or list of strings): Either a single key or a list of keys.
+
+        Raises:
+            ValueError: If the arguments passed in do not match the format above.
+
+        Returns:
+            memoryview or dictionary from string to memoryview: The data for each key to be retrieved.
+        """
+        if type(key) is str:
+            keys = [key]
+        elif is_get_list_like(key):
+            keys = key
+        else:
+            raise ValueError(f'Unknown data type for key: f{type(key)}. Must be string or list.')
+        # Pending writes, packed keys and content references are resolved by get
+        if self.content_store is not None:
+            copied_keys = list(keys)
+        else:
+            copied_keys = [cur_key for cur_key in keys if self.resolve_packed_key(cur_key) is not None
+                           or (self.write_behind is not None and self.write_behind.get_pending(cur_key) is not None)]
+        if type(key) is str:
+            if copied_keys:
+                return memoryview(self.get(key, **kwargs))
+            return self.adapter.get_view(key, **kwargs)
+        result = {}
+        if copied_keys:
+            callback = kwargs.get('callback', None)
+            get_kwargs = {name: value for name, value in kwargs.items() if name != 'callback'}
+            for cur_key, data in self.get(copied_keys, **get_kwargs).items():
+                result[cur_key] = memoryview(data)
+            if callback:
+                callback(len(copied_keys))
+        direct = [cur_key for cur_key in keys if cur_key not in result]
+        if direct:
+            result.update(self.adapter.get_multiple_views(direct, **kwargs))
+        return result
+
+    def put_obj(self, key, obj, serializer=None, **kwargs):
+        """Serializes an object and inserts it into the stash.
+
+        NumPy arrays are written directly from their memory, and generic objects are pickled with
+        protocol 5 so that large buffers inside them are written out of band without extra copies.
 
         Args:
-            key (string): The key for which data should be downloaded.
-            filename (string or pathlib.Path): The target filename.
+            key (string): The target key.
+            obj (object): The object to be stored.
+            serializer (string or Serializer, optional): The serializer to use ("bytes", "numpy", "pickle", or a
+                    registered custom serializer). By default, the serializer is chosen based on the type of obj.
 
         Returns:
             The function does not return values.
+        """
+        self.flush_write_behind()
+        frames = serialize(obj, serializer=serializer)
+        return self.adapter.put_frames(key, frames, **kwargs)
+
+    def get_obj(self, key, serializer=None, use_mmap=True, **kwargs):
+        """Retrieves an object stored with put_obj.
+
+        If the back-end has a local copy of the data (the root directory of a file system stash or the local disk
+        cache of an S3 stash), the file is memory-mapped and NumPy arrays are returned as read-only views of it.
+        Otherwise arrays are read-only views into the downloaded bytes.
+
+        Args:
+            key (string): The key of the object.
+            serializer (string or Serializer, optional): Overrides the serializer recorded when the object was stored.
+            use_mmap (bool): Whether to memory-map local copies of the data.
+
+        Raises:
+            ValueError: If the data for the key was not written by put_obj.
+
+        Returns:
+            object: The deserialized object.
+        """
+        self.flush_write_behind()
+        if use_mmap:
+            local_path = self.adapter.get_local_path(key, **kwargs)
+            if local_path is not None:
+                return deserialize_file(local_path, serializer=serializer)
+        return deserialize(self.adapter.get(key, **kwargs), serializer=serializer)
+
+    def prefetch_iter(self, keys, window=16, max_bytes=None, batch_size=8, num_threads=4, **kwargs):
+        """Iterates over the data for a sequence of keys, fetching ahead of the consumer.
+
+        Useful for data loaders that read keys in a known (e.g., shuffled) order. Batches of keys are fetched in
+        the background with the same bulk get as stash.get(keys), and the number of keys fetched ahead adapts
+        to the speed of the consumer. The returned Prefetcher records the time the consumer spent waiting for
+        data in its attribute stall_time. It can be iterated over only once.
+
+        For instance, for key, data in stash.prefetch_iter(keys, window=64) yields the data in the order of keys.
+
+        Args:
+            keys (list of strings): The keys in the order in which they will be consumed.
+            window (int): The initial number of keys to fetch ahead of the consumer.
+            max_bytes (int, optional): Pause fetching while more than this many bytes are waiting to be consumed
+                    or expected from the batches in flight.
+            batch_size (int): The largest number of keys fetched with one bulk get.
+            num_threads (int): The number of batches fetched concurrently.
+
+        Returns:
+            Prefetcher: An iterable over (key, data) pairs.
+        """
+        def fetch_multiple(batch):
+            return self.get(batch, **kwargs)
+        return Prefetcher(fetch_multiple, keys,
+                          window=window,
+                          max_bytes=max_bytes,
+                          batch_size=batch_size,
+                          num_threads=num_threads)
+
+    def get_transformed(self, keys, transform, num_processes=None, chunk_size=64, mp_context=None, **kwargs):
+        """Retrieves data for multiple keys and applies a CPU-bound transform (e.g., decoding) in a process pool.
+
+        Fetching runs on threads as in stash.get(keys), while the transform runs in worker processes so that it
+        is not serialized by the GIL. Data with a local copy (the root directory of a file system stash or the
+        local disk cache of an S3 stash) is read by the workers directly from the file; other data is handed
+        over through shared memory instead of being pickled.
+        By default, the workers are started with the "forkserver" (or "spawn") method so that no S3 client
+        or lock is inherited by a forked process.
+
+        Args:
+            keys (list of strings): The keys to retrieve.
+            transform (callable): A picklable function (e.g., defined at module level) that maps bytes to a result.
+            num_processes (int, optional): The number of worker processes (default: number of CPUs).
+            chunk_size (int): The number of keys fetched at a time while earlier keys are being transformed.
+            mp_context (multiprocessing context, optional): Overrides the start method for the worker processes.
+
+        Returns:
+            dictionary from string to object: The transformed data for each key.
+        """
+        callback = kwargs.pop('callback', None)
+        def fetch_local_paths(chunk):
+            if self.content_store is not None:
+                return {}
+            plain_keys = [key for key in chunk if self.resolve_packed_key(key) is None
+                          and (self.write_behind is None or self.write_behind.get_pending(key) is None)]
+            return self.adapter.get_local_paths(plain_keys, **kwargs)
+        def fetch_data(chunk):
+            return self.get(chunk, **kwargs)
+        return get_multiple_transformed(keys, transform,
+                                        fetch_local_paths=fetch_local_paths,
+                                        fetch_data=fetch_data,
+                                        num_processes=num_processes,
+                                        chunk_size=chunk_size,
+                                        mp_context=mp_context,
+                                        callback=callback)
+
+    # TODO: add a version that supports multiple keys? 
+    def download_file(self, key, filename=None, **kwargs):
+        """Downloads the data corresponding to one or multiple keys into local files.
+
+        For instance, stash.download_file(key, filename) and stash.download_file({key1: filename1, key2: filename2})
+        both work. Multiple keys are downloaded in parallel.
+
+        Args:
+            key (string or dictionary from string to filename): Either a single key or a dictionary mapping keys
+                    to target filenames.
+            filename (string or pathlib.Path, optional): The target filename if key is a single key.
+            link_mode (string, optional): How the target is created from a local copy (the S3 disk cache or the
+                    file of the file system back-end): 'copy' (default), 'hardlink', 'reflink' or 'symlink'.
+                    Links avoid copying the data. Hard and symbolic links share the file with the local copy,
+                    which is therefore made read-only; a symbolic link breaks when the cached copy is evicted.
+                    Falls back to a copy if the file system does not support the link.
+
+        Raises:
+            ValueError: If the arguments passed in do not match the format above.
+
+        Returns:
+            For multiple keys, a dictionary mapping the keys that failed to their exceptions (empty unless
+                on_error="collect", see get). Otherwise, the function does not return values.
         """        
-        return self.adapter.download_file(key, filename, **kwargs)
+        self.flush_write_behind()
+        if type(key) is str:
+            assert filename is not None, 'Must supply a filename if a single key is downloaded.'
+            if self.content_store is not None:
+                key = self.content_store.resolve_keys([key])[key]
+            return self.adapter.download_file(key, filename, **kwargs)
+        elif type(key) is dict:
+            if self.content_store is not None:
+                return self.download_resolved(key, **kwargs)
+            return self.adapter.download_multiple(key, **kwargs)
+        else:
+            raise ValueError(f'Unknown data type for key: {type(key)}. Must be string or dict.')
+
+    def download_resolved(self, filenames, **kwargs):
+        # Downloads the blobs of content-addressed keys. Keys sharing a blob go into separate rounds, because
+        # download_multiple takes one target per key.
+        sources = self.content_store.resolve_keys(filenames.keys())
+        rounds = []
+        for key, filename in filenames.items():
+            for cur_round in rounds:
+                if sources[key] not in cur_round:
+                    break
+            else:
+                cur_round = {}
+                rounds.append(cur_round)
+            cur_round[sources[key]] = (key, filename)
+        errors = {}
+        for cur_round in rounds:
+            round_errors = self.adapter.download_multiple({source: filename for source, (_, filename)
+                                                           in cur_round.items()}, **kwargs)
+            for source, exc in (round_errors or {}).items():
+                errors[cur_round[source][0]] = exc
+        return errors
     
+    def copy(self, src, dst=None, **kwargs):
+        """Copies one or multiple keys inside the stash without transferring the data to the client.
+
+        For instance, stash.copy(src, dst) and stash.copy({src1: dst1, src2: dst2}) both work.
+        The S3 back-end uses server-side copies (multipart copies for large objects), the file system
+        back-end uses hardlinks or reflinks. Multiple keys are copied in parallel.
+
+        Args:
+            src (string or dictionary from string to string): Either a single source key or a dictionary
+                    mapping source keys to destination keys.
+            dst (string, optional): The destination key if src is a single key.
+
+        Raises:
+            ValueError: If the arguments passed in do not match the format above.
+
+        Returns:
+            For multiple keys, a dictionary mapping the keys that failed to their exceptions (empty unless
+                on_error="collect", see get). Otherwise, the function does not return values.
+        """
+        self.flush_write_behind()
+        if type(src) is str:
+            assert dst is not None, 'Must supply a destination key if a single key is copied.'
+            return self.adapter.copy(src, dst, **kwargs)
+        elif type(src) is dict:
+            return self.adapter.copy_multiple(src, **kwargs)
+        else:
+            raise ValueError(f'Unknown data type for src: {type(src)}. Must be string or dict.')
+
+    def move(self, src, dst=None, **kwargs):
+        """Moves (renames) one or multiple keys inside the stash without transferring the data to the client.
+
+        Accepts the same arguments as copy. On S3, a move is a server-side copy followed by a delete of
+        the source key. On the file system, it is a rename.
+
+        Raises:
+            ValueError: If the arguments passed in do not match the format of copy.
+
+        Returns:
+            For multiple keys, a dictionary mapping the keys that failed to their exceptions (empty unless
+                on_error="collect", see get). Otherwise, the function does not return values.
+        """
+        self.flush_write_behind()
+        if type(src) is str:
+            assert dst is not None, 'Must supply a destination key if a single key is moved.'
+            return self.adapter.move(src, dst, **kwargs)
+        elif type(src) is dict:
+            return self.adapter.move_multiple(src, **kwargs)
+        else:
+            raise ValueError(f'Unknown data type for src: {type(src)}. Must be string or dict.')
+
+    def copy_prefix(self, src_prefix, dst_prefix, **kwargs):
+        """Copies every key under a prefix, e.g., to promote a model version or to snapshot an output directory.
+
+        The key src_prefix + suffix is copied to dst_prefix + suffix, including keys in nested "directories".
+
+        Args:
+            src_prefix (string): The prefix of the keys to copy.
+            dst_prefix (string): The prefix that replaces src_prefix in the destination keys.
+
+        Returns:
+            int: The number of keys copied.
+        """
+        self.flush_write_behind()
+        return self.adapter.copy_prefix(src_prefix, dst_prefix, **kwargs)
+
     def delete(self, key, **kwargs):
         """Deletes one or multiple keys from the stash.
         
@@ -153,8 +878,10 @@ class ObjectStash:
             ValueError: If the arguments passed in do not match the format above.
 
         Returns:
-            The function does not return values.
+            For multiple keys, a dictionary mapping the keys that failed to their exceptions (empty unless
+                on_error="collect", see get). Otherwise, the function does not return values.
         """        
+        self.flush_write_behind()
         if type(key) is str:
             return self.adapter.delete(key, **kwargs)
         elif type(key) is list:
@@ -0,0 +1,106 @@
+import struct
+
+
+# A packed shard stored under a prefix consists of two objects:
+#   <prefix>.pack  the data of all members, back to back
+#   <prefix>.idx   the index, mapping each member key to its offset and length in the data object
+# A member "name" of the shard is addressed in the stash as "<prefix>/name".
+PACK_DATA_SUFFIX = '.pack'
+PACK_INDEX_SUFFIX = '.idx'
+
+INDEX_MAGIC = b'OSPIDX1\n'
+INDEX_COUNT_FORMAT = '<Q'
+INDEX_ENTRY_FORMAT = '<HQQ'
+
+
+def pack_data_key(prefix):
+    return prefix + PACK_DATA_SUFFIX
+
+
+def pack_index_key(prefix):
+    return prefix + PACK_INDEX_SUFFIX
+
+
+class PackIndex:
+    """The offsets and lengths of the members of one packed shard."""
+    def __init__(self, entries=None):
+        # Maps member name to (offset, length)
+        self.entries = {} if entries is None else entries
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, name):
+        return self.entries[name]
+
+    def encode(self):
+        parts = [INDEX_MAGIC, struct.pack(INDEX_COUNT_FORMAT, len(self.entries))]
+        for name in sorted(self.entries.keys()):
+            offset, length = self.entries[name]
+            name_bytes = name.encode('utf-8')
+            parts.append(struct.pack(INDEX_ENTRY_FORMAT, len(name_bytes), offset, length))
+            parts.append(name_bytes)
+        return b''.join(parts)
+
+    @classmethod
+    def decode(cls, data):
+        view = memoryview(data)
+        if bytes(view[:len(INDEX_MAGIC)]) != INDEX_MAGIC:
+            raise ValueError('Data is not a pack index.')
+        pos = len(INDEX_MAGIC)
+        count, = struct.unpack_from(INDEX_COUNT_FORMAT, view, pos)
+        pos += struct.calcsize(INDEX_COUNT_FORMAT)
+        entry_size = struct.calcsize(INDEX_ENTRY_FORMAT)
+        entries = {}
+        for _ in range(count):
+            name_length, offset, length = struct.unpack_from(INDEX_ENTRY_FORMAT, view, pos)
+            pos += entry_size
+            entries[bytes(view[pos:pos + name_length]).decode('utf-8')] = (offset, length)
+            pos += name_length
+        return cls(entries)
+
+
+def build_pack(data_dict):
+    """Lays out the members of a packed shard.
+
+    Returns:
+        tuple (frames, index): The member data in storage order (to be written back to back) and the PackIndex.
+    """
+    frames = []
+    entries = {}
+    offset = 0
+    for name, data in data_dict.items():
+        assert len(name) > 0, 'Member names must be non-empty'
+        length = memoryview(data).nbytes
+        entries[name] = (offset, length)
+        frames.append(data)
+        offset += length
+    return frames, PackIndex(entries)
+
+
+def coalesce_ranges(ranges, max_gap=0):
+    """Merges byte ranges in the same object that are adjacent or separated by at most max_gap bytes.
+
+    Args:
+        ranges (list of (start, length) tuples): The requested ranges.
+        max_gap (int): The largest number of unrequested bytes that may be read to merge two ranges.
+
+    Returns:
+        list of (start, length, members): The merged ranges, where members lists the indices of the
+            requested ranges contained in each merged range.
+    """
+    order = sorted(range(len(ranges)), key=lambda ii: ranges[ii][0])
+    merged = []
+    for ii in order:
+        start, length = ranges[ii]
+        if merged and start <= merged[-1][0] + merged[-1][1] + max_gap:
+            cur_start, cur_length, members = merged[-1]
+            new_end = max(cur_start + cur_length, start + length)
+            merged[-1] = (cur_start, new_end - cur_start, members)
+            members.append(ii)
+        else:
+            merged.append((start, length, [ii]))
+    return merged
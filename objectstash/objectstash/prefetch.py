@@ -0,0 +1,132 @@
+import collections
+import concurrent.futures
+from timeit import default_timer as timer
+
+
+class Prefetcher:
+    """Iterates over the data for a known sequence of keys while fetching ahead of the consumer.
+
+    Keys are fetched in batches on a background thread pool; each batch is fetched with one bulk get, so
+    back-ends with a parallel get_multiple (e.g., S3) download the keys of a batch concurrently.
+    The iterator yields (key, data) pairs in the requested order.
+
+    The number of keys fetched ahead (the window) adapts to the consumer: it doubles whenever the consumer
+    has to wait for data (a stall), and shrinks slowly while the consumer never waits. If max_bytes is set,
+    no new batches are started while the fetched data waiting to be consumed plus the expected size of the
+    batches in flight (from the average size of the keys fetched so far) exceeds max_bytes. Until the first
+    batch arrived, only one batch is in flight.
+
+    A Prefetcher is single-pass: it can be iterated over only once.
+
+    The attributes stall_time (seconds the consumer spent waiting), num_stalls and window can be used to
+    check whether a job is I/O-bound.
+    """
+    def __init__(self, fetch_multiple, keys, window=16, max_bytes=None, batch_size=8, num_threads=4,
+                 min_window=1, max_window=1024, adaptive=True):
+        assert window >= 1
+        assert batch_size >= 1
+        self.fetch_multiple = fetch_multiple
+        self.keys = list(keys)
+        self.window = window
+        self.min_window = min(min_window, window)
+        self.max_window = max(max_window, window)
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.adaptive = adaptive
+        self.stall_time = 0.0
+        self.num_stalls = 0
+        self.num_yielded = 0
+        self.executor = None
+        # Batches that have been submitted but not fully consumed, in order: (keys, future)
+        self.pending = collections.deque()
+        self.next_index = 0
+        self.num_ahead = 0
+        self.calm_streak = 0
+        self.started = False
+        # Totals over the received batches, for the expected size of the batches in flight
+        self.num_fetched_keys = 0
+        self.num_fetched_bytes = 0
+
+    def expected_bytes(self):
+        # The bytes of the received batches plus the expected bytes of the batches in flight, or None if no
+        # batch was received yet
+        total = 0
+        num_in_flight = 0
+        for batch, future in self.pending:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                total += sum(memoryview(x).nbytes for x in future.result().values())
+            else:
+                num_in_flight += len(batch)
+        if num_in_flight > 0:
+            if self.num_fetched_keys == 0:
+                return None
+            total += num_in_flight * self.num_fetched_bytes / self.num_fetched_keys
+        return total
+
+    def submit_batches(self):
+        while self.next_index < len(self.keys) and self.num_ahead < self.window:
+            if self.max_bytes is not None and self.pending:
+                expected = self.expected_bytes()
+                if expected is None or expected >= self.max_bytes:
+                    break
+            batch_size = min(self.batch_size, self.window - self.num_ahead, len(self.keys) - self.next_index)
+            batch = self.keys[self.next_index:self.next_index + batch_size]
+            self.pending.append((batch, self.executor.submit(self.fetch_multiple, list(dict.fromkeys(batch)))))
+            self.next_index += batch_size
+            self.num_ahead += batch_size
+
+    def adapt_window(self, stalled, num_keys):
+        # The first batch always stalls because nothing was fetched ahead yet
+        if not self.adaptive or self.num_yielded == 0:
+            return
+        if stalled:
+            self.window = min(self.max_window, 2 * self.window)
+            self.calm_streak = 0
+        else:
+            self.calm_streak += num_keys
+            if self.calm_streak >= 2 * self.window:
+                self.window = max(self.min_window, self.window - max(1, self.window // 4))
+                self.calm_streak = 0
+
+    def __iter__(self):
+        if self.started:
+            raise RuntimeError('A Prefetcher can only be iterated over once.')
+        self.started = True
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads)
+        try:
+            self.submit_batches()
+            while self.pending:
+                batch, future = self.pending[0]
+                stalled = not future.done()
+                if stalled:
+                    wait_start = timer()
+                    concurrent.futures.wait([future])
+                    self.stall_time += timer() - wait_start
+                    self.num_stalls += 1
+                result = future.result()
+                self.pending.popleft()
+                self.num_ahead -= len(batch)
+                self.num_fetched_keys += len(result)
+                self.num_fetched_bytes += sum(memoryview(x).nbytes for x in result.values())
+                self.adapt_window(stalled, len(batch))
+                self.submit_batches()
+                for key in batch:
+                    self.num_yielded += 1
+                    yield key, result[key]
+        finally:
+            self.close()
+
+    def close(self):
+        for _, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def stats(self):
+        return {'stall_time': self.stall_time,
+                'num_stalls': self.num_stalls,
+                'num_yielded': self.num_yielded,
+                'window': self.window}
@@ -0,0 +1,152 @@
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+
+def default_mp_context():
+    # Forking a process while other threads hold locks (e.g., inside boto3 or the fetch thread pool) is not
+    # safe, so we start the workers from a fresh interpreter instead.
+    methods = multiprocessing.get_all_start_methods()
+    if 'forkserver' in methods:
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def transform_file(transform, filepath):
+    with open(filepath, 'rb') as f:
+        return transform(f.read())
+
+
+def transform_shared_memory(transform, name, size):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        data = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    return transform(data)
+
+
+class SharedMemoryPayload:
+    # Holds the data for one key in a shared memory block until the worker is done with it
+    def __init__(self, data):
+        self.size = len(data)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, self.size))
+        self.shm.buf[:self.size] = data
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def get_multiple_transformed(keys, transform, *,
+                             fetch_local_paths,
+                             fetch_data,
+                             num_processes=None,
+                             chunk_size=64,
+                             mp_context=None,
+                             use_shared_memory=True,
+                             callback=None):
+    """Fetches keys on threads and applies a transform to the data of each key in a process pool.
+
+    Fetching runs chunk by chunk on a background thread so that downloading the next chunk overlaps with
+    transforming the current one. Keys that have a local copy (FSAdapter files or the S3 disk cache) are passed
+    to the workers by path; other data is passed through shared memory so that large payloads are not pickled.
+    At most 2 * num_processes chunks are fetched or transformed at a time, and the shared memory of a key is
+    released as soon as its result arrives, so memory use does not grow with the number of keys.
+
+    Args:
+        keys (list of strings): The keys to fetch.
+        transform (callable): A picklable function (e.g., defined at module level) mapping bytes to a result.
+        fetch_local_paths (callable): Maps a list of keys to a dictionary from keys to local paths (or None).
+        fetch_data (callable): Maps a list of keys to a dictionary from keys to bytes.
+
+    Returns:
+        dictionary from string to result: The transformed data for each key.
+    """
+    keys = list(dict.fromkeys(keys))
+    if mp_context is None:
+        mp_context = default_mp_context()
+    if num_processes is None:
+        num_processes = os.cpu_count() or 1
+    use_shared_memory = use_shared_memory and shared_memory is not None
+    max_chunks_in_flight = 2 * num_processes
+
+    def fetch_chunk(chunk):
+        paths = fetch_local_paths(chunk)
+        missing = [key for key in chunk if paths.get(key) is None]
+        data = fetch_data(missing) if missing else {}
+        return paths, data
+
+    chunks = [keys[ii:ii + chunk_size] for ii in range(0, len(keys), chunk_size)]
+    result = {}
+    payloads = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as fetch_executor, \
+         concurrent.futures.ProcessPoolExecutor(max_workers=num_processes, mp_context=mp_context) as executor:
+        # Fetches in chunk order, and the number of keys of each chunk whose result is still missing
+        fetch_futures = collections.deque()
+        remaining = {}
+        future_to_key = {}
+        key_to_chunk = {}
+        next_chunk = 0
+
+        def submit_fetches():
+            nonlocal next_chunk
+            while next_chunk < len(chunks) and len(remaining) < max_chunks_in_flight:
+                fetch_futures.append((next_chunk, fetch_executor.submit(fetch_chunk, chunks[next_chunk])))
+                remaining[next_chunk] = len(chunks[next_chunk])
+                next_chunk += 1
+
+        def submit_transforms(chunk_index, paths, data):
+            for key in chunks[chunk_index]:
+                if paths.get(key) is not None:
+                    future = executor.submit(transform_file, transform, str(paths[key]))
+                elif use_shared_memory:
+                    payloads[key] = SharedMemoryPayload(data.pop(key))
+                    future = executor.submit(transform_shared_memory, transform,
+                                             payloads[key].shm.name, payloads[key].size)
+                else:
+                    future = executor.submit(transform, data.pop(key))
+                future_to_key[future] = key
+                key_to_chunk[key] = chunk_index
+
+        try:
+            submit_fetches()
+            while fetch_futures or future_to_key:
+                waiting = set(future_to_key.keys())
+                if fetch_futures:
+                    waiting.add(fetch_futures[0][1])
+                done, _ = concurrent.futures.wait(waiting, return_when=concurrent.futures.FIRST_COMPLETED)
+                while fetch_futures and fetch_futures[0][1].done():
+                    chunk_index, fetch_future = fetch_futures.popleft()
+                    submit_transforms(chunk_index, *fetch_future.result())
+                for future in done:
+                    key = future_to_key.pop(future, None)
+                    if key is None:
+                        continue
+                    if key in payloads:
+                        payloads.pop(key).release()
+                    # A failed transform raises here; the finally block cancels the other keys
+                    result[key] = future.result()
+                    if callback:
+                        callback(1)
+                    chunk_index = key_to_chunk.pop(key)
+                    remaining[chunk_index] -= 1
+                    if remaining[chunk_index] == 0:
+                        del remaining[chunk_index]
+                submit_fetches()
+        finally:
+            for _, future in fetch_futures:
+                future.cancel()
+            for future in future_to_key:
+                future.cancel()
+            executor.shutdown(wait=True)
+            for payload in payloads.values():
+                payload.release()
+    return result
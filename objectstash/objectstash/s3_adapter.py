@@ -1,24 +1,30 @@
 import concurrent.futures
 import datetime
 import math
+import os
 import pathlib
-import shutil
 import threading
 import time
-from timeit import default_timer as timer
 import io
 
 import boto3
 import botocore
 from botocore.client import Config
 
+from .bulk import BulkResult, DeadlineExceeded, backoff_sleep, deadline_from_timeout, run_bulk
+from .frames import FramesReader, frames_nbytes, readinto_exact
+from .local_files import link_file
+from .metrics import Metrics, maybe_timed, record_retry
+from .tracing import submit_traced
 from .storage_adapter import StorageAdapter
+from .streaming import iter_parts
 
 
-def key_exists(client, bucket, key):
+def key_exists(client, bucket, key, metrics=None):
     # Return true if a key exists in s3 bucket
     try:
-        client.head_object(Bucket=bucket, Key=key)
+        with maybe_timed(metrics, 'head', key=key):
+            client.head_object(Bucket=bucket, Key=key)
         return True
     except botocore.exceptions.ClientError as exc:
         if exc.response['Error']['Code'] != '404':
@@ -28,6 +34,16 @@ def key_exists(client, bucket, key):
         raise
 
 
+def evict_cached_key(cache_root_path, key, verbose=False, metrics=None):
+    local_filepath = pathlib.Path(cache_root_path).resolve() / key
+    if local_filepath.is_file():
+        local_filepath.unlink()
+        if metrics is not None:
+            metrics.increment('cache_evictions')
+        if verbose:
+            print(f'Removed local cache file {local_filepath}')
+
+
 def delete_key(client,
                bucket,
                key,
@@ -36,20 +52,17 @@ def delete_key(client,
                verbose=False,
                num_tries=5,
                initial_delay=1.0,
-               delay_factor=math.sqrt(2.0)):
+               delay_factor=math.sqrt(2.0),
+               metrics=None):
     if cache_on_local_disk:
         assert cache_root_path is not None
-        cache_root_path = pathlib.Path(cache_root_path).resolve()
-        local_filepath = cache_root_path / key
-        if local_filepath.is_file():
-            local_filepath.unlink()
-            if verbose:
-                print(f'Removed local cache file {local_filepath}')
+        evict_cached_key(cache_root_path, key, verbose=verbose, metrics=metrics)
     delay = initial_delay
     num_tries_left = num_tries
     while num_tries_left >= 1:
         try:
-            client.delete_object(Key=key, Bucket=bucket)
+            with maybe_timed(metrics, 'delete', key=key, attempt=num_tries - num_tries_left + 1):
+                client.delete_object(Key=key, Bucket=bucket)
             if verbose:
                 print(f'Deleted key {key}')
             return
@@ -57,10 +70,181 @@ def delete_key(client,
             if num_tries_left == 1:
                 raise Exception(f'delete backoff failed for key "{key}" at final delay {delay}')
             else:
-                time.sleep(delay)
+                record_retry(metrics, delay)
+                backoff_sleep(delay)
                 delay *= delay_factor
                 num_tries_left -= 1
-    
+
+
+def delete_s3_objects_parallel(keys, *,
+                               client_generator,
+                               bucket,
+                               cache_on_local_disk=True,
+                               cache_root_path=None,
+                               verbose=False,
+                               max_num_threads=90,
+                               num_tries=5,
+                               initial_delay=1.0,
+                               delay_factor=math.sqrt(2.0),
+                               on_error='fail_fast',
+                               deadline=None,
+                               metrics=None):
+    # Returns {key: exception} for the keys that failed (only with on_error='collect', see run_bulk)
+    tl = threading.local()
+    def cur_delete(key):
+        if not hasattr(tl, 'get_object_client'):
+            tl.get_object_client = client_generator()
+        delete_key(tl.get_object_client, bucket, key,
+                   cache_on_local_disk=cache_on_local_disk,
+                   cache_root_path=cache_root_path,
+                   verbose=verbose,
+                   num_tries=num_tries,
+                   initial_delay=initial_delay,
+                   delay_factor=delay_factor,
+                   metrics=metrics)
+    return run_bulk(cur_delete, list(keys),
+                    max_num_threads=max_num_threads,
+                    on_error=on_error,
+                    deadline=deadline).errors
+
+
+def sync_s3_cache(keys, *,
+                  client,
+                  client_generator,
+                  bucket,
+                  cache_root_path,
+                  verbose=False,
+                  special_verbose=True,
+                  max_num_threads=90,
+                  num_tries=5,
+                  initial_delay=1.0,
+                  delay_factor=math.sqrt(2.0),
+                  download_callback=None,
+                  skip_modification_time_check=False,
+                  freshness_ttl=0.0,
+                  listing_density=None,
+                  on_error='fail_fast',
+                  deadline=None,
+                  metrics=None):
+    # Makes sure that the local disk cache contains an up-to-date copy of each key.
+    # Local copies that were downloaded or validated less than freshness_ttl seconds ago are used without a check.
+    # Passing a listing_density dictionary (shared across calls) enables revalidation by listing, see
+    # get_s3_object_metadata_bulk.
+    # Returns {key: exception} for the keys that failed (only with on_error='collect', see run_bulk).
+    if client is None:
+        assert client_generator is not None
+    else:
+        assert client_generator is None
+        assert max_num_threads <= 1
+    assert cache_root_path is not None
+    cache_root_path = pathlib.Path(cache_root_path).resolve()
+
+    missing_keys = []
+    existing_keys = []
+    for key in keys:
+        local_filepath = cache_root_path / key
+        if not local_filepath.is_file():
+            missing_keys.append(key)
+            local_filepath.parent.mkdir(parents=True, exist_ok=True)
+        else:
+            existing_keys.append(key)
+
+    keys_to_download = missing_keys.copy()
+    errors = {}
+    if metrics is not None:
+        metrics.increment('cache_misses', len(missing_keys))
+    if skip_modification_time_check:
+        if verbose:
+            print(f'Skipping the file modification time check for {len(existing_keys)} keys that have local copies.')
+        if metrics is not None:
+            metrics.increment('cache_hits', len(existing_keys))
+        for key in existing_keys:
+            if download_callback:
+                download_callback(1)
+    else:
+        fresh_keys = []
+        if freshness_ttl > 0:
+            now = time.time()
+            unchecked_keys = []
+            for key in existing_keys:
+                if now - (cache_root_path / key).stat().st_mtime < freshness_ttl:
+                    fresh_keys.append(key)
+                else:
+                    unchecked_keys.append(key)
+            existing_keys = unchecked_keys
+            if metrics is not None:
+                metrics.increment('cache_hits', len(fresh_keys))
+                metrics.increment('cache_fresh', len(fresh_keys))
+            if download_callback:
+                for key in fresh_keys:
+                    download_callback(1)
+        if verbose:
+            print(f'Getting metadata for {len(existing_keys)} keys that have local copies.')
+        metadata = get_s3_object_metadata_bulk(existing_keys,
+                                               client=client,
+                                               client_generator=client_generator,
+                                               bucket=bucket,
+                                               max_num_threads=max_num_threads,
+                                               num_tries=num_tries,
+                                               initial_delay=initial_delay,
+                                               delay_factor=delay_factor,
+                                               listing_density=listing_density,
+                                               on_error=on_error,
+                                               deadline=deadline,
+                                               metrics=metrics)
+        errors.update(metadata.errors)
+        for key in existing_keys:
+            if key in errors:
+                continue
+            local_filepath = cache_root_path / key
+            local_stat = local_filepath.stat()
+            local_time = datetime.datetime.fromtimestamp(local_stat.st_mtime, datetime.timezone.utc)
+            # Keys missing from a listing were deleted remotely, the download reports the error
+            remote = metadata.get(key)
+            # Two second time buffer because S3 modification times are truncated to seconds
+            if (remote is None or (remote['LastModified'] - local_time).total_seconds() >= -2
+                    or remote['Size'] != local_stat.st_size):
+                if verbose:
+                    print(f'Local copy of key "{key}" is outdated')
+                if metrics is not None:
+                    metrics.increment('cache_misses')
+                    metrics.increment('cache_stale')
+                keys_to_download.append(key)
+            else:
+                if freshness_ttl > 0:
+                    # The modification time records when the local copy was last known to be current
+                    os.utime(local_filepath)
+                if metrics is not None:
+                    metrics.increment('cache_hits')
+                if download_callback:
+                    download_callback(1)
+
+    tl = threading.local()
+    def cur_download_file(key):
+        local_filepath = cache_root_path / key
+        if verbose or special_verbose:
+            print('{} not available locally or outdated, downloading from S3 ... '.format(key))
+        download_s3_file_with_backoff(key,
+                                      str(local_filepath),
+                                      client=client,
+                                      client_generator=client_generator,
+                                      bucket=bucket,
+                                      num_tries=num_tries,
+                                      initial_delay=initial_delay,
+                                      delay_factor=delay_factor,
+                                      thread_local=tl,
+                                      metrics=metrics)
+        if not local_filepath.is_file():
+            raise IOError(f'Downloading {key} did not create {local_filepath}')
+
+    downloads = run_bulk(cur_download_file, keys_to_download,
+                         max_num_threads=max_num_threads,
+                         on_error=on_error,
+                         deadline=deadline,
+                         callback=download_callback)
+    errors.update(downloads.errors)
+    return errors
+
 
 def get_s3_object_bytes_parallel(keys, *,
                                  client,
@@ -75,7 +259,13 @@ def get_s3_object_bytes_parallel(keys, *,
                                  initial_delay=1.0,
                                  delay_factor=math.sqrt(2.0),
                                  download_callback=None,
-                                 skip_modification_time_check=False):
+                                 skip_modification_time_check=False,
+                                 freshness_ttl=0.0,
+                                 listing_density=None,
+                                 on_error='fail_fast',
+                                 deadline=None,
+                                 metrics=None):
+    # Returns a BulkResult mapping keys to their data (see run_bulk for on_error and deadline)
     if client is None:
         assert client_generator is not None
     else:
@@ -84,92 +274,30 @@ def get_s3_object_bytes_parallel(keys, *,
     if cache_on_local_disk:
         assert cache_root_path is not None
         cache_root_path = pathlib.Path(cache_root_path).resolve()
+        errors = sync_s3_cache(keys,
+                               client=client,
+                               client_generator=client_generator,
+                               bucket=bucket,
+                               cache_root_path=cache_root_path,
+                               verbose=verbose,
+                               special_verbose=special_verbose,
+                               max_num_threads=max_num_threads,
+                               num_tries=num_tries,
+                               initial_delay=initial_delay,
+                               delay_factor=delay_factor,
+                               download_callback=download_callback,
+                               skip_modification_time_check=skip_modification_time_check,
+                               freshness_ttl=freshness_ttl,
+                               listing_density=listing_density,
+                               on_error=on_error,
+                               deadline=deadline,
+                               metrics=metrics)
 
-        missing_keys = []
-        existing_keys = []
-        for key in keys:
-            local_filepath = cache_root_path / key
-            if not local_filepath.is_file():
-                missing_keys.append(key)
-                local_filepath.parent.mkdir(parents=True, exist_ok=True)
-            else:
-                existing_keys.append(key)
-
-        keys_to_download = missing_keys.copy()
-        if skip_modification_time_check:
-            if verbose:
-                print(f'Skipping the file modification time check for {len(existing_keys)} keys that have local copies.')
-            for key in existing_keys:
-                if download_callback:
-                    download_callback(1)
-        else:
-            if verbose:
-                print(f'Getting metadata for {len(existing_keys)} keys that have local copies ... ', end='')
-            metadata_start = timer()
-            metadata = get_s3_object_metadata_parallel(existing_keys,
-                                                       client=client,
-                                                       client_generator=client_generator,
-                                                       bucket=bucket,
-                                                       verbose=False,
-                                                       max_num_threads=max_num_threads,
-                                                       num_tries=num_tries,
-                                                       initial_delay=initial_delay,
-                                                       delay_factor=delay_factor,
-                                                       download_callback=None)
-            metadata_end = timer()
-            if verbose:
-                print(f'took {metadata_end - metadata_start:.3f} seconds')
-            for key in existing_keys:
-                local_filepath = cache_root_path / key
-                assert local_filepath.is_file
-                local_time = datetime.datetime.fromtimestamp(local_filepath.stat().st_mtime,
-                                                             datetime.timezone.utc)
-                remote_time = metadata[key]['LastModified']
-                # Two second time buffer because S3 modification times are truncated to seconds
-                if (remote_time - local_time).total_seconds() >= -2:
-                    if verbose:
-                        print(f'Local copy of key "{key}" is outdated')
-                    keys_to_download.append(key)
-                elif download_callback:
-                    download_callback(1)
-
-        tl = threading.local()
-        def cur_download_file(key):
-            local_filepath = cache_root_path / key
-            if verbose or special_verbose:
-                print('{} not available locally or outdated, downloading from S3 ... '.format(key))
-            download_s3_file_with_backoff(key,
-                                          str(local_filepath),
-                                          client=client,
-                                          client_generator=client_generator,
-                                          bucket=bucket,
-                                          num_tries=num_tries,
-                                          initial_delay=initial_delay,
-                                          delay_factor=delay_factor,
-                                          thread_local=tl)
-            return local_filepath.is_file()
-
-        if len(keys_to_download) > 0:
-            download_start = timer()
-            with concurrent.futures.ThreadPoolExecutor(max_workers=max_num_threads) as executor:
-                future_to_key = {executor.submit(cur_download_file, key): key for key in keys_to_download}
-                for future in concurrent.futures.as_completed(future_to_key):
-                    key = future_to_key[future]
-                    try:
-                        success = future.result()
-                        assert success
-                        if download_callback:
-                            download_callback(1)
-                    except Exception as exc:
-                        print('Key {} generated an exception: {}'.format(key, exc))
-                        raise exc
-            download_end = timer()
-            if verbose:
-                print('Downloading took {:.3f} seconds'.format(download_end - download_start))
-
-        result = {}
+        result = BulkResult(errors=errors)
         # TODO: parallelize this as well?
         for key in keys:
+            if key in errors:
+                continue
             local_filepath = cache_root_path / key
             if verbose:
                 print('Reading from local file {} ... '.format(local_filepath), end='')
@@ -189,23 +317,13 @@ def get_s3_object_bytes_parallel(keys, *,
                                                     num_tries=num_tries,
                                                     initial_delay=initial_delay,
                                                     delay_factor=delay_factor,
-                                                    thread_local=tl)
-        download_start = timer()
-        result = {}
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_num_threads) as executor:
-            future_to_key = {executor.submit(cur_get_object_bytes, key): key for key in keys}
-            for future in concurrent.futures.as_completed(future_to_key):
-                key = future_to_key[future]
-                try:
-                    result[key] = future.result()
-                    if download_callback:
-                        download_callback(1)
-                except Exception as exc:
-                    print('Key {} generated an exception: {}'.format(key, exc))
-                    raise exc
-        download_end = timer()
-        if verbose:
-            print('Getting object bytes took {} seconds'.format(download_end - download_start))
+                                                    thread_local=tl,
+                                                    metrics=metrics)
+        result = run_bulk(cur_get_object_bytes, keys,
+                          max_num_threads=max_num_threads,
+                          on_error=on_error,
+                          deadline=deadline,
+                          callback=download_callback)
     return result
 
 
@@ -216,7 +334,8 @@ def get_s3_object_bytes_with_backoff(key, *,
                                      num_tries=5,
                                      initial_delay=1.0,
                                      delay_factor=math.sqrt(2.0),
-                                     thread_local=None):
+                                     thread_local=None,
+                                     metrics=None):
     if client is None:
         if thread_local is None:
             client = client_generator()
@@ -229,17 +348,257 @@ def get_s3_object_bytes_with_backoff(key, *,
 
     while num_tries_left >= 1:
         try:
-            read_bytes = client.get_object(Key=key, Bucket=bucket)["Body"].read()
+            with maybe_timed(metrics, 'get', key=key, attempt=num_tries - num_tries_left + 1) as transfer:
+                read_bytes = client.get_object(Key=key, Bucket=bucket)["Body"].read()
+                transfer['bytes_in'] = len(read_bytes)
             return read_bytes
         except:
             if num_tries_left == 1:
                 raise Exception('get backoff failed ' + key + ' ' + str(delay))
             else:
-                time.sleep(delay)
+                record_retry(metrics, delay)
+                backoff_sleep(delay)
+                delay *= delay_factor
+                num_tries_left -= 1
+
+
+def get_s3_object_into_with_backoff(key, buffer, *,
+                                    client,
+                                    client_generator,
+                                    bucket,
+                                    num_tries=5,
+                                    initial_delay=1.0,
+                                    delay_factor=math.sqrt(2.0),
+                                    thread_local=None,
+                                    metrics=None):
+    # Streams the object into the buffer without an intermediate bytes object, returns the number of bytes
+    if client is None:
+        if thread_local is None:
+            client = client_generator()
+        else:
+            if not hasattr(thread_local, 'get_object_client'):
+                thread_local.get_object_client = client_generator()
+            client = thread_local.get_object_client
+    delay = initial_delay
+    num_tries_left = num_tries
+
+    while num_tries_left >= 1:
+        try:
+            with maybe_timed(metrics, 'get', key=key, attempt=num_tries - num_tries_left + 1) as transfer:
+                body = client.get_object(Key=key, Bucket=bucket)["Body"]
+                try:
+                    num_bytes = readinto_exact(body, buffer)
+                finally:
+                    body.close()
+                transfer['bytes_in'] = num_bytes
+            return num_bytes
+        except ValueError:
+            # The buffer is too small, retrying does not help
+            raise
+        except:
+            if num_tries_left == 1:
+                raise Exception('get backoff failed ' + key + ' ' + str(delay))
+            else:
+                record_retry(metrics, delay)
+                backoff_sleep(delay)
+                delay *= delay_factor
+                num_tries_left -= 1
+
+
+def get_s3_objects_into_parallel(buffers, *,
+                                 client,
+                                 client_generator,
+                                 bucket,
+                                 cache_on_local_disk=True,
+                                 cache_root_path=None,
+                                 verbose=False,
+                                 max_num_threads=90,
+                                 num_tries=5,
+                                 initial_delay=1.0,
+                                 delay_factor=math.sqrt(2.0),
+                                 download_callback=None,
+                                 skip_modification_time_check=False,
+                                 freshness_ttl=0.0,
+                                 listing_density=None,
+                                 on_error='fail_fast',
+                                 deadline=None,
+                                 metrics=None):
+    # buffers maps keys to writable buffers, the result (a BulkResult) maps keys to the number of bytes written
+    if client is None:
+        assert client_generator is not None
+    else:
+        assert client_generator is None
+        assert max_num_threads <= 1
+    if cache_on_local_disk:
+        assert cache_root_path is not None
+        cache_root_path = pathlib.Path(cache_root_path).resolve()
+        errors = sync_s3_cache(list(buffers.keys()),
+                               client=client,
+                               client_generator=client_generator,
+                               bucket=bucket,
+                               cache_root_path=cache_root_path,
+                               verbose=verbose,
+                               special_verbose=False,
+                               max_num_threads=max_num_threads,
+                               num_tries=num_tries,
+                               initial_delay=initial_delay,
+                               delay_factor=delay_factor,
+                               download_callback=download_callback,
+                               skip_modification_time_check=skip_modification_time_check,
+                               freshness_ttl=freshness_ttl,
+                               listing_density=listing_density,
+                               on_error=on_error,
+                               deadline=deadline,
+                               metrics=metrics)
+        result = BulkResult(errors=errors)
+        for key, buffer in buffers.items():
+            if key in errors:
+                continue
+            with open(cache_root_path / key, 'rb', buffering=0) as f:
+                result[key] = readinto_exact(f, buffer)
+        return result
+
+    tl = threading.local()
+    def cur_get_object_into(key):
+        if verbose:
+            print('Loading {} from S3 ... '.format(key))
+        return get_s3_object_into_with_backoff(key, buffers[key],
+                                               client=client,
+                                               client_generator=client_generator,
+                                               bucket=bucket,
+                                               num_tries=num_tries,
+                                               initial_delay=initial_delay,
+                                               delay_factor=delay_factor,
+                                               thread_local=tl,
+                                               metrics=metrics)
+    return run_bulk(cur_get_object_into, list(buffers.keys()),
+                    max_num_threads=max_num_threads,
+                    on_error=on_error,
+                    deadline=deadline,
+                    callback=download_callback)
+
+
+def get_s3_object_range_with_backoff(key, start, length, *,
+                                     client,
+                                     client_generator,
+                                     bucket,
+                                     num_tries=5,
+                                     initial_delay=1.0,
+                                     delay_factor=math.sqrt(2.0),
+                                     thread_local=None,
+                                     metrics=None):
+    if length == 0:
+        return b''
+    if client is None:
+        if thread_local is None:
+            client = client_generator()
+        else:
+            if not hasattr(thread_local, 'get_object_client'):
+                thread_local.get_object_client = client_generator()
+            client = thread_local.get_object_client
+    delay = initial_delay
+    num_tries_left = num_tries
+    byte_range = f'bytes={start}-{start + length - 1}'
+
+    while num_tries_left >= 1:
+        try:
+            with maybe_timed(metrics, 'get_range', key=key, attempt=num_tries - num_tries_left + 1) as transfer:
+                read_bytes = client.get_object(Key=key, Bucket=bucket, Range=byte_range)["Body"].read()
+                transfer['bytes_in'] = len(read_bytes)
+            assert len(read_bytes) == length
+            return read_bytes
+        except:
+            if num_tries_left == 1:
+                raise Exception(f'get range backoff failed for key {key} ({byte_range}), last delay {delay}')
+            else:
+                record_retry(metrics, delay)
+                backoff_sleep(delay)
                 delay *= delay_factor
                 num_tries_left -= 1
 
 
+def get_s3_object_ranges_parallel(ranges, *,
+                                  client,
+                                  client_generator,
+                                  bucket,
+                                  cache_on_local_disk=True,
+                                  cache_root_path=None,
+                                  verbose=False,
+                                  max_num_threads=90,
+                                  num_tries=5,
+                                  initial_delay=1.0,
+                                  delay_factor=math.sqrt(2.0),
+                                  skip_modification_time_check=False,
+                                  freshness_ttl=0.0,
+                                  listing_density=None,
+                                  deadline=None,
+                                  metrics=None):
+    # ranges is a list of (key, start, length) tuples, the result is a list of bytes in the same order.
+    # With the local disk cache, ranges of keys that already have a local copy are read from it (after the usual
+    # revalidation); other keys are not downloaded in full (e.g., a large pack file read one member at a time).
+    # A failed range (or the deadline) fails the call right away (on_error='fail_fast', see run_bulk).
+    if client is None:
+        assert client_generator is not None
+    else:
+        assert client_generator is None
+        assert max_num_threads <= 1
+    result = [None] * len(ranges)
+    remote_indices = list(range(len(ranges)))
+    if cache_on_local_disk:
+        assert cache_root_path is not None
+        cache_root_path = pathlib.Path(cache_root_path).resolve()
+        cached_keys = sorted(set(key for key, _, _ in ranges if (cache_root_path / key).is_file()))
+        if cached_keys:
+            sync_s3_cache(cached_keys,
+                          client=client,
+                          client_generator=client_generator,
+                          bucket=bucket,
+                          cache_root_path=cache_root_path,
+                          verbose=verbose,
+                          special_verbose=False,
+                          max_num_threads=max_num_threads,
+                          num_tries=num_tries,
+                          initial_delay=initial_delay,
+                          delay_factor=delay_factor,
+                          skip_modification_time_check=skip_modification_time_check,
+                          freshness_ttl=freshness_ttl,
+                          listing_density=listing_density,
+                          deadline=deadline,
+                          metrics=metrics)
+        cached_keys = set(cached_keys)
+        remote_indices = []
+        for ii, (key, start, length) in enumerate(ranges):
+            if key in cached_keys:
+                with open(cache_root_path / key, 'rb') as f:
+                    f.seek(start)
+                    result[ii] = f.read(length)
+            else:
+                remote_indices.append(ii)
+        if not remote_indices:
+            return result
+
+    tl = threading.local()
+    def cur_get_range(key_range):
+        key, start, length = key_range
+        if verbose:
+            print(f'Loading {length} bytes at offset {start} of {key} from S3 ... ')
+        return get_s3_object_range_with_backoff(key, start, length,
+                                                client=client,
+                                                client_generator=client_generator,
+                                                bucket=bucket,
+                                                num_tries=num_tries,
+                                                initial_delay=initial_delay,
+                                                delay_factor=delay_factor,
+                                                thread_local=tl,
+                                                metrics=metrics)
+    remote = run_bulk(lambda ii: cur_get_range(ranges[ii]), remote_indices,
+                      max_num_threads=max_num_threads,
+                      deadline=deadline)
+    for ii in remote_indices:
+        result[ii] = remote[ii]
+    return result
+
+
 def get_s3_object_metadata_with_backoff(key, *,
                                         client,
                                         client_generator,
@@ -247,7 +606,8 @@ def get_s3_object_metadata_with_backoff(key, *,
                                         num_tries=5,
                                         initial_delay=1.0,
                                         delay_factor=math.sqrt(2.0),
-                                        thread_local=None):
+                                        thread_local=None,
+                                        metrics=None):
     if client is None:
         if thread_local is None:
             client = client_generator()
@@ -259,17 +619,170 @@ def get_s3_object_metadata_with_backoff(key, *,
     num_tries_left = num_tries
     while num_tries_left >= 1:
         try:
-            metadata = client.head_object(Key=key, Bucket=bucket)
+            with maybe_timed(metrics, 'head', key=key, attempt=num_tries - num_tries_left + 1):
+                metadata = client.head_object(Key=key, Bucket=bucket)
             return metadata
         except:
             if num_tries_left == 1:
                 raise Exception('get backoff failed ' + key + ' ' + str(delay))
             else:
-                time.sleep(delay)
+                record_retry(metrics, delay)
+                backoff_sleep(delay)
                 delay *= delay_factor
                 num_tries_left -= 1
 
 
+def list_s3_object_metadata_with_backoff(prefix, keys, *,
+                                         client,
+                                         client_generator,
+                                         bucket,
+                                         num_tries=5,
+                                         initial_delay=1.0,
+                                         delay_factor=math.sqrt(2.0),
+                                         max_pages=None,
+                                         thread_local=None,
+                                         metrics=None):
+    # Returns the metadata of the objects directly under the prefix, listing only the range spanned by keys, and
+    # the last key of the range that the listing covered. The result also contains objects in that range that were
+    # not requested. After max_pages listing calls, the listing stops even if it did not reach the last key.
+    if client is None:
+        if thread_local is None:
+            client = client_generator()
+        else:
+            if not hasattr(thread_local, 'get_object_client'):
+                thread_local.get_object_client = client_generator()
+            client = thread_local.get_object_client
+    keys = sorted(keys)
+    result = {}
+    num_pages = 0
+    request = {'Bucket': bucket, 'Prefix': prefix, 'Delimiter': '/'}
+    # Starting after the first key without its last character includes the first key
+    if len(keys[0]) - 1 > len(prefix):
+        request['StartAfter'] = keys[0][:-1]
+    while True:
+        delay = initial_delay
+        num_tries_left = num_tries
+        while num_tries_left >= 1:
+            try:
+                with maybe_timed(metrics, 'list', key=prefix, attempt=num_tries - num_tries_left + 1):
+                    response = client.list_objects_v2(**request)
+                break
+            except:
+                if num_tries_left == 1:
+                    raise Exception(f'list backoff failed for prefix {prefix}, last delay {delay}')
+                else:
+                    record_retry(metrics, delay)
+                    backoff_sleep(delay)
+                    delay *= delay_factor
+                    num_tries_left -= 1
+        num_pages += 1
+        contents = response.get('Contents', [])
+        for x in contents:
+            result[x['Key']] = {'LastModified': x['LastModified'], 'Size': x['Size'], 'ETag': x['ETag']}
+        if not response.get('IsTruncated') or (contents and contents[-1]['Key'] >= keys[-1]):
+            return result, keys[-1]
+        if max_pages is not None and num_pages >= max_pages:
+            # Common prefixes ("directories") do not advance the covered range
+            return result, contents[-1]['Key'] if contents else None
+        request['ContinuationToken'] = response['NextContinuationToken']
+
+
+# Groups of keys in a prefix without an observed listing density are only listed if they have this many keys
+LISTING_MIN_KEYS = 8
+
+
+def get_s3_object_metadata_bulk(keys, *,
+                                client,
+                                client_generator,
+                                bucket,
+                                max_num_threads=20,
+                                num_tries=5,
+                                initial_delay=1.0,
+                                delay_factor=math.sqrt(2.0),
+                                listing_density=None,
+                                on_error='fail_fast',
+                                deadline=None,
+                                metrics=None):
+    # Returns a BulkResult {key: {'LastModified', 'Size', 'ETag'}} for keys that exist.
+    # If listing_density is a dictionary, keys are grouped by their parent prefix, and a group is revalidated
+    # with listing calls (up to 1000 objects each) instead of one HEAD per key when that takes fewer requests.
+    # listing_density learns, per prefix, how many objects a listing returns per requested key. Prefixes without
+    # an observation are only listed for groups of at least LISTING_MIN_KEYS keys. A listing stops after half as
+    # many calls as the group has keys, and the keys it did not reach are checked with HEAD requests, so sparse
+    # keys in a large prefix cost at most about 1.5 requests per key. Keys whose listing failed (e.g., because
+    # the credentials lack the ListBucket permission) are also checked with HEAD requests, and their prefix is
+    # not listed again.
+    groups = {}
+    for key in keys:
+        groups.setdefault(key[:key.rfind('/') + 1], []).append(key)
+    listed_groups = {}
+    head_keys = []
+    for prefix, group in groups.items():
+        if listing_density is None:
+            head_keys.extend(group)
+            continue
+        density = listing_density.get(prefix)
+        if density is None:
+            use_listing = len(group) >= LISTING_MIN_KEYS
+        else:
+            # Fewer listing calls (ceil(len(group) * density / 1000)) than HEAD requests
+            use_listing = len(group) * density / 1000 <= len(group) - 1
+        if use_listing:
+            listed_groups[prefix] = sorted(group)
+        else:
+            head_keys.extend(group)
+
+    result = BulkResult()
+    if listed_groups:
+        tl = threading.local()
+        def cur_list_group(prefix):
+            return list_s3_object_metadata_with_backoff(prefix, listed_groups[prefix],
+                                                        client=client,
+                                                        client_generator=client_generator,
+                                                        bucket=bucket,
+                                                        num_tries=num_tries,
+                                                        initial_delay=initial_delay,
+                                                        delay_factor=delay_factor,
+                                                        max_pages=max(1, len(listed_groups[prefix]) // 2),
+                                                        thread_local=tl,
+                                                        metrics=metrics)
+        # Failed listings fall back to HEAD requests, so they do not count as errors of the operation
+        listings = run_bulk(cur_list_group, list(listed_groups.keys()),
+                            max_num_threads=max_num_threads,
+                            on_error='collect',
+                            deadline=deadline)
+        for prefix, exc in listings.errors.items():
+            if not isinstance(exc, DeadlineExceeded):
+                listing_density[prefix] = math.inf
+            head_keys.extend(listed_groups[prefix])
+        for prefix, (listing, last_covered) in listings.items():
+            group = listed_groups[prefix]
+            covered = [key for key in group if last_covered is not None and key <= last_covered]
+            head_keys.extend(group[len(covered):])
+            listing_density[prefix] = max(1.0, len(listing) / max(1, len(covered)))
+            for key in covered:
+                if key in listing:
+                    result[key] = listing[key]
+    if head_keys:
+        metadata = get_s3_object_metadata_parallel(head_keys,
+                                                   client=client,
+                                                   client_generator=client_generator,
+                                                   bucket=bucket,
+                                                   verbose=False,
+                                                   max_num_threads=max_num_threads,
+                                                   num_tries=num_tries,
+                                                   initial_delay=initial_delay,
+                                                   delay_factor=delay_factor,
+                                                   download_callback=None,
+                                                   on_error=on_error,
+                                                   deadline=deadline,
+                                                   metrics=metrics)
+        for key, x in metadata.items():
+            result[key] = {'LastModified': x['LastModified'], 'Size': x['ContentLength'], 'ETag': x['ETag']}
+        result.errors.update(metadata.errors)
+    return result
+
+
 def get_s3_object_metadata_parallel(keys,
                                     client,
                                     client_generator,
@@ -279,7 +792,11 @@ def get_s3_object_metadata_parallel(keys,
                                     num_tries=5,
                                     initial_delay=1.0,
                                     delay_factor=math.sqrt(2.0),
-                                    download_callback=None):
+                                    download_callback=None,
+                                    on_error='fail_fast',
+                                    deadline=None,
+                                    metrics=None):
+    # Returns a BulkResult mapping keys to their HEAD responses (see run_bulk for on_error and deadline)
     if client is None:
         assert client_generator is not None
     else:
@@ -296,45 +813,342 @@ def get_s3_object_metadata_parallel(keys,
                                                    num_tries=num_tries,
                                                    initial_delay=initial_delay,
                                                    delay_factor=delay_factor,
-                                                   thread_local=tl)
-    download_start = timer()
-    result = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_num_threads) as executor:
-        future_to_key = {executor.submit(cur_get_object_metadata, key): key for key in keys}
-        for future in concurrent.futures.as_completed(future_to_key):
-            key = future_to_key[future]
-            try:
-                result[key] = future.result()
-                if download_callback:
-                    download_callback(1)
-            except Exception as exc:
-                print('Key {} generated an exception: {}'.format(key, exc))
-                raise exc
-    download_end = timer()
-    if verbose:
-        print('Getting object metadata took {} seconds'.format(download_end - download_start))
-    return result
+                                                   thread_local=tl,
+                                                   metrics=metrics)
+    return run_bulk(cur_get_object_metadata, keys,
+                    max_num_threads=max_num_threads,
+                    on_error=on_error,
+                    deadline=deadline,
+                    callback=download_callback)
 
 
-def put_s3_object_bytes_with_backoff(file_bytes, key, client, bucket, num_tries=10, initial_delay=1.0, delay_factor=2.0):
+def put_s3_object_bytes_with_backoff(file_bytes, key, client, bucket, num_tries=10, initial_delay=1.0, delay_factor=2.0,
+                                     metrics=None):
     delay = initial_delay
     num_tries_left = num_tries
+    bio = io.BytesIO(file_bytes)
     while num_tries_left >= 1:
         try:
-            bio = io.BytesIO(file_bytes)
-            client.upload_fileobj(bio, Key=key, Bucket=bucket, ExtraArgs={'ACL': 'bucket-owner-full-control'})
+            bio.seek(0)
+            with maybe_timed(metrics, 'put', key=key, attempt=num_tries - num_tries_left + 1) as transfer:
+                client.upload_fileobj(bio, Key=key, Bucket=bucket, ExtraArgs={'ACL': 'bucket-owner-full-control'})
+                transfer['bytes_out'] = len(file_bytes)
             return
         except:
             if num_tries_left == 1:
                 raise Exception(f'put backoff failed for key {key} ({len(file_bytes)} bytes), last delay {delay}')
             else:
-                time.sleep(delay)
+                record_retry(metrics, delay)
+                backoff_sleep(delay)
+                delay *= delay_factor
+                num_tries_left -= 1
+
+
+def put_s3_object_frames_with_backoff(frames, key, client, bucket, num_tries=10, initial_delay=1.0, delay_factor=2.0,
+                                      metrics=None):
+    # Like put_s3_object_bytes_with_backoff, but streams a list of buffers without concatenating them
+    delay = initial_delay
+    num_tries_left = num_tries
+    while num_tries_left >= 1:
+        try:
+            reader = FramesReader(frames)
+            with maybe_timed(metrics, 'put', key=key, attempt=num_tries - num_tries_left + 1) as transfer:
+                client.upload_fileobj(reader, Key=key, Bucket=bucket, ExtraArgs={'ACL': 'bucket-owner-full-control'})
+                transfer['bytes_out'] = reader.total
+            return
+        except:
+            if num_tries_left == 1:
+                raise Exception(f'put backoff failed for key {key} ({frames_nbytes(frames)} bytes), last delay {delay}')
+            else:
+                record_retry(metrics, delay)
+                backoff_sleep(delay)
+                delay *= delay_factor
+                num_tries_left -= 1
+
+
+def upload_s3_part_with_backoff(part, key, upload_id, part_number, *,
+                                client,
+                                bucket,
+                                num_tries=5,
+                                initial_delay=1.0,
+                                delay_factor=math.sqrt(2.0),
+                                metrics=None):
+    delay = initial_delay
+    num_tries_left = num_tries
+    while num_tries_left >= 1:
+        try:
+            with maybe_timed(metrics, 'put_part', key=key, attempt=num_tries - num_tries_left + 1) as transfer:
+                response = client.upload_part(Body=part, Bucket=bucket, Key=key, UploadId=upload_id,
+                                              PartNumber=part_number)
+                transfer['bytes_out'] = len(part)
+            return {'ETag': response['ETag'], 'PartNumber': part_number}
+        except:
+            if num_tries_left == 1:
+                raise Exception(f'upload part backoff failed for key {key} (part {part_number}), last delay {delay}')
+            else:
+                record_retry(metrics, delay)
+                backoff_sleep(delay)
+                delay *= delay_factor
+                num_tries_left -= 1
+
+
+def put_s3_object_stream_with_backoff(source, key, *,
+                                      client,
+                                      bucket,
+                                      part_size=8 * 2 ** 20,
+                                      max_in_flight_parts=4,
+                                      num_tries=5,
+                                      initial_delay=1.0,
+                                      delay_factor=math.sqrt(2.0),
+                                      metrics=None):
+    # Uploads a file-like object or an iterable of chunks with a multipart upload. At most max_in_flight_parts
+    # parts are uploaded concurrently, and reading from the source pauses while they are all busy, so memory
+    # stays below (max_in_flight_parts + 1) * part_size. Each part is retried on its own.
+    # Returns the number of bytes uploaded.
+    assert part_size >= 5 * 2 ** 20, 'S3 parts (except the last one) must be at least 5 MiB'
+    parts = iter_parts(source, part_size)
+    first_part = next(parts, b'')
+    second_part = next(parts, None)
+    if second_part is None:
+        # Small objects do not need a multipart upload
+        put_s3_object_bytes_with_backoff(first_part, key, client, bucket,
+                                         num_tries=num_tries,
+                                         initial_delay=initial_delay,
+                                         delay_factor=delay_factor,
+                                         metrics=metrics)
+        return len(first_part)
+
+    with maybe_timed(metrics, 'put_multipart_start', key=key):
+        upload_id = client.create_multipart_upload(Bucket=bucket, Key=key,
+                                                   ACL='bucket-owner-full-control')['UploadId']
+    slots = threading.Semaphore(max_in_flight_parts)
+    def upload_part(part, part_number):
+        try:
+            return upload_s3_part_with_backoff(part, key, upload_id, part_number,
+                                               client=client,
+                                               bucket=bucket,
+                                               num_tries=num_tries,
+                                               initial_delay=initial_delay,
+                                               delay_factor=delay_factor,
+                                               metrics=metrics)
+        finally:
+            slots.release()
+    futures = []
+    num_bytes = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight_parts) as executor:
+            def all_parts():
+                yield first_part
+                yield second_part
+                yield from parts
+            for part_number, part in enumerate(all_parts(), start=1):
+                slots.acquire()
+                # Stop reading the source early if an upload already failed
+                for future in futures:
+                    if future.done() and future.exception() is not None:
+                        slots.release()
+                        raise future.exception()
+                num_bytes += len(part)
+                futures.append(submit_traced(executor, upload_part, part, part_number))
+                del part
+            completed_parts = [future.result() for future in futures]
+        with maybe_timed(metrics, 'put_multipart_complete', key=key):
+            client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                             MultipartUpload={'Parts': completed_parts})
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    return num_bytes
+
+
+def copy_s3_part_with_backoff(src_key, dst_key, upload_id, part_number, start, end, *,
+                              client,
+                              bucket,
+                              source_bucket=None,
+                              num_tries=5,
+                              initial_delay=1.0,
+                              delay_factor=math.sqrt(2.0),
+                              metrics=None):
+    # Copies the bytes [start, end) of src_key into one part of a multipart upload
+    delay = initial_delay
+    num_tries_left = num_tries
+    while num_tries_left >= 1:
+        try:
+            with maybe_timed(metrics, 'copy_part', key=dst_key, attempt=num_tries - num_tries_left + 1):
+                response = client.upload_part_copy(Bucket=bucket, Key=dst_key, UploadId=upload_id,
+                                                   PartNumber=part_number,
+                                                   CopySource={'Bucket': source_bucket or bucket,
+                                                               'Key': src_key},
+                                                   CopySourceRange=f'bytes={start}-{end - 1}')
+            return {'ETag': response['CopyPartResult']['ETag'], 'PartNumber': part_number}
+        except:
+            if num_tries_left == 1:
+                raise Exception(f'copy part backoff failed for key {dst_key} (part {part_number}), last delay {delay}')
+            else:
+                record_retry(metrics, delay)
+                backoff_sleep(delay)
                 delay *= delay_factor
                 num_tries_left -= 1
 
 
-def list_all_keys(client, bucket, prefix, max_keys=None):
-    objects = client.list_objects(Bucket=bucket, Prefix=prefix, Delimiter='/')
+def copy_s3_object_with_backoff(src_key, dst_key, *,
+                                client,
+                                client_generator,
+                                bucket,
+                                source_bucket=None,
+                                size=None,
+                                part_size=256 * 2 ** 20,
+                                max_in_flight_parts=4,
+                                num_tries=5,
+                                initial_delay=1.0,
+                                delay_factor=math.sqrt(2.0),
+                                thread_local=None,
+                                metrics=None):
+    # Copies an object inside the bucket (or from source_bucket into the bucket) without transferring the data
+    # to the client. Objects larger than part_size are copied with a multipart copy, max_in_flight_parts parts
+    # at a time. Returns the size of the object.
+    assert part_size <= 5 * 2 ** 30, 'S3 copies at most 5 GiB per request'
+    if client is None:
+        if thread_local is None:
+            client = client_generator()
+        else:
+            if not hasattr(thread_local, 'get_object_client'):
+                thread_local.get_object_client = client_generator()
+            client = thread_local.get_object_client
+    if size is None:
+        size = get_s3_object_metadata_with_backoff(src_key,
+                                                   client=client,
+                                                   client_generator=None,
+                                                   bucket=source_bucket or bucket,
+                                                   num_tries=num_tries,
+                                                   initial_delay=initial_delay,
+                                                   delay_factor=delay_factor,
+                                                   metrics=metrics)['ContentLength']
+    if size <= part_size:
+        delay = initial_delay
+        num_tries_left = num_tries
+        while num_tries_left >= 1:
+            try:
+                with maybe_timed(metrics, 'copy', key=dst_key, attempt=num_tries - num_tries_left + 1):
+                    client.copy_object(Bucket=bucket, Key=dst_key,
+                                       CopySource={'Bucket': source_bucket or bucket, 'Key': src_key},
+                                       ACL='bucket-owner-full-control')
+                return size
+            except:
+                if num_tries_left == 1:
+                    raise Exception(f'copy backoff failed for key {src_key} -> {dst_key}, last delay {delay}')
+                else:
+                    record_retry(metrics, delay)
+                    backoff_sleep(delay)
+                    delay *= delay_factor
+                    num_tries_left -= 1
+
+    with maybe_timed(metrics, 'copy_multipart_start', key=dst_key):
+        upload_id = client.create_multipart_upload(Bucket=bucket, Key=dst_key,
+                                                   ACL='bucket-owner-full-control')['UploadId']
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight_parts) as executor:
+            futures = []
+            for part_number, start in enumerate(range(0, size, part_size), start=1):
+                futures.append(submit_traced(executor, copy_s3_part_with_backoff,
+                                             src_key, dst_key, upload_id, part_number, start,
+                                             min(start + part_size, size),
+                                             client=client,
+                                             bucket=bucket,
+                                             source_bucket=source_bucket,
+                                             num_tries=num_tries,
+                                             initial_delay=initial_delay,
+                                             delay_factor=delay_factor,
+                                             metrics=metrics))
+            completed_parts = [future.result() for future in futures]
+        with maybe_timed(metrics, 'copy_multipart_complete', key=dst_key):
+            client.complete_multipart_upload(Bucket=bucket, Key=dst_key, UploadId=upload_id,
+                                             MultipartUpload={'Parts': completed_parts})
+    except BaseException:
+        client.abort_multipart_upload(Bucket=bucket, Key=dst_key, UploadId=upload_id)
+        raise
+    return size
+
+
+def copy_s3_objects_parallel(pairs, *,
+                             client,
+                             client_generator,
+                             bucket,
+                             source_bucket=None,
+                             sizes=None,
+                             delete_source=False,
+                             cache_on_local_disk=True,
+                             cache_root_path=None,
+                             verbose=False,
+                             max_num_threads=90,
+                             part_size=256 * 2 ** 20,
+                             max_in_flight_parts=4,
+                             num_tries=5,
+                             initial_delay=1.0,
+                             delay_factor=math.sqrt(2.0),
+                             on_error='fail_fast',
+                             deadline=None,
+                             metrics=None):
+    # pairs maps source keys to destination keys, sizes (optional) maps source keys to their sizes, e.g.,
+    # from a listing. With source_bucket, the source keys are in that bucket instead of the destination bucket.
+    # With delete_source, the source keys are deleted after they were copied (a move).
+    # Cached copies of the destination keys (and of moved source keys) are evicted.
+    # Returns a BulkResult whose errors map the source keys that failed (see run_bulk).
+    if client is None:
+        assert client_generator is not None
+    else:
+        assert client_generator is None
+        assert max_num_threads <= 1
+    if cache_on_local_disk:
+        assert cache_root_path is not None
+    assert source_bucket is None or not delete_source, 'Moves between buckets are not supported'
+
+    tl = threading.local()
+    def cur_copy(src):
+        if client is None:
+            if not hasattr(tl, 'get_object_client'):
+                tl.get_object_client = client_generator()
+            cur_client = tl.get_object_client
+        else:
+            cur_client = client
+        dst = pairs[src]
+        copy_s3_object_with_backoff(src, dst,
+                                    client=cur_client,
+                                    client_generator=None,
+                                    bucket=bucket,
+                                    source_bucket=source_bucket,
+                                    size=None if sizes is None else sizes.get(src),
+                                    part_size=part_size,
+                                    max_in_flight_parts=max_in_flight_parts,
+                                    num_tries=num_tries,
+                                    initial_delay=initial_delay,
+                                    delay_factor=delay_factor,
+                                    metrics=metrics)
+        if cache_on_local_disk:
+            evict_cached_key(cache_root_path, dst, verbose=verbose, metrics=metrics)
+        if delete_source and src != dst:
+            delete_key(cur_client, bucket, src,
+                       cache_on_local_disk=cache_on_local_disk,
+                       cache_root_path=cache_root_path,
+                       verbose=verbose,
+                       num_tries=num_tries,
+                       initial_delay=initial_delay,
+                       delay_factor=delay_factor,
+                       metrics=metrics)
+        if verbose:
+            print(f'Copied key {src} to {dst}')
+
+    return run_bulk(cur_copy, list(pairs.keys()),
+                    max_num_threads=max_num_threads,
+                    on_error=on_error,
+                    deadline=deadline)
+
+
+def list_all_keys(client, bucket, prefix, max_keys=None, metrics=None):
+    with maybe_timed(metrics, 'list', key=prefix):
+        objects = client.list_objects(Bucket=bucket, Prefix=prefix, Delimiter='/')
     contents = objects.get("Contents", [])
     common_prefixes = objects.get("CommonPrefixes", [])
     keys = list([x['Key'] for x in contents])
@@ -342,8 +1156,9 @@ def list_all_keys(client, bucket, prefix, max_keys=None):
     truncated = objects['IsTruncated']
     next_marker = objects.get('NextMarker')
     while truncated:
-        objects = client.list_objects(Bucket=bucket, Prefix=prefix,
-                                      Delimiter='/', Marker=next_marker)
+        with maybe_timed(metrics, 'list', key=prefix):
+            objects = client.list_objects(Bucket=bucket, Prefix=prefix,
+                                          Delimiter='/', Marker=next_marker)
         truncated = objects['IsTruncated']
         next_marker = objects.get('NextMarker')
         keys += list(map(lambda x: x['Key'], objects['Contents']))
@@ -352,6 +1167,28 @@ def list_all_keys(client, bucket, prefix, max_keys=None):
     return list(filter(lambda x: len(x) > 0, keys))
 
 
+def list_all_object_metadata(client, bucket, prefix, start_after=None, metrics=None):
+    # Returns {key: {'Size', 'ETag'}} for all objects under the prefix, including those in nested "directories".
+    # With start_after, only keys after it (in the UTF-8 order of S3 listings) are listed.
+    metadata = {}
+    request = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after is not None:
+        request['StartAfter'] = start_after
+    while True:
+        with maybe_timed(metrics, 'list', key=prefix):
+            response = client.list_objects_v2(**request)
+        for x in response.get('Contents', []):
+            metadata[x['Key']] = {'Size': x['Size'], 'ETag': x['ETag']}
+        if not response.get('IsTruncated'):
+            return metadata
+        request['ContinuationToken'] = response['NextContinuationToken']
+
+
+def list_all_object_sizes(client, bucket, prefix, metrics=None):
+    # Returns {key: size} for all objects under the prefix, including those in nested "directories"
+    return {key: x['Size'] for key, x in list_all_object_metadata(client, bucket, prefix, metrics=metrics).items()}
+
+
 def download_s3_file_with_caching(key, local_filename, *,
                                   bucket,
                                   client,
@@ -363,7 +1200,11 @@ def download_s3_file_with_caching(key, local_filename, *,
                                   num_tries=5,
                                   initial_delay=1.0,
                                   delay_factor=math.sqrt(2.0),
-                                  skip_modification_time_check=False):
+                                  skip_modification_time_check=False,
+                                  freshness_ttl=0.0,
+                                  listing_density=None,
+                                  link_mode='copy',
+                                  metrics=None):
     if client is None:
         assert client_generator is not None
     else:
@@ -371,68 +1212,112 @@ def download_s3_file_with_caching(key, local_filename, *,
     if cache_on_local_disk:
         assert cache_root_path is not None
         cache_root_path = pathlib.Path(cache_root_path).resolve()
-        currently_cached = False
-
         cache_filepath = cache_root_path / key
-        if not cache_filepath.is_file():
-            cache_filepath.parent.mkdir(parents=True, exist_ok=True)
-        else:
-            if skip_modification_time_check:
-                if verbose:
-                    print(f'Skipping the file modification time check the local copy in the cache.')
-                currently_cached = True
-            else:
-                if verbose:
-                    print(f'Getting metadata to check the modification time compared to the local copy ... ', end='')
-                metadata_start = timer()
-                metadata = get_s3_object_metadata_with_backoff(key,
-                                                               client=client,
-                                                               client_generator=client_generator,
-                                                               bucket=bucket,
-                                                               num_tries=num_tries,
-                                                               initial_delay=initial_delay,
-                                                               delay_factor=delay_factor)
-                metadata_end = timer()
-                if verbose:
-                    print(f'took {metadata_end - metadata_start:.3f} seconds')
-                local_time = datetime.datetime.fromtimestamp(cache_filepath.stat().st_mtime,
-                                                             datetime.timezone.utc)
-                remote_time = metadata['LastModified']
-                if (remote_time - local_time).total_seconds() >= -2:
-                    if verbose:
-                        print(f'Local copy of key "{key}" is outdated')
-                else:
-                    currently_cached = True
-        if not currently_cached:
-            if verbose or special_verbose:
-                print('{} not available locally or outdated, downloading from S3 ... '.format(key))
-            download_start = timer()
-            download_s3_file_with_backoff(key, str(cache_filepath),
-                                          client=client,
-                                          client_generator=client_generator,
-                                          bucket=bucket,
-                                          initial_delay=initial_delay,
-                                          delay_factor=delay_factor)
-            download_end = timer()
-            if verbose:
-                print('Downloading took {:.3f} seconds'.format(download_end - download_start))
+        sync_s3_cache([key],
+                      client=client,
+                      client_generator=client_generator,
+                      bucket=bucket,
+                      cache_root_path=cache_root_path,
+                      verbose=verbose,
+                      special_verbose=special_verbose,
+                      max_num_threads=1,
+                      num_tries=num_tries,
+                      initial_delay=initial_delay,
+                      delay_factor=delay_factor,
+                      skip_modification_time_check=skip_modification_time_check,
+                      freshness_ttl=freshness_ttl,
+                      listing_density=listing_density,
+                      metrics=metrics)
         assert cache_filepath.is_file()
         if verbose:
-            print(f'Copying to the target from the cache file {cache_filepath} ...')
-        shutil.copy(cache_filepath, local_filename)
+            print(f'Copying to the target from the cache file {cache_filepath} ({link_mode}) ...')
+        if link_file(cache_filepath, local_filename, link_mode) != link_mode and metrics is not None:
+            metrics.increment('link_fallbacks')
     else:
         if verbose:
             print('Loading {} from S3 ... '.format(key))
-        download_start = timer()
         download_s3_file_with_backoff(key, str(local_filename),
                                       client=client,
                                       client_generator=client_generator,
                                       bucket=bucket,
                                       initial_delay=initial_delay,
-                                      delay_factor=delay_factor)
-        download_end = timer()
+                                      delay_factor=delay_factor,
+                                      metrics=metrics)
+
+
+def download_s3_files_parallel(filenames, *,
+                               client,
+                               client_generator,
+                               bucket,
+                               cache_on_local_disk=True,
+                               cache_root_path=None,
+                               verbose=False,
+                               max_num_threads=90,
+                               num_tries=5,
+                               initial_delay=1.0,
+                               delay_factor=math.sqrt(2.0),
+                               download_callback=None,
+                               skip_modification_time_check=False,
+                               freshness_ttl=0.0,
+                               listing_density=None,
+                               link_mode='copy',
+                               on_error='fail_fast',
+                               deadline=None,
+                               metrics=None):
+    # filenames maps keys to local target files. With the cache, the targets are linked to (or copied from)
+    # the cache files according to link_mode.
+    # Returns {key: exception} for the keys that failed (only with on_error='collect', see run_bulk).
+    if client is None:
+        assert client_generator is not None
+    else:
+        assert client_generator is None
+        assert max_num_threads <= 1
+    if cache_on_local_disk:
+        assert cache_root_path is not None
+        cache_root_path = pathlib.Path(cache_root_path).resolve()
+        errors = sync_s3_cache(list(filenames.keys()),
+                               client=client,
+                               client_generator=client_generator,
+                               bucket=bucket,
+                               cache_root_path=cache_root_path,
+                               verbose=verbose,
+                               special_verbose=False,
+                               max_num_threads=max_num_threads,
+                               num_tries=num_tries,
+                               initial_delay=initial_delay,
+                               delay_factor=delay_factor,
+                               download_callback=download_callback,
+                               skip_modification_time_check=skip_modification_time_check,
+                               freshness_ttl=freshness_ttl,
+                               listing_density=listing_density,
+                               on_error=on_error,
+                               deadline=deadline,
+                               metrics=metrics)
+        for key, filename in filenames.items():
+            if key in errors:
+                continue
+            if link_file(cache_root_path / key, filename, link_mode) != link_mode and metrics is not None:
+                metrics.increment('link_fallbacks')
+        return errors
+
+    tl = threading.local()
+    def cur_download_file(key):
         if verbose:
-            print('Downloading took {:.3f} seconds'.format(download_end - download_start))
+            print('Loading {} from S3 ... '.format(key))
+        download_s3_file_with_backoff(key, str(filenames[key]),
+                                      client=client,
+                                      client_generator=client_generator,
+                                      bucket=bucket,
+                                      num_tries=num_tries,
+                                      initial_delay=initial_delay,
+                                      delay_factor=delay_factor,
+                                      thread_local=tl,
+                                      metrics=metrics)
+    return run_bulk(cur_download_file, list(filenames.keys()),
+                    max_num_threads=max_num_threads,
+                    on_error=on_error,
+                    deadline=deadline,
+                    callback=download_callback).errors
 
 
 def download_s3_file_with_backoff(key, local_filename, *,
@@ -442,7 +1327,8 @@ def download_s3_file_with_backoff(key, local_filename, *,
                                   num_tries=5,
                                   initial_delay=1.0,
                                   delay_factor=math.sqrt(2.0),
-                                  thread_local=None):
+                                  thread_local=None,
+                                  metrics=None):
     if client is None:
         if thread_local is None:
             client = client_generator()
@@ -455,13 +1341,16 @@ def download_s3_file_with_backoff(key, local_filename, *,
 
     while num_tries_left >= 1:
         try:
-            client.download_file(bucket, key, local_filename)
+            with maybe_timed(metrics, 'download', key=key, attempt=num_tries - num_tries_left + 1) as transfer:
+                client.download_file(bucket, key, local_filename)
+                transfer['bytes_in'] = os.path.getsize(local_filename)
             return
         except:
             if num_tries_left == 1:
                 raise Exception('download backoff failed ' + ' ' + str(key) + ' ' + str(delay))
             else:
-                time.sleep(delay)
+                record_retry(metrics, delay)
+                backoff_sleep(delay)
                 delay *= delay_factor
                 num_tries_left -= 1
 
@@ -473,7 +1362,8 @@ def upload_file_to_s3_with_backoff(local_filename, key, *,
                                    num_tries=5,
                                    initial_delay=1.0,
                                    delay_factor=math.sqrt(2.0),
-                                   thread_local=None):
+                                   thread_local=None,
+                                   metrics=None):
     assert pathlib.Path(local_filename).is_file()
     if client is None:
         if thread_local is None:
@@ -486,13 +1376,16 @@ def upload_file_to_s3_with_backoff(local_filename, key, *,
     num_tries_left = num_tries
     while num_tries_left >= 1:
         try:
-            client.upload_file(str(local_filename), bucket, key, ExtraArgs={'ACL': 'bucket-owner-full-control'})
+            with maybe_timed(metrics, 'upload', key=key, attempt=num_tries - num_tries_left + 1) as transfer:
+                client.upload_file(str(local_filename), bucket, key, ExtraArgs={'ACL': 'bucket-owner-full-control'})
+                transfer['bytes_out'] = os.path.getsize(local_filename)
             return
         except:
             if num_tries_left == 1:
                 raise Exception('upload backoff failed ' + ' ' + str(key) + ' ' + str(delay))
             else:
-                time.sleep(delay)
+                record_retry(metrics, delay)
+                backoff_sleep(delay)
                 delay *= delay_factor
                 num_tries_left -= 1
 
@@ -522,8 +1415,14 @@ class S3Adapter(StorageAdapter):
                  num_tries=3,
                  initial_delay=1.0,
                  delay_factor=math.sqrt(2.0),
-                 skip_modification_time_check=False):
+                 skip_modification_time_check=False,
+                 cache_freshness_ttl=0.0,
+                 revalidate_by_listing=True,
+                 multipart_part_size=8 * 2 ** 20,
+                 max_in_flight_parts=4,
+                 copy_part_size=256 * 2 ** 20):
         self.bucket = bucket
+        self.endpoint_url = endpoint_url
         self.cache_on_local_disk = cache_on_local_disk
 
         if anonymous:
@@ -553,7 +1452,8 @@ class S3Adapter(StorageAdapter):
                                   aws_access_key_id=access_key,
                                   aws_secret_access_key=secret_key)
         self.get_client = get_client
-        self.client = self.get_client()
+        self.client_pid = os.getpid()
+        self.process_client = self.get_client()
 
         if self.cache_on_local_disk:
             assert cache_root_path is not None
@@ -568,12 +1468,43 @@ class S3Adapter(StorageAdapter):
         self.initial_delay = initial_delay
         self.delay_factor = delay_factor
         self.skip_modification_time_check = skip_modification_time_check
+        # Cached copies validated less than cache_freshness_ttl seconds ago are used without a request
+        self.cache_freshness_ttl = cache_freshness_ttl
+        # Objects per requested key seen when revalidating a prefix by listing (None: one HEAD per key)
+        self.listing_density = {} if revalidate_by_listing else None
+        self.multipart_part_size = multipart_part_size
+        self.max_in_flight_parts = max_in_flight_parts
+        # Server-side copies of larger objects are split into parts of this size
+        self.copy_part_size = copy_part_size
+        self.metrics = Metrics()
+
+    @property
+    def client(self):
+        # boto3 clients must not be shared across a fork, so a forked child creates its own client
+        if self.client_pid != os.getpid():
+            self.process_client = self.get_client()
+            self.client_pid = os.getpid()
+        return self.process_client
+
+    def backend_id(self):
+        return f's3:{self.endpoint_url or ""}/{self.bucket}'
 
     def list_keys(self, prefix, max_keys=None):
-        return list_all_keys(self.client, self.bucket, prefix, max_keys)
+        return list_all_keys(self.client, self.bucket, prefix, max_keys, metrics=self.metrics)
     
+    def list_sizes(self, prefix):
+        return list_all_object_sizes(self.client, self.bucket, prefix, metrics=self.metrics)
+
+    def list_metadata(self, prefix, start_after=None):
+        return list_all_object_metadata(self.client, self.bucket, prefix, start_after, metrics=self.metrics)
+
     def exists(self, key):
-        return key_exists(self.client, self.bucket, key)
+        return key_exists(self.client, self.bucket, key, metrics=self.metrics)
+
+    def evict_cached(self, key, verbose):
+        # A cached copy of an overwritten key is stale, even if it was validated less than cache_freshness_ttl ago
+        if self.cache_on_local_disk:
+            evict_cached_key(self.cache_root_path, key, verbose=verbose, metrics=self.metrics)
 
     def put(self, key, data, verbose=None):
         cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
@@ -583,7 +1514,9 @@ class S3Adapter(StorageAdapter):
                                          bucket=self.bucket,
                                          num_tries=self.num_tries,
                                          initial_delay=self.initial_delay,
-                                         delay_factor=self.delay_factor)
+                                         delay_factor=self.delay_factor,
+                                         metrics=self.metrics)
+        self.evict_cached(key, cur_verbose)
         if cur_verbose:
             print(f'Stored {len(data)} bytes under key {key}')
 
@@ -593,7 +1526,38 @@ class S3Adapter(StorageAdapter):
         for key, data in data_dict.items():
             self.put(key, data, verbose)
 
+    def put_frames(self, key, frames, verbose=None):
+        cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
+        put_s3_object_frames_with_backoff(frames,
+                                          key,
+                                          client=self.client,
+                                          bucket=self.bucket,
+                                          num_tries=self.num_tries,
+                                          initial_delay=self.initial_delay,
+                                          delay_factor=self.delay_factor,
+                                          metrics=self.metrics)
+        self.evict_cached(key, cur_verbose)
+        if cur_verbose:
+            print(f'Stored {frames_nbytes(frames)} bytes under key {key}')
+
+    def put_stream(self, key, source, verbose=None):
+        cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
+        num_bytes = put_s3_object_stream_with_backoff(source,
+                                                      key,
+                                                      client=self.client,
+                                                      bucket=self.bucket,
+                                                      part_size=self.multipart_part_size,
+                                                      max_in_flight_parts=self.max_in_flight_parts,
+                                                      num_tries=self.num_tries,
+                                                      initial_delay=self.initial_delay,
+                                                      delay_factor=self.delay_factor,
+                                                      metrics=self.metrics)
+        self.evict_cached(key, cur_verbose)
+        if cur_verbose:
+            print(f'Stored {num_bytes} bytes under key {key}')
+
     def upload_file(self, key, filename, verbose=None):
+        cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
         upload_file_to_s3_with_backoff(filename,
                                        key,
                                        client=self.client,
@@ -602,9 +1566,11 @@ class S3Adapter(StorageAdapter):
                                        num_tries=self.num_tries,
                                        initial_delay=self.initial_delay,
                                        delay_factor=self.delay_factor,
-                                       thread_local=None)
+                                       thread_local=None,
+                                       metrics=self.metrics)
+        self.evict_cached(key, cur_verbose)
     
-    def download_file(self, key, filename, verbose=None, skip_modification_time_check=None):
+    def download_file(self, key, filename, verbose=None, skip_modification_time_check=None, link_mode='copy'):
         cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
         cur_skip_time_check = default_option_if_needed(user_option=skip_modification_time_check,
                                                        default=self.skip_modification_time_check)
@@ -619,7 +1585,37 @@ class S3Adapter(StorageAdapter):
                                       initial_delay=self.initial_delay,
                                       delay_factor=self.delay_factor,
                                       skip_modification_time_check=cur_skip_time_check,
-                                      verbose=cur_verbose)
+                                      freshness_ttl=self.cache_freshness_ttl,
+                                      listing_density=self.listing_density,
+                                      verbose=cur_verbose,
+                                      link_mode=link_mode,
+                                      metrics=self.metrics)
+
+    def download_multiple(self, filenames, verbose=None, callback=None, skip_modification_time_check=None,
+                          link_mode='copy', on_error='fail_fast', timeout=None):
+        # Returns {key: exception} for the keys that failed with on_error='collect'
+        cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
+        cur_skip_time_check = default_option_if_needed(user_option=skip_modification_time_check,
+                                                       default=self.skip_modification_time_check)
+        return download_s3_files_parallel(filenames,
+                                          client=None,
+                                          client_generator=self.get_client,
+                                          bucket=self.bucket,
+                                          cache_on_local_disk=self.cache_on_local_disk,
+                                          cache_root_path=self.cache_root_path,
+                                          verbose=cur_verbose,
+                                          max_num_threads=self.max_num_threads,
+                                          num_tries=self.num_tries,
+                                          initial_delay=self.initial_delay,
+                                          delay_factor=self.delay_factor,
+                                          download_callback=callback,
+                                          skip_modification_time_check=cur_skip_time_check,
+                                          freshness_ttl=self.cache_freshness_ttl,
+                                          listing_density=self.listing_density,
+                                          link_mode=link_mode,
+                                          on_error=on_error,
+                                          deadline=deadline_from_timeout(timeout),
+                                          metrics=self.metrics)
 
     def get(self, key, verbose=None, skip_modification_time_check=None):
         cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
@@ -637,9 +1633,122 @@ class S3Adapter(StorageAdapter):
                                             initial_delay=self.initial_delay,
                                             delay_factor=self.delay_factor,
                                             download_callback=None,
-                                            skip_modification_time_check=cur_skip_time_check)[key]
+                                            skip_modification_time_check=cur_skip_time_check,
+                                            freshness_ttl=self.cache_freshness_ttl,
+                                            listing_density=self.listing_density,
+                                            metrics=self.metrics)[key]
 
-    def get_multiple(self, keys, verbose=None, callback=None, skip_modification_time_check=None):
+    def get_into(self, key, buffer, verbose=None, skip_modification_time_check=None):
+        cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
+        cur_skip_time_check = default_option_if_needed(user_option=skip_modification_time_check,
+                                                       default=self.skip_modification_time_check)
+        return get_s3_objects_into_parallel({key: buffer},
+                                            client=self.client,
+                                            client_generator=None,
+                                            bucket=self.bucket,
+                                            cache_on_local_disk=self.cache_on_local_disk,
+                                            cache_root_path=self.cache_root_path,
+                                            verbose=cur_verbose,
+                                            max_num_threads=1,
+                                            num_tries=self.num_tries,
+                                            initial_delay=self.initial_delay,
+                                            delay_factor=self.delay_factor,
+                                            skip_modification_time_check=cur_skip_time_check,
+                                            freshness_ttl=self.cache_freshness_ttl,
+                                            listing_density=self.listing_density,
+                                            metrics=self.metrics)[key]
+
+    def get_multiple_into(self, buffers, verbose=None, callback=None, skip_modification_time_check=None,
+                          on_error='fail_fast', timeout=None):
+        cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
+        cur_skip_time_check = default_option_if_needed(user_option=skip_modification_time_check,
+                                                       default=self.skip_modification_time_check)
+        return get_s3_objects_into_parallel(buffers,
+                                            client=None,
+                                            client_generator=self.get_client,
+                                            bucket=self.bucket,
+                                            cache_on_local_disk=self.cache_on_local_disk,
+                                            cache_root_path=self.cache_root_path,
+                                            verbose=cur_verbose,
+                                            max_num_threads=self.max_num_threads,
+                                            num_tries=self.num_tries,
+                                            initial_delay=self.initial_delay,
+                                            delay_factor=self.delay_factor,
+                                            download_callback=callback,
+                                            skip_modification_time_check=cur_skip_time_check,
+                                            freshness_ttl=self.cache_freshness_ttl,
+                                            listing_density=self.listing_density,
+                                            on_error=on_error,
+                                            deadline=deadline_from_timeout(timeout),
+                                            metrics=self.metrics)
+
+    def get_local_path(self, key, verbose=None, skip_modification_time_check=None):
+        if not self.cache_on_local_disk:
+            return None
+        cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
+        cur_skip_time_check = default_option_if_needed(user_option=skip_modification_time_check,
+                                                       default=self.skip_modification_time_check)
+        sync_s3_cache([key],
+                      client=self.client,
+                      client_generator=None,
+                      bucket=self.bucket,
+                      cache_root_path=self.cache_root_path,
+                      verbose=cur_verbose,
+                      max_num_threads=1,
+                      num_tries=self.num_tries,
+                      initial_delay=self.initial_delay,
+                      delay_factor=self.delay_factor,
+                      skip_modification_time_check=cur_skip_time_check,
+                      freshness_ttl=self.cache_freshness_ttl,
+                      listing_density=self.listing_density,
+                      metrics=self.metrics)
+        return self.cache_root_path / key
+
+    def get_ranges(self, ranges, verbose=None, skip_modification_time_check=None, timeout=None):
+        cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
+        cur_skip_time_check = default_option_if_needed(user_option=skip_modification_time_check,
+                                                       default=self.skip_modification_time_check)
+        return get_s3_object_ranges_parallel(ranges,
+                                             client=None,
+                                             client_generator=self.get_client,
+                                             bucket=self.bucket,
+                                             cache_on_local_disk=self.cache_on_local_disk,
+                                             cache_root_path=self.cache_root_path,
+                                             verbose=cur_verbose,
+                                             max_num_threads=self.max_num_threads,
+                                             num_tries=self.num_tries,
+                                             initial_delay=self.initial_delay,
+                                             delay_factor=self.delay_factor,
+                                             skip_modification_time_check=cur_skip_time_check,
+                                             freshness_ttl=self.cache_freshness_ttl,
+                                             listing_density=self.listing_density,
+                                             deadline=deadline_from_timeout(timeout),
+                                             metrics=self.metrics)
+
+    def get_local_paths(self, keys, verbose=None, skip_modification_time_check=None):
+        if not self.cache_on_local_disk:
+            return {key: None for key in keys}
+        cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
+        cur_skip_time_check = default_option_if_needed(user_option=skip_modification_time_check,
+                                                       default=self.skip_modification_time_check)
+        sync_s3_cache(keys,
+                      client=None,
+                      client_generator=self.get_client,
+                      bucket=self.bucket,
+                      cache_root_path=self.cache_root_path,
+                      verbose=cur_verbose,
+                      max_num_threads=self.max_num_threads,
+                      num_tries=self.num_tries,
+                      initial_delay=self.initial_delay,
+                      delay_factor=self.delay_factor,
+                      skip_modification_time_check=cur_skip_time_check,
+                      freshness_ttl=self.cache_freshness_ttl,
+                      listing_density=self.listing_density,
+                      metrics=self.metrics)
+        return {key: self.cache_root_path / key for key in keys}
+
+    def get_multiple(self, keys, verbose=None, callback=None, skip_modification_time_check=None,
+                     on_error='fail_fast', timeout=None):
         cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
         cur_skip_time_check = default_option_if_needed(user_option=skip_modification_time_check,
                                                        default=self.skip_modification_time_check)
@@ -655,8 +1764,82 @@ class S3Adapter(StorageAdapter):
                                             initial_delay=self.initial_delay,
                                             delay_factor=self.delay_factor,
                                             download_callback=callback,
-                                            skip_modification_time_check=cur_skip_time_check)
+                                            skip_modification_time_check=cur_skip_time_check,
+                                            freshness_ttl=self.cache_freshness_ttl,
+                                            listing_density=self.listing_density,
+                                            on_error=on_error,
+                                            deadline=deadline_from_timeout(timeout),
+                                            metrics=self.metrics)
     
+    def copy_multiple(self, pairs, verbose=None, delete_source=False, sizes=None, on_error='fail_fast',
+                      timeout=None):
+        # Returns {source key: exception} for the pairs that failed with on_error='collect'
+        cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
+        if len(pairs) == 1:
+            client, client_generator, max_num_threads = self.client, None, 1
+        else:
+            client, client_generator, max_num_threads = None, self.get_client, self.max_num_threads
+        return copy_s3_objects_parallel(pairs,
+                                        client=client,
+                                        client_generator=client_generator,
+                                        bucket=self.bucket,
+                                        sizes=sizes,
+                                        delete_source=delete_source,
+                                        cache_on_local_disk=self.cache_on_local_disk,
+                                        cache_root_path=self.cache_root_path,
+                                        verbose=cur_verbose,
+                                        max_num_threads=max_num_threads,
+                                        part_size=self.copy_part_size,
+                                        max_in_flight_parts=self.max_in_flight_parts,
+                                        num_tries=self.num_tries,
+                                        initial_delay=self.initial_delay,
+                                        delay_factor=self.delay_factor,
+                                        on_error=on_error,
+                                        deadline=deadline_from_timeout(timeout),
+                                        metrics=self.metrics).errors
+
+    def copy(self, src, dst, verbose=None):
+        self.copy_multiple({src: dst}, verbose=verbose)
+
+    def copy_from(self, source, keys, verbose=None, on_error='fail_fast', timeout=None):
+        # Keys in another bucket are copied server-side, which needs read access to that bucket
+        if not isinstance(source, S3Adapter):
+            return super().copy_from(source, keys, on_error=on_error, timeout=timeout)
+        cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
+        return copy_s3_objects_parallel({key: key for key in keys},
+                                        client=None,
+                                        client_generator=self.get_client,
+                                        bucket=self.bucket,
+                                        source_bucket=source.bucket,
+                                        cache_on_local_disk=self.cache_on_local_disk,
+                                        cache_root_path=self.cache_root_path,
+                                        verbose=cur_verbose,
+                                        max_num_threads=self.max_num_threads,
+                                        part_size=self.copy_part_size,
+                                        max_in_flight_parts=self.max_in_flight_parts,
+                                        num_tries=self.num_tries,
+                                        initial_delay=self.initial_delay,
+                                        delay_factor=self.delay_factor,
+                                        on_error=on_error,
+                                        deadline=deadline_from_timeout(timeout),
+                                        metrics=self.metrics).errors
+
+    def move(self, src, dst, verbose=None):
+        self.copy_multiple({src: dst}, verbose=verbose, delete_source=True)
+
+    def move_multiple(self, pairs, verbose=None, on_error='fail_fast', timeout=None):
+        return self.copy_multiple(pairs, verbose=verbose, delete_source=True, on_error=on_error, timeout=timeout)
+
+    def copy_prefix(self, src_prefix, dst_prefix, verbose=None, on_error='fail_fast', timeout=None):
+        # One listing provides the sizes, so no HEAD request per key is needed.
+        # Returns the number of keys copied (the failed keys are not counted with on_error='collect').
+        sizes = list_all_object_sizes(self.client, self.bucket, src_prefix, metrics=self.metrics)
+        pairs = {key: dst_prefix + key[len(src_prefix):] for key in sizes}
+        errors = {}
+        if pairs:
+            errors = self.copy_multiple(pairs, verbose=verbose, sizes=sizes, on_error=on_error, timeout=timeout)
+        return len(pairs) - len(errors)
+
     def delete(self, key, verbose=None):
         cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
         delete_key(self.client,
@@ -667,10 +1850,23 @@ class S3Adapter(StorageAdapter):
                    verbose=cur_verbose,
                    num_tries=self.num_tries,
                    initial_delay=self.initial_delay,
-                   delay_factor=self.delay_factor)
+                   delay_factor=self.delay_factor,
+                   metrics=self.metrics)
 
-    def delete_multiple(self, keys, verbose=None):
-        # TODO: add a new function for parallel deletion
+    def delete_multiple(self, keys, verbose=None, on_error='fail_fast', timeout=None):
+        # Returns {key: exception} for the keys that failed with on_error='collect'
         # TODO: add a callback parameter
-        for key in keys:
-            self.delete_multiple(key)
\ No newline at end of file
+        cur_verbose = default_option_if_needed(user_option=verbose, default=self.verbose)
+        return delete_s3_objects_parallel(keys,
+                                          client_generator=self.get_client,
+                                          bucket=self.bucket,
+                                          cache_on_local_disk=self.cache_on_local_disk,
+                                          cache_root_path=self.cache_root_path,
+                                          verbose=cur_verbose,
+                                          max_num_threads=self.max_num_threads,
+                                          num_tries=self.num_tries,
+                                          initial_delay=self.initial_delay,
+                                          delay_factor=self.delay_factor,
+                                          on_error=on_error,
+                                          deadline=deadline_from_timeout(timeout),
+                                          metrics=self.metrics)
\ No newline at end of file
@@ -0,0 +1,191 @@
+import json
+import mmap
+import pickle
+import struct
+
+from .frames import as_byte_view
+
+
+# Layout of a serialized object:
+#   MAGIC | header length (uint32, little endian) | JSON header | padding | frame 0 | frame 1 | ...
+# The payload starts at a multiple of PAYLOAD_ALIGNMENT so that arrays read back with frombuffer are aligned.
+MAGIC = b'OSOBJ1'
+HEADER_LENGTH_FORMAT = '<I'
+PAYLOAD_ALIGNMENT = 64
+
+
+class Serializer:
+    """Base class for the serializers used by ObjectStash.put_obj and ObjectStash.get_obj.
+
+    A serializer turns an object into a JSON-compatible header and a list of buffers (frames).
+    The frames are written back to back without being copied into an intermediate bytes object,
+    and on the way back they are handed to decode as zero-copy memoryviews into the stored data.
+    """
+    name = None
+
+    def encode(self, obj):
+        """Returns a tuple (header, frames), where header is a JSON-compatible dict and frames is a list of buffers."""
+        raise NotImplementedError
+
+    def decode(self, header, frames):
+        """Reconstructs the object from the header and the list of frames (memoryviews)."""
+        raise NotImplementedError
+
+
+class BytesSerializer(Serializer):
+    name = 'bytes'
+
+    def encode(self, obj):
+        return {}, [obj]
+
+    def decode(self, header, frames):
+        return bytes(frames[0])
+
+
+class NumpySerializer(Serializer):
+    """Stores a NumPy array as its raw memory.
+
+    Arrays that are C or Fortran contiguous are written directly from their buffer.
+    The array returned by decode is a read-only view of the stored data (e.g., of a memory-mapped file).
+    """
+    name = 'numpy'
+
+    def encode(self, obj):
+        import numpy as np
+        if obj.dtype.hasobject:
+            raise ValueError('NumpySerializer does not support arrays with dtype object, use PickleSerializer instead.')
+        if obj.flags.c_contiguous:
+            fortran_order = False
+        elif obj.flags.f_contiguous:
+            fortran_order = True
+        else:
+            obj = np.ascontiguousarray(obj)
+            fortran_order = False
+        header = {'descr': np.lib.format.dtype_to_descr(obj.dtype),
+                  'shape': list(obj.shape),
+                  'fortran_order': fortran_order}
+        if obj.size == 0:
+            return header, [b'']
+        return header, [obj.reshape(-1, order='F' if fortran_order else 'C').view('u1')]
+
+    def decode(self, header, frames):
+        import numpy as np
+        dtype = np.lib.format.descr_to_dtype(header['descr'])
+        shape = tuple(header['shape'])
+        order = 'F' if header['fortran_order'] else 'C'
+        if len(frames[0]) == 0:
+            return np.empty(shape, dtype=dtype, order=order)
+        return np.frombuffer(frames[0], dtype=dtype).reshape(shape, order=order)
+
+
+class PickleSerializer(Serializer):
+    """Pickles objects with protocol 5 so that large buffers (e.g., NumPy arrays inside the object) are stored out of band.
+
+    On Python versions without protocol 5, the object is pickled in band with the highest available protocol.
+    """
+    name = 'pickle'
+
+    def encode(self, obj):
+        if pickle.HIGHEST_PROTOCOL >= 5:
+            buffers = []
+            data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+            return {}, [data] + [x.raw() for x in buffers]
+        else:
+            return {}, [pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)]
+
+    def decode(self, header, frames):
+        if len(frames) > 1:
+            return pickle.loads(frames[0], buffers=frames[1:])
+        else:
+            return pickle.loads(frames[0])
+
+
+SERIALIZERS = {}
+
+
+def register_serializer(serializer):
+    """Registers a serializer so that get_obj can decode objects written with it.
+
+    Args:
+        serializer (Serializer): The serializer instance. Its name must be unique.
+    """
+    assert serializer.name is not None
+    SERIALIZERS[serializer.name] = serializer
+
+
+for _serializer in [BytesSerializer(), NumpySerializer(), PickleSerializer()]:
+    register_serializer(_serializer)
+
+
+def get_serializer(serializer):
+    if isinstance(serializer, Serializer):
+        return serializer
+    if serializer not in SERIALIZERS:
+        raise ValueError(f'Unknown serializer "{serializer}". Registered serializers: {sorted(SERIALIZERS.keys())}.')
+    return SERIALIZERS[serializer]
+
+
+def infer_serializer(obj):
+    # Checking the type name avoids importing NumPy for objects that are not arrays
+    obj_type = type(obj)
+    if obj_type.__module__ == 'numpy' and obj_type.__name__ == 'ndarray':
+        return SERIALIZERS['numpy']
+    elif isinstance(obj, (bytes, bytearray)):
+        return SERIALIZERS['bytes']
+    else:
+        return SERIALIZERS['pickle']
+
+
+def serialize(obj, serializer=None):
+    """Serializes an object into a list of frames without copying the object's buffers.
+
+    Returns:
+        list of buffers: The frames that make up the serialized object when written back to back.
+    """
+    if serializer is None:
+        serializer = infer_serializer(obj)
+    else:
+        serializer = get_serializer(serializer)
+    header, frames = serializer.encode(obj)
+    frames = [as_byte_view(x) for x in frames]
+    full_header = {'serializer': serializer.name,
+                   'header': header,
+                   'frame_lengths': [x.nbytes for x in frames]}
+    header_bytes = json.dumps(full_header).encode('utf-8')
+    prefix_length = len(MAGIC) + struct.calcsize(HEADER_LENGTH_FORMAT) + len(header_bytes)
+    padding = (-prefix_length) % PAYLOAD_ALIGNMENT
+    prefix = MAGIC + struct.pack(HEADER_LENGTH_FORMAT, len(header_bytes) + padding) + header_bytes + b' ' * padding
+    return [prefix] + frames
+
+
+def deserialize(data, serializer=None):
+    """Deserializes an object from a buffer (bytes, memoryview, mmap) written by serialize.
+
+    The frames passed to the serializer are views into data, so no payload bytes are copied.
+    """
+    view = as_byte_view(data)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise ValueError('Data was not written by ObjectStash.put_obj (missing header).')
+    offset = len(MAGIC)
+    header_length, = struct.unpack_from(HEADER_LENGTH_FORMAT, view, offset)
+    offset += struct.calcsize(HEADER_LENGTH_FORMAT)
+    full_header = json.loads(bytes(view[offset:offset + header_length]).decode('utf-8'))
+    offset += header_length
+    frames = []
+    for length in full_header['frame_lengths']:
+        frames.append(view[offset:offset + length])
+        offset += length
+    if serializer is None:
+        serializer = get_serializer(full_header['serializer'])
+    else:
+        serializer = get_serializer(serializer)
+    return serializer.decode(full_header['header'], frames)
+
+
+def deserialize_file(filepath, serializer=None):
+    """Deserializes an object from a file by memory-mapping it, so arrays are backed by the page cache."""
+    with open(filepath, 'rb') as f:
+        if f.seek(0, 2) == 0:
+            raise ValueError(f'File {filepath} is empty.')
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return deserialize(mapped, serializer=serializer)
@@ -0,0 +1,385 @@
+import bisect
+import concurrent.futures
+import hashlib
+import threading
+
+from .bulk import BulkResult, pop_bulk_options, run_sequential
+from .metrics import Metrics
+from .storage_adapter import StorageAdapter, walk_keys
+from .tracing import submit_traced
+
+
+def stable_hash(text):
+    # Unlike hash(), this is the same in every process
+    return int.from_bytes(hashlib.md5(text.encode('utf-8')).digest()[:8], 'little')
+
+
+class HashRing:
+    """A consistent hash ring: adding a shard only moves about 1 / (number of shards) of the keys."""
+    def __init__(self, names, num_virtual_nodes=128):
+        self.names = list(names)
+        self.num_virtual_nodes = num_virtual_nodes
+        points = []
+        for name in self.names:
+            for ii in range(num_virtual_nodes):
+                points.append((stable_hash(f'{name}#{ii}'), name))
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.owners = [point[1] for point in points]
+
+    def owner(self, key):
+        pos = bisect.bisect(self.hashes, stable_hash(key))
+        return self.owners[pos % len(self.owners)]
+
+
+class ShardedAdapter(StorageAdapter):
+    """Spreads keys over several child adapters (e.g., S3Adapters for different buckets, or FSAdapters on
+    different disks) with consistent hashing.
+
+    Bulk operations are split by shard and the shards are accessed in parallel. list_keys merges the listings
+    of all shards. After add_shard, rebalance moves the keys that the new shard now owns; until it finished,
+    reads of keys that were not moved yet fall back to their previous shard, and writes delete the copy on the
+    previous shard so that rebalance does not move it over the new data.
+
+    Args:
+        shards (list of StorageAdapter or dictionary from string to StorageAdapter): The child adapters. The
+                names of the shards (default: "shard0", "shard1", ...) determine the placement of keys, so they
+                must stay the same when the stash is opened again.
+        num_virtual_nodes (int): The number of points per shard on the hash ring.
+    """
+    def __init__(self, shards, num_virtual_nodes=128, num_threads=None):
+        if not isinstance(shards, dict):
+            shards = {f'shard{ii}': shard for ii, shard in enumerate(shards)}
+        assert len(shards) > 0, 'Need at least one shard'
+        self.shards = dict(shards)
+        self.num_virtual_nodes = num_virtual_nodes
+        self.num_threads = num_threads
+        self.ring = HashRing(self.shards.keys(), num_virtual_nodes=num_virtual_nodes)
+        self.previous_ring = None
+        self.lock = threading.Lock()
+        self.metrics = Metrics()
+
+    def shard_name(self, key):
+        return self.ring.owner(key)
+
+    def shard_for(self, key):
+        return self.shards[self.ring.owner(key)]
+
+    def group_by_shard(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.ring.owner(key), []).append(key)
+        return groups
+
+    def run_per_shard(self, groups, fn):
+        # Calls fn(shard_adapter, items) for each shard in parallel and returns {shard name: result}
+        if len(groups) == 1:
+            name, items = next(iter(groups.items()))
+            return {name: fn(self.shards[name], items)}
+        num_threads = self.num_threads or len(groups)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = {name: submit_traced(executor, fn, self.shards[name], items) for name, items in groups.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    def previous_shard_for(self, key):
+        # Returns the shard that held the key before the last add_shard if a rebalance is in progress
+        previous_ring = self.previous_ring
+        if previous_ring is None:
+            return None
+        previous_name = previous_ring.owner(key)
+        if previous_name == self.ring.owner(key):
+            return None
+        return self.shards[previous_name]
+
+    def discard_previous(self, keys):
+        # Until the rebalance finished, a write leaves a stale copy on the previous shard, which rebalance would
+        # otherwise move over the new data
+        if self.previous_ring is None:
+            return
+        groups = {}
+        for key in keys:
+            if self.previous_shard_for(key) is not None:
+                groups.setdefault(self.previous_ring.owner(key), []).append(key)
+        def delete_existing(shard, cur_keys):
+            cur_keys = [key for key in cur_keys if shard.exists(key)]
+            if cur_keys:
+                shard.delete_multiple(cur_keys)
+        if groups:
+            self.run_per_shard(groups, delete_existing)
+
+    def add_trace_hook(self, hook):
+        for shard in self.shards.values():
+            if shard.metrics is not None:
+                shard.add_trace_hook(hook)
+
+    def remove_trace_hook(self, hook):
+        for shard in self.shards.values():
+            if shard.metrics is not None:
+                shard.remove_trace_hook(hook)
+
+    def backend_id(self):
+        return 'sharded(' + ','.join(f'{name}={shard.backend_id()}' for name, shard in self.shards.items()) + ')'
+
+    def flush(self):
+        for shard in self.shards.values():
+            shard.flush()
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+
+    def add_shard(self, adapter, name=None, rebalance=True):
+        """Adds a shard to the ring.
+
+        Args:
+            adapter (StorageAdapter): The new shard.
+            name (string, optional): The name of the shard (default: "shard<index>").
+            rebalance (bool): Whether to move the keys owned by the new shard right away. Otherwise call
+                    rebalance() later; reads fall back to the previous shard in the meantime.
+
+        Returns:
+            int: The number of keys moved.
+        """
+        if name is None:
+            name = f'shard{len(self.shards)}'
+        assert name not in self.shards, f'Shard {name} already exists'
+        with self.lock:
+            if self.previous_ring is None:
+                self.previous_ring = self.ring
+            self.shards[name] = adapter
+            self.ring = HashRing(self.shards.keys(), num_virtual_nodes=self.num_virtual_nodes)
+        if rebalance:
+            return self.rebalance()
+        return 0
+
+    def rebalance(self, prefix=''):
+        """Moves every key under the prefix to the shard that owns it on the current ring.
+
+        Returns:
+            int: The number of keys moved.
+        """
+        def move_keys(shard, name):
+            # copy_from lets shards of the same type copy without passing the data through memory
+            targets = {}
+            for key in walk_keys(shard, prefix):
+                owner = self.ring.owner(key)
+                if owner != name:
+                    targets.setdefault(owner, []).append(key)
+            moved = 0
+            for owner, keys in targets.items():
+                self.shards[owner].copy_from(shard, keys)
+                shard.delete_multiple(keys)
+                moved += len(keys)
+            return moved
+        groups = {name: name for name in self.shards.keys()}
+        moved = sum(self.run_per_shard(groups, move_keys).values())
+        self.metrics.increment('rebalanced_keys', moved)
+        if prefix == '':
+            self.previous_ring = None
+        return moved
+
+    def list_keys(self, prefix, **kwargs):
+        groups = {name: prefix for name in self.shards.keys()}
+        listings = self.run_per_shard(groups, lambda shard, cur_prefix: shard.list_keys(cur_prefix, **kwargs))
+        keys = set()
+        for listing in listings.values():
+            keys.update(listing)
+        return sorted(keys)
+
+    def list_sizes(self, prefix, **kwargs):
+        groups = {name: prefix for name in self.shards.keys()}
+        result = {}
+        for sizes in self.run_per_shard(groups, lambda shard, cur_prefix: shard.list_sizes(cur_prefix,
+                                                                                           **kwargs)).values():
+            result.update(sizes)
+        return result
+
+    def list_metadata(self, prefix, start_after=None, **kwargs):
+        groups = {name: prefix for name in self.shards.keys()}
+        result = {}
+        for metadata in self.run_per_shard(groups, lambda shard, cur_prefix: shard.list_metadata(
+                cur_prefix, start_after, **kwargs)).values():
+            result.update(metadata)
+        return result
+
+    def exists(self, key, **kwargs):
+        if self.shard_for(key).exists(key, **kwargs):
+            return True
+        previous = self.previous_shard_for(key)
+        return previous is not None and previous.exists(key, **kwargs)
+
+    def put(self, key, data, **kwargs):
+        result = self.shard_for(key).put(key, data, **kwargs)
+        self.discard_previous([key])
+        return result
+
+    def put_frames(self, key, frames, **kwargs):
+        result = self.shard_for(key).put_frames(key, frames, **kwargs)
+        self.discard_previous([key])
+        return result
+
+    def put_stream(self, key, source, **kwargs):
+        result = self.shard_for(key).put_stream(key, source, **kwargs)
+        self.discard_previous([key])
+        return result
+
+    def put_multiple(self, data_dict, **kwargs):
+        groups = self.group_by_shard(data_dict.keys())
+        self.run_per_shard(groups, lambda shard, keys: shard.put_multiple({key: data_dict[key] for key in keys},
+                                                                          **kwargs))
+        self.discard_previous(data_dict.keys())
+
+    def upload_file(self, key, filename, **kwargs):
+        result = self.shard_for(key).upload_file(key, filename, **kwargs)
+        self.discard_previous([key])
+        return result
+
+    def get(self, key, **kwargs):
+        previous = self.previous_shard_for(key)
+        if previous is None or self.shard_for(key).exists(key):
+            return self.shard_for(key).get(key, **kwargs)
+        return previous.get(key, **kwargs)
+
+    def group_for_read(self, keys):
+        if self.previous_ring is None:
+            return self.group_by_shard(keys)
+        # The keys that were not moved yet are read from their previous shard
+        groups = {}
+        for key in keys:
+            previous = self.previous_shard_for(key)
+            if previous is not None and not self.shard_for(key).exists(key):
+                name = self.previous_ring.owner(key)
+            else:
+                name = self.ring.owner(key)
+            groups.setdefault(name, []).append(key)
+        return groups
+
+    def get_multiple(self, keys, **kwargs):
+        groups = self.group_for_read(keys)
+        result = BulkResult()
+        for shard_result in self.run_per_shard(groups, lambda shard, cur_keys: shard.get_multiple(cur_keys,
+                                                                                                  **kwargs)).values():
+            result.update(shard_result)
+            result.errors.update(getattr(shard_result, 'errors', {}))
+        return result
+
+    def get_into(self, key, buffer, **kwargs):
+        previous = self.previous_shard_for(key)
+        if previous is None or self.shard_for(key).exists(key):
+            return self.shard_for(key).get_into(key, buffer, **kwargs)
+        return previous.get_into(key, buffer, **kwargs)
+
+    def get_multiple_into(self, buffers, **kwargs):
+        groups = self.group_for_read(buffers.keys())
+        def get_shard_into(shard, cur_keys):
+            return shard.get_multiple_into({key: buffers[key] for key in cur_keys}, **kwargs)
+        result = BulkResult()
+        for shard_result in self.run_per_shard(groups, get_shard_into).values():
+            result.update(shard_result)
+            result.errors.update(getattr(shard_result, 'errors', {}))
+        return result
+
+    def get_local_path(self, key, **kwargs):
+        previous = self.previous_shard_for(key)
+        if previous is None or self.shard_for(key).exists(key):
+            return self.shard_for(key).get_local_path(key, **kwargs)
+        return previous.get_local_path(key, **kwargs)
+
+    def get_local_paths(self, keys, **kwargs):
+        result = {}
+        groups = self.group_for_read(keys)
+        for shard_result in self.run_per_shard(groups, lambda shard, cur_keys: shard.get_local_paths(cur_keys,
+                                                                                                     **kwargs)).values():
+            result.update(shard_result)
+        return result
+
+    def get_ranges(self, ranges, **kwargs):
+        owners = {}
+        for name, keys in self.group_for_read(dict.fromkeys(key for key, _, _ in ranges)).items():
+            for key in keys:
+                owners[key] = name
+        groups = {}
+        for ii, (key, _, _) in enumerate(ranges):
+            groups.setdefault(owners[key], []).append(ii)
+        def get_shard_ranges(shard, indices):
+            return shard.get_ranges([ranges[ii] for ii in indices], **kwargs)
+        shard_results = self.run_per_shard(groups, get_shard_ranges)
+        result = [None] * len(ranges)
+        for name, indices in groups.items():
+            for ii, data in zip(indices, shard_results[name]):
+                result[ii] = data
+        return result
+
+    def download_file(self, key, filename, **kwargs):
+        previous = self.previous_shard_for(key)
+        if previous is None or self.shard_for(key).exists(key):
+            return self.shard_for(key).download_file(key, filename, **kwargs)
+        return previous.download_file(key, filename, **kwargs)
+
+    def merge_errors(self, shard_results):
+        # Bulk writes with on_error='collect' return {key: exception} per shard
+        errors = {}
+        for shard_errors in shard_results.values():
+            errors.update(shard_errors or {})
+        return errors
+
+    def download_multiple(self, filenames, **kwargs):
+        groups = self.group_for_read(filenames.keys())
+        return self.merge_errors(self.run_per_shard(groups, lambda shard, cur_keys: shard.download_multiple(
+            {key: filenames[key] for key in cur_keys}, **kwargs)))
+
+    def same_shard(self, src, dst):
+        # Whether a copy from src to dst can stay inside one shard
+        return self.previous_shard_for(src) is None and self.ring.owner(src) == self.ring.owner(dst)
+
+    def copy(self, src, dst, **kwargs):
+        if self.same_shard(src, dst):
+            self.shard_for(src).copy(src, dst, **kwargs)
+        else:
+            self.shard_for(dst).put(dst, self.get(src, **kwargs), **kwargs)
+        self.discard_previous([dst])
+
+    def copy_multiple(self, pairs, **kwargs):
+        groups = {}
+        other_srcs = []
+        for src, dst in pairs.items():
+            if self.same_shard(src, dst):
+                groups.setdefault(self.ring.owner(src), []).append(src)
+            else:
+                other_srcs.append(src)
+        errors = {}
+        if groups:
+            errors.update(self.merge_errors(self.run_per_shard(groups, lambda shard, srcs: shard.copy_multiple(
+                {src: pairs[src] for src in srcs}, **kwargs))))
+        if other_srcs:
+            copy_kwargs = dict(kwargs)
+            on_error, deadline = pop_bulk_options(copy_kwargs)
+            errors.update(run_sequential(lambda src: self.copy(src, pairs[src], **copy_kwargs), other_srcs,
+                                         on_error=on_error, deadline=deadline).errors)
+        self.discard_previous(dst for src, dst in pairs.items() if src not in errors)
+        return errors
+
+    def move(self, src, dst, **kwargs):
+        if self.same_shard(src, dst):
+            self.shard_for(src).move(src, dst, **kwargs)
+            self.discard_previous([dst])
+            return
+        self.copy(src, dst, **kwargs)
+        self.delete(src, **kwargs)
+
+    def delete(self, key, **kwargs):
+        previous = self.previous_shard_for(key)
+        if previous is not None and previous.exists(key):
+            previous.delete(key, **kwargs)
+            if not self.shard_for(key).exists(key):
+                return
+        return self.shard_for(key).delete(key, **kwargs)
+
+    def delete_multiple(self, keys, **kwargs):
+        if self.previous_ring is not None:
+            on_error, deadline = pop_bulk_options(kwargs)
+            return run_sequential(lambda key: self.delete(key, **kwargs), keys,
+                                  on_error=on_error, deadline=deadline).errors
+        groups = self.group_by_shard(keys)
+        return self.merge_errors(self.run_per_shard(groups, lambda shard, cur_keys: shard.delete_multiple(cur_keys,
+                                                                                                        **kwargs)))
@@ -0,0 +1,381 @@
+import contextlib
+import hashlib
+import mmap
+import os
+import pathlib
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the shared cache cannot be used
+    fcntl = None
+
+from .frames import as_byte_view, copy_into
+from .local_files import create_temp_file
+from .metrics import Metrics
+from .storage_adapter import StorageAdapter
+
+
+def default_shared_cache_dir():
+    # /dev/shm is a RAM-backed file system on Linux, so the entries are shared memory
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm/objectstash'
+    return os.path.join(tempfile.gettempdir(), 'objectstash-shared-cache')
+
+
+# The header of the index file holds the total size of the entries (an int64), updated under the file lock
+INDEX_HEADER = struct.Struct('<q')
+# Last-access times are updated at most this often per entry, so that hits rarely write metadata
+ACCESS_TIME_RESOLUTION = 1.0
+# Eviction removes the least recently used entries until the cache is at this fraction of max_bytes
+EVICTION_TARGET = 0.9
+
+
+class SharedMemoryCache:
+    """A host-level object cache that all processes using the same directory share.
+
+    Each entry is a file in the cache directory (by default on the RAM-backed /dev/shm). Readers map entries
+    into memory, so a hit is a zero-copy, read-only view that stays valid even if the entry is evicted or
+    replaced later. The shared index (a small file holding the total size, locked with flock) and the last-access
+    times of the entry files let every process enforce the byte limit with LRU eviction.
+
+    Args:
+        directory (string or pathlib.Path, optional): The cache directory (default: /dev/shm/objectstash).
+        max_bytes (int): The largest total size of the entries.
+        max_object_bytes (int, optional): Larger objects are not cached (default: max_bytes / 8).
+    """
+    def __init__(self, directory=None, max_bytes=2 ** 30, max_object_bytes=None):
+        if fcntl is None:
+            raise RuntimeError('The shared cache needs POSIX file locks (fcntl), which this platform does not have.')
+        self.directory = pathlib.Path(directory if directory is not None else default_shared_cache_dir())
+        self.entry_dir = self.directory / 'entries'
+        self.entry_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes if max_object_bytes is not None else max_bytes // 8
+        self.thread_lock = threading.Lock()
+        self.index_fd = None
+        self.index_pid = None
+        with self.locked():
+            if os.fstat(self.index_fd).st_size < INDEX_HEADER.size:
+                os.pwrite(self.index_fd, INDEX_HEADER.pack(0), 0)
+
+    def __getstate__(self):
+        # Another process opens the same directory
+        return {'directory': self.directory, 'max_bytes': self.max_bytes, 'max_object_bytes': self.max_object_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def close(self):
+        with self.thread_lock:
+            if self.index_fd is not None and self.index_pid == os.getpid():
+                os.close(self.index_fd)
+            self.index_fd = None
+            self.index_pid = None
+
+    def entry_path(self, key):
+        return self.entry_dir / hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @contextlib.contextmanager
+    def locked(self):
+        # flock only excludes other open files, so threads of this process also take a thread lock
+        with self.thread_lock:
+            if self.index_pid != os.getpid():
+                # A forked child would share the open file (and so the lock) with its parent
+                self.index_fd = os.open(self.directory / 'index', os.O_RDWR | os.O_CREAT, 0o666)
+                self.index_pid = os.getpid()
+            fcntl.flock(self.index_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.index_fd, fcntl.LOCK_UN)
+
+    def read_total(self):
+        return INDEX_HEADER.unpack(os.pread(self.index_fd, INDEX_HEADER.size, 0))[0]
+
+    def write_total(self, total):
+        os.pwrite(self.index_fd, INDEX_HEADER.pack(max(0, total)), 0)
+
+    def total_bytes(self):
+        with self.locked():
+            return self.read_total()
+
+    def get_view(self, key):
+        # Returns a read-only memoryview of the cached data, or None if the key is not cached
+        try:
+            fd = os.open(self.entry_path(key), os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            stat = os.fstat(fd)
+            now = time.time()
+            if now - stat.st_atime > ACCESS_TIME_RESOLUTION:
+                # Keeps the modification time (the insertion time) and records the access for LRU eviction
+                try:
+                    os.utime(fd, (now, stat.st_mtime))
+                except PermissionError:
+                    # Entries written by another user
+                    pass
+            if stat.st_size == 0:
+                return memoryview(b'')
+            return memoryview(mmap.mmap(fd, stat.st_size, access=mmap.ACCESS_READ))
+        finally:
+            os.close(fd)
+
+    def put(self, key, data):
+        # Stores data (any buffer) and returns whether it was cached
+        view = as_byte_view(data)
+        if view.nbytes > self.max_object_bytes:
+            return False
+        fpath = self.entry_path(key)
+        # Entries are created with the usual permissions, so that processes of other users can read them
+        fd, tmp_path = create_temp_file(self.entry_dir, fpath.name)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(view)
+            with self.locked():
+                try:
+                    old_size = os.stat(fpath).st_size
+                except FileNotFoundError:
+                    old_size = 0
+                os.replace(tmp_path, fpath)
+                total = self.read_total() + view.nbytes - old_size
+                if total > self.max_bytes:
+                    total = self.evict_locked(int(self.max_bytes * EVICTION_TARGET))
+                self.write_total(total)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return True
+
+    def invalidate(self, key):
+        fpath = self.entry_path(key)
+        with self.locked():
+            try:
+                size = os.stat(fpath).st_size
+                os.unlink(fpath)
+            except FileNotFoundError:
+                return False
+            self.write_total(self.read_total() - size)
+        return True
+
+    def evict_locked(self, target_bytes):
+        # Must be called with the index lock held. Recomputes the total from the entry files (which also
+        # repairs the total after a process died between writing an entry and updating the index) and removes
+        # the least recently used entries. Returns the new total.
+        entries = []
+        for entry in os.scandir(self.entry_dir):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        for _, size, path in entries:
+            if total <= target_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+    def clear(self):
+        with self.locked():
+            self.evict_locked(0)
+            self.write_total(0)
+
+
+class SharedCacheAdapter(StorageAdapter):
+    """Serves hot objects from a SharedMemoryCache that all processes on the host share, and reads the others
+    from a child adapter.
+
+    Reads fill the cache, and writes through this adapter remove the written keys from it, so other processes
+    do not see outdated data. Writes that bypass the cache (e.g., from other hosts) are not detected, so the
+    cache is meant for data that does not change while it is being read (datasets, checkpoints). Entries are
+    keyed by the back-end (see StorageAdapter.backend_id) and the key, so stashes of different buckets or root
+    directories can share one cache directory.
+    """
+    def __init__(self, adapter, cache):
+        self.adapter = adapter
+        self.cache = cache
+        # Stashes of different back-ends may share the cache directory, so the entries are keyed by both
+        self.namespace = adapter.backend_id()
+        # The cache counters are recorded next to the operations of the child adapter, if it records metrics
+        self.metrics = adapter.metrics if adapter.metrics is not None else Metrics()
+
+    def cache_key(self, key):
+        return f'{self.namespace}\n{key}'
+
+    def lookup(self, key):
+        view = self.cache.get_view(self.cache_key(key))
+        self.metrics.increment('shared_cache_hits' if view is not None else 'shared_cache_misses')
+        return view
+
+    def invalidate(self, keys):
+        for key in keys:
+            if self.cache.invalidate(self.cache_key(key)):
+                self.metrics.increment('shared_cache_evictions')
+
+    def flush(self):
+        self.adapter.flush()
+
+    def close(self):
+        self.adapter.close()
+        self.cache.close()
+
+    def list_keys(self, prefix, **kwargs):
+        return self.adapter.list_keys(prefix, **kwargs)
+
+    def list_sizes(self, prefix, **kwargs):
+        return self.adapter.list_sizes(prefix, **kwargs)
+
+    def list_metadata(self, prefix, start_after=None, **kwargs):
+        return self.adapter.list_metadata(prefix, start_after, **kwargs)
+
+    def exists(self, key, **kwargs):
+        return self.adapter.exists(key, **kwargs)
+
+    def put(self, key, data, **kwargs):
+        self.adapter.put(key, data, **kwargs)
+        self.invalidate([key])
+
+    def put_frames(self, key, frames, **kwargs):
+        self.adapter.put_frames(key, frames, **kwargs)
+        self.invalidate([key])
+
+    def put_stream(self, key, source, **kwargs):
+        self.adapter.put_stream(key, source, **kwargs)
+        self.invalidate([key])
+
+    def put_multiple(self, data_dict, **kwargs):
+        self.adapter.put_multiple(data_dict, **kwargs)
+        self.invalidate(data_dict.keys())
+
+    def upload_file(self, key, filename, **kwargs):
+        self.adapter.upload_file(key, filename, **kwargs)
+        self.invalidate([key])
+
+    def get_view(self, key, **kwargs):
+        view = self.lookup(key)
+        if view is not None:
+            return view
+        data = self.adapter.get(key, **kwargs)
+        if self.cache.put(self.cache_key(key), data):
+            cached = self.cache.get_view(self.cache_key(key))
+            if cached is not None:
+                return cached
+        return memoryview(data)
+
+    def get_cached_and_missing(self, keys, kwargs):
+        # Returns the cached views and the data of the other keys, which is read from the child adapter
+        callback = kwargs.get('callback', None)
+        views = {}
+        missing = []
+        for key in keys:
+            view = self.lookup(key)
+            if view is None:
+                missing.append(key)
+            else:
+                views[key] = view
+                if callback:
+                    callback(1)
+        fetched = self.adapter.get_multiple(missing, **kwargs) if missing else {}
+        for key, data in fetched.items():
+            self.cache.put(self.cache_key(key), data)
+        return views, fetched
+
+    def get_multiple_views(self, keys, **kwargs):
+        views, fetched = self.get_cached_and_missing(keys, kwargs)
+        for key, data in fetched.items():
+            cached = self.cache.get_view(self.cache_key(key))
+            views[key] = cached if cached is not None else memoryview(data)
+        return views
+
+    def get(self, key, **kwargs):
+        view = self.lookup(key)
+        if view is not None:
+            return bytes(view)
+        data = self.adapter.get(key, **kwargs)
+        self.cache.put(self.cache_key(key), data)
+        return data
+
+    def get_multiple(self, keys, **kwargs):
+        views, fetched = self.get_cached_and_missing(keys, kwargs)
+        fetched.update({key: bytes(view) for key, view in views.items()})
+        return fetched
+
+    def get_into(self, key, buffer, **kwargs):
+        view = self.lookup(key)
+        if view is not None:
+            return copy_into(view, buffer)
+        num_bytes = self.adapter.get_into(key, buffer, **kwargs)
+        self.cache.put(self.cache_key(key), as_byte_view(buffer)[:num_bytes])
+        return num_bytes
+
+    def get_ranges(self, ranges, **kwargs):
+        result = [None] * len(ranges)
+        missing = []
+        for ii, (key, start, length) in enumerate(ranges):
+            view = self.cache.get_view(self.cache_key(key))
+            if view is not None:
+                result[ii] = bytes(view[start:start + length])
+            else:
+                missing.append(ii)
+        if missing:
+            for ii, data in zip(missing, self.adapter.get_ranges([ranges[ii] for ii in missing], **kwargs)):
+                result[ii] = data
+        return result
+
+    def get_local_path(self, key, **kwargs):
+        return self.adapter.get_local_path(key, **kwargs)
+
+    def get_local_paths(self, keys, **kwargs):
+        return self.adapter.get_local_paths(keys, **kwargs)
+
+    def download_file(self, key, filename, **kwargs):
+        return self.adapter.download_file(key, filename, **kwargs)
+
+    def download_multiple(self, filenames, **kwargs):
+        return self.adapter.download_multiple(filenames, **kwargs)
+
+    def copy(self, src, dst, **kwargs):
+        self.adapter.copy(src, dst, **kwargs)
+        self.invalidate([dst])
+
+    def copy_multiple(self, pairs, **kwargs):
+        errors = self.adapter.copy_multiple(pairs, **kwargs)
+        self.invalidate(pairs.values())
+        return errors
+
+    def move(self, src, dst, **kwargs):
+        self.adapter.move(src, dst, **kwargs)
+        self.invalidate([src, dst])
+
+    def move_multiple(self, pairs, **kwargs):
+        errors = self.adapter.move_multiple(pairs, **kwargs)
+        self.invalidate(list(pairs.keys()) + list(pairs.values()))
+        return errors
+
+    def copy_prefix(self, src_prefix, dst_prefix, **kwargs):
+        num_keys = self.adapter.copy_prefix(src_prefix, dst_prefix, **kwargs)
+        self.invalidate(dst_prefix + key[len(src_prefix):] for key in self.adapter.list_sizes(src_prefix))
+        return num_keys
+
+    def delete(self, key, **kwargs):
+        self.adapter.delete(key, **kwargs)
+        self.invalidate([key])
+
+    def delete_multiple(self, keys, **kwargs):
+        errors = self.adapter.delete_multiple(keys, **kwargs)
+        self.invalidate(keys)
+        return errors
@@ -1,6 +1,28 @@
+import uuid
 from abc import ABC, abstractmethod
+
+from .bulk import pop_bulk_options, run_sequential
+from .frames import copy_into
+from .streaming import read_all
+
+
+def walk_keys(adapter, prefix=''):
+    # Lists all keys under the prefix by descending into the "directories" returned by list_keys
+    keys = []
+    pending = [prefix]
+    while pending:
+        for entry in adapter.list_keys(pending.pop()):
+            if entry.endswith('/'):
+                pending.append(entry)
+            else:
+                keys.append(entry)
+    return keys
+
  
 class StorageAdapter(ABC):
+    # Adapters that record operation latencies and counters set this to a Metrics object
+    metrics = None
+
     @abstractmethod
     def list_keys(self, prefix, **kwargs):
         pass
@@ -39,4 +61,130 @@ class StorageAdapter(ABC):
 
     @abstractmethod
     def delete_multiple(self, keys, **kwargs):
-        pass
\ No newline at end of file
+        pass
+
+    def backend_id(self):
+        # Identifies the stored data (e.g., the bucket or root directory), so that caches shared by several
+        # stashes keep the entries of different back-ends apart. Adapters without such an identity get one per
+        # instance, whose entries are never shared.
+        if 'instance_id' not in self.__dict__:
+            self.instance_id = f'{type(self).__name__}:{uuid.uuid4().hex}'
+        return self.instance_id
+
+    def put_frames(self, key, frames, **kwargs):
+        # Stores the concatenation of a list of buffers. Adapters should override this to avoid the copy.
+        return self.put(key, b''.join(frames), **kwargs)
+
+    def put_stream(self, key, source, **kwargs):
+        # Stores the data of a file-like object or an iterable of chunks. Adapters should override this
+        # to avoid holding the entire data in memory.
+        return self.put(key, read_all(source), **kwargs)
+
+    def get_local_path(self, key, **kwargs):
+        # Returns a local file containing the data for the key, or None if the adapter has no local copy
+        return None
+
+    def get_ranges(self, ranges, **kwargs):
+        # Reads a list of (key, start, length) byte ranges. Adapters should override this to avoid reading full objects.
+        return [self.get(key, **kwargs)[start:start + length] for key, start, length in ranges]
+
+    def get_into(self, key, buffer, **kwargs):
+        # Reads the data for a key into a writable buffer and returns the number of bytes written.
+        # Adapters should override this to avoid the intermediate bytes object.
+        return copy_into(self.get(key, **kwargs), buffer)
+
+    def get_view(self, key, **kwargs):
+        # Returns a read-only buffer of the data for a key. Adapters backed by shared memory return it without a copy.
+        return memoryview(self.get(key, **kwargs))
+
+    def get_multiple_views(self, keys, **kwargs):
+        return {key: memoryview(data) for key, data in self.get_multiple(keys, **kwargs).items()}
+
+    def get_multiple_into(self, buffers, **kwargs):
+        callback = kwargs.pop('callback', None)
+        on_error, deadline = pop_bulk_options(kwargs)
+        return run_sequential(lambda key: self.get_into(key, buffers[key], **kwargs), buffers.keys(),
+                              on_error=on_error, deadline=deadline, callback=callback)
+
+    def get_local_paths(self, keys, **kwargs):
+        return {key: self.get_local_path(key, **kwargs) for key in keys}
+
+    def list_sizes(self, prefix, **kwargs):
+        # Returns {key: size in bytes} for all keys under the prefix, including nested "directories".
+        # Adapters should override this to avoid reading the data.
+        sizes = {}
+        for key in walk_keys(self, prefix):
+            local_path = self.get_local_path(key)
+            sizes[key] = local_path.stat().st_size if local_path is not None else len(self.get(key, **kwargs))
+        return sizes
+
+    def list_metadata(self, prefix, start_after=None, **kwargs):
+        # Returns {key: {'Size', 'ETag'}} for all keys under the prefix (only keys after start_after if given).
+        # The default has no ETags; adapters should override this to list both in one pass.
+        return {key: {'Size': size, 'ETag': None} for key, size in self.list_sizes(prefix, **kwargs).items()
+                if start_after is None or key.encode('utf-8') > start_after.encode('utf-8')}
+
+    def download_multiple(self, filenames, **kwargs):
+        # filenames maps keys to local target files. Returns {key: exception} for the keys that failed with
+        # on_error='collect' (see run_bulk), like the other bulk writes below.
+        callback = kwargs.pop('callback', None)
+        on_error, deadline = pop_bulk_options(kwargs)
+        return run_sequential(lambda key: self.download_file(key, filenames[key], **kwargs), filenames.keys(),
+                              on_error=on_error, deadline=deadline, callback=callback).errors
+
+    def copy(self, src, dst, **kwargs):
+        # Copies the data of one key to another. Adapters should override this to copy without transferring
+        # the data to the client.
+        return self.put(dst, self.get(src, **kwargs), **kwargs)
+
+    def copy_multiple(self, pairs, **kwargs):
+        # pairs maps source keys to destination keys
+        on_error, deadline = pop_bulk_options(kwargs)
+        return run_sequential(lambda src: self.copy(src, pairs[src], **kwargs), pairs.keys(),
+                              on_error=on_error, deadline=deadline).errors
+
+    def copy_from(self, source, keys, **kwargs):
+        # Copies keys from another adapter (source) to the same keys in this one. Keys that the source has as
+        # local files are uploaded from the file, the others pass through memory one at a time. Adapters
+        # override this to copy from adapters of their own type without the client (e.g., between buckets).
+        on_error, deadline = pop_bulk_options(kwargs)
+        def copy_key(key):
+            local_path = source.get_local_path(key)
+            if local_path is not None:
+                self.upload_file(key, local_path, **kwargs)
+            else:
+                self.put(key, source.get(key), **kwargs)
+        return run_sequential(copy_key, keys, on_error=on_error, deadline=deadline).errors
+
+    def move(self, src, dst, **kwargs):
+        self.copy(src, dst, **kwargs)
+        self.delete(src, **kwargs)
+
+    def move_multiple(self, pairs, **kwargs):
+        # Only sources that were copied are deleted
+        errors = dict(self.copy_multiple(pairs, **kwargs) or {})
+        errors.update(self.delete_multiple([src for src in pairs.keys() if src not in errors], **kwargs) or {})
+        return errors
+
+    def copy_prefix(self, src_prefix, dst_prefix, **kwargs):
+        # Copies every key under src_prefix to the same key with src_prefix replaced by dst_prefix.
+        # Returns the number of keys copied.
+        pairs = {key: dst_prefix + key[len(src_prefix):] for key in walk_keys(self, src_prefix)}
+        errors = self.copy_multiple(pairs, **kwargs) or {}
+        return len(pairs) - len(errors)
+
+    def flush(self):
+        # Adapters that buffer writes (e.g., TieredAdapter with write-back) store the buffered data here
+        pass
+
+    def close(self):
+        self.flush()
+
+    def add_trace_hook(self, hook):
+        # Registers a TraceHook that observes every back-end call
+        assert self.metrics is not None, 'This adapter does not support trace hooks'
+        self.metrics.add_hook(hook)
+
+    def remove_trace_hook(self, hook):
+        assert self.metrics is not None, 'This adapter does not support trace hooks'
+        self.metrics.remove_hook(hook)
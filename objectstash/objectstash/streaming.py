@@ -0,0 +1,53 @@
+DEFAULT_CHUNK_SIZE = 2 ** 20
+
+
+def is_stream_like(x):
+    # File-like objects and iterables of chunks (but not a single buffer or a string)
+    if hasattr(x, 'read'):
+        return True
+    if isinstance(x, (str, dict)):
+        return False
+    try:
+        # Buffers (e.g., bytes, NumPy arrays, array.array) are iterable, but hold the data in one piece
+        memoryview(x)
+        return False
+    except TypeError:
+        pass
+    try:
+        iter(x)
+        return True
+    except TypeError:
+        return False
+
+
+def iter_chunks(source, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Yields the data of a file-like object or an iterable of chunks as it arrives
+    if hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for chunk in source:
+            if len(chunk) > 0:
+                yield chunk
+
+
+def iter_parts(source, part_size):
+    # Regroups the chunks of a stream into parts of exactly part_size bytes (the last part may be smaller)
+    buffer = bytearray()
+    for chunk in iter_chunks(source, chunk_size=part_size):
+        if not buffer and len(chunk) == part_size:
+            yield bytes(chunk)
+            continue
+        buffer += chunk
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def read_all(source):
+    return b''.join(iter_chunks(source))
@@ -0,0 +1,402 @@
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+
+from .bulk import BulkResult, pop_bulk_options, run_sequential
+from .frames import frames_nbytes
+from .metrics import Metrics
+from .storage_adapter import StorageAdapter
+from .tracing import submit_traced
+
+
+WRITE_POLICIES = ['write_through', 'write_back']
+
+
+def delimited_keys(keys, prefix):
+    # Mimics the listing semantics of the adapters: keys directly under the prefix, and one entry
+    # ending in "/" for each deeper level
+    result = set()
+    for key in keys:
+        if not key.startswith(prefix):
+            continue
+        pos = key.find('/', len(prefix))
+        result.add(key if pos < 0 else key[:pos + 1])
+    return result
+
+
+class TieredAdapter(StorageAdapter):
+    """Combines a fast hot tier (e.g., an FSAdapter on a local NVMe disk) with a cold tier (e.g., an S3Adapter).
+
+    The cold tier is the authoritative copy. Keys read from the cold tier are promoted to the hot tier, and keys
+    are demoted (removed from the hot tier) in least-recently-used order when the hot tier holds more than
+    max_hot_bytes, or when they have not been accessed for max_hot_age seconds.
+
+    With the "write_through" policy, put writes to the cold tier and then to the hot tier. With "write_back",
+    put only writes to the hot tier and marks the key dirty; dirty keys are written to the cold tier when they
+    are demoted and by flush() / close(). list_keys and exists include dirty keys, so both policies give the
+    same view of the stash.
+
+    The adapter tracks which keys it placed in the hot tier, so the hot tier must not be shared with other
+    writers. Data found in the hot tier from an earlier run is not used.
+    """
+    def __init__(self, hot, cold, *,
+                 write_policy='write_through',
+                 promote_on_get=True,
+                 max_hot_bytes=None,
+                 max_hot_age=None,
+                 num_threads=8):
+        if write_policy not in WRITE_POLICIES:
+            raise ValueError(f'Unknown write policy "{write_policy}". Must be one of {WRITE_POLICIES}.')
+        self.hot = hot
+        self.cold = cold
+        self.write_policy = write_policy
+        self.promote_on_get = promote_on_get
+        self.max_hot_bytes = max_hot_bytes
+        self.max_hot_age = max_hot_age
+        self.num_threads = num_threads
+        self.metrics = Metrics()
+        self.lock = threading.Lock()
+        # Maps keys in the hot tier to [size, last access time], in least-recently-used order
+        self.resident = collections.OrderedDict()
+        self.hot_bytes = 0
+        # Keys whose latest data is only in the hot tier (write-back policy)
+        self.dirty = set()
+        # Striped locks that serialize writes, promotions and demotions of the same key
+        self.key_locks = [threading.Lock() for _ in range(64)]
+
+    def key_lock(self, key):
+        return self.key_locks[hash(key) % len(self.key_locks)]
+
+    def add_trace_hook(self, hook):
+        for adapter in [self.hot, self.cold]:
+            if adapter.metrics is not None:
+                adapter.add_trace_hook(hook)
+
+    def remove_trace_hook(self, hook):
+        for adapter in [self.hot, self.cold]:
+            if adapter.metrics is not None:
+                adapter.remove_trace_hook(hook)
+
+    def is_resident(self, key, touch=True):
+        with self.lock:
+            entry = self.resident.get(key)
+            if entry is None:
+                return False
+            if touch:
+                entry[1] = time.time()
+                self.resident.move_to_end(key)
+            return True
+
+    def register(self, key, size, dirty):
+        # Must be called with the key lock held
+        with self.lock:
+            if key in self.resident:
+                self.hot_bytes -= self.resident[key][0]
+            self.resident[key] = [size, time.time()]
+            self.resident.move_to_end(key)
+            self.hot_bytes += size
+            if dirty:
+                self.dirty.add(key)
+            else:
+                self.dirty.discard(key)
+
+    def unregister(self, key):
+        # Must be called with the key lock held. Returns whether the key was dirty.
+        with self.lock:
+            entry = self.resident.pop(key, None)
+            if entry is not None:
+                self.hot_bytes -= entry[0]
+            was_dirty = key in self.dirty
+            self.dirty.discard(key)
+            return was_dirty
+
+    def fits_hot(self, size):
+        return self.max_hot_bytes is None or size <= self.max_hot_bytes
+
+    def store(self, key, size, write_hot, write_cold):
+        # Writes new data for a key according to the write policy
+        if self.write_policy == 'write_back' and self.fits_hot(size):
+            with self.key_lock(key):
+                write_hot()
+                self.register(key, size, dirty=True)
+        else:
+            with self.key_lock(key):
+                write_cold()
+                if self.fits_hot(size):
+                    write_hot()
+                    self.register(key, size, dirty=False)
+                else:
+                    self.drop_hot_copy(key)
+        self.enforce_limits()
+
+    def promote(self, key, data):
+        if not self.promote_on_get or not self.fits_hot(len(data)):
+            return
+        with self.key_lock(key):
+            # A concurrent put already placed newer data in the hot tier
+            if self.is_resident(key, touch=False):
+                return
+            self.hot.put(key, data)
+            self.register(key, len(data), dirty=False)
+        self.metrics.increment('promotions')
+
+    def delete_hot_copy(self, key):
+        try:
+            self.hot.delete(key)
+        except FileNotFoundError:
+            pass
+
+    def drop_hot_copy(self, key):
+        # Must be called with the key lock held. Returns whether the key was dirty.
+        with self.lock:
+            resident = key in self.resident
+        was_dirty = self.unregister(key)
+        if resident:
+            self.delete_hot_copy(key)
+        return was_dirty
+
+    def demote_key(self, key):
+        with self.key_lock(key):
+            with self.lock:
+                if key not in self.resident:
+                    return
+                is_dirty = key in self.dirty
+            if is_dirty:
+                self.cold.put(key, self.hot.get(key))
+                self.metrics.increment('write_backs')
+            self.unregister(key)
+            self.delete_hot_copy(key)
+        self.metrics.increment('demotions')
+
+    def demote(self, max_age=None):
+        """Demotes keys that were not accessed for max_age seconds (default: max_hot_age).
+
+        Returns:
+            [list of strings]: The demoted keys.
+        """
+        if max_age is None:
+            max_age = self.max_hot_age
+        if max_age is None:
+            return []
+        cutoff = time.time() - max_age
+        victims = []
+        with self.lock:
+            for key, (_, last_access) in self.resident.items():
+                if last_access > cutoff:
+                    break
+                victims.append(key)
+        for key in victims:
+            self.demote_key(key)
+        return victims
+
+    def enforce_limits(self):
+        self.demote()
+        if self.max_hot_bytes is None:
+            return
+        while True:
+            with self.lock:
+                if self.hot_bytes <= self.max_hot_bytes or not self.resident:
+                    return
+                key = next(iter(self.resident))
+            self.demote_key(key)
+
+    def backend_id(self):
+        # The cold tier is the authoritative copy
+        return self.cold.backend_id()
+
+    def flush(self):
+        """Writes all dirty keys to the cold tier."""
+        with self.lock:
+            keys = list(self.dirty)
+        def write_back(key):
+            with self.key_lock(key):
+                with self.lock:
+                    if key not in self.dirty:
+                        return
+                self.cold.put(key, self.hot.get(key))
+                with self.lock:
+                    self.dirty.discard(key)
+            self.metrics.increment('write_backs')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            futures = [submit_traced(executor, write_back, key) for key in keys]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+
+    def close(self):
+        self.flush()
+
+    def list_keys(self, prefix, **kwargs):
+        keys = set(self.cold.list_keys(prefix, **kwargs))
+        with self.lock:
+            dirty = list(self.dirty)
+        keys |= delimited_keys(dirty, prefix)
+        return sorted(keys)
+
+    def list_sizes(self, prefix, **kwargs):
+        sizes = self.cold.list_sizes(prefix, **kwargs)
+        with self.lock:
+            for key in self.dirty:
+                if key.startswith(prefix) and key in self.resident:
+                    sizes[key] = self.resident[key][0]
+        return sizes
+
+    def list_metadata(self, prefix, start_after=None, **kwargs):
+        metadata = self.cold.list_metadata(prefix, start_after, **kwargs)
+        with self.lock:
+            for key in self.dirty:
+                if key.startswith(prefix) and key in self.resident and (
+                        start_after is None or key.encode('utf-8') > start_after.encode('utf-8')):
+                    metadata[key] = {'Size': self.resident[key][0], 'ETag': None}
+        return metadata
+
+    def exists(self, key, **kwargs):
+        if self.is_resident(key, touch=False):
+            return True
+        return self.cold.exists(key, **kwargs)
+
+    def put(self, key, data, **kwargs):
+        self.store(key, len(data),
+                   write_hot=lambda: self.hot.put(key, data),
+                   write_cold=lambda: self.cold.put(key, data, **kwargs))
+
+    def put_frames(self, key, frames, **kwargs):
+        self.store(key, frames_nbytes(frames),
+                   write_hot=lambda: self.hot.put_frames(key, frames),
+                   write_cold=lambda: self.cold.put_frames(key, frames, **kwargs))
+
+    def put_multiple(self, data_dict, **kwargs):
+        if self.write_policy == 'write_through':
+            # One bulk write to the cold tier, then fill the hot tier
+            self.cold.put_multiple(data_dict, **kwargs)
+            for key, data in data_dict.items():
+                with self.key_lock(key):
+                    if self.fits_hot(len(data)):
+                        self.hot.put(key, data)
+                        self.register(key, len(data), dirty=False)
+                    else:
+                        self.drop_hot_copy(key)
+            self.enforce_limits()
+        else:
+            for key, data in data_dict.items():
+                self.put(key, data, **kwargs)
+
+    def upload_file(self, key, filename, **kwargs):
+        self.store(key, os.path.getsize(filename),
+                   write_hot=lambda: self.hot.upload_file(key, filename),
+                   write_cold=lambda: self.cold.upload_file(key, filename, **kwargs))
+
+    def get_hot(self, key):
+        # Returns None if the hot copy disappeared because the key was demoted concurrently
+        try:
+            return self.hot.get(key)
+        except FileNotFoundError:
+            return None
+
+    def get(self, key, **kwargs):
+        if self.is_resident(key):
+            data = self.get_hot(key)
+            if data is not None:
+                self.metrics.increment('hot_hits')
+                return data
+        self.metrics.increment('hot_misses')
+        data = self.cold.get(key, **kwargs)
+        self.promote(key, data)
+        self.enforce_limits()
+        return data
+
+    def get_multiple(self, keys, **kwargs):
+        callback = kwargs.pop('callback', None)
+        result = BulkResult()
+        missing = []
+        for key in keys:
+            data = self.get_hot(key) if self.is_resident(key) else None
+            if data is None:
+                missing.append(key)
+            else:
+                result[key] = data
+        self.metrics.increment('hot_hits', len(result))
+        self.metrics.increment('hot_misses', len(missing))
+        if callback and result:
+            callback(len(result))
+        if missing:
+            if callback:
+                kwargs['callback'] = callback
+            cold_result = self.cold.get_multiple(missing, **kwargs)
+            for key, data in cold_result.items():
+                self.promote(key, data)
+            result.update(cold_result)
+            result.errors.update(getattr(cold_result, 'errors', {}))
+            self.enforce_limits()
+        return result
+
+    def get_into(self, key, buffer, **kwargs):
+        # Reads into caller buffers do not promote keys since the data never passes through this adapter
+        if self.is_resident(key):
+            try:
+                num_bytes = self.hot.get_into(key, buffer)
+                self.metrics.increment('hot_hits')
+                return num_bytes
+            except FileNotFoundError:
+                pass
+        self.metrics.increment('hot_misses')
+        return self.cold.get_into(key, buffer, **kwargs)
+
+    def get_multiple_into(self, buffers, **kwargs):
+        hot_keys = [key for key in buffers.keys() if self.is_resident(key)]
+        result = BulkResult()
+        for key in hot_keys:
+            try:
+                result[key] = self.hot.get_into(key, buffers[key])
+            except FileNotFoundError:
+                pass
+        missing = {key: buffer for key, buffer in buffers.items() if key not in result}
+        self.metrics.increment('hot_hits', len(result))
+        self.metrics.increment('hot_misses', len(missing))
+        if missing:
+            cold_result = self.cold.get_multiple_into(missing, **kwargs)
+            result.update(cold_result)
+            result.errors.update(getattr(cold_result, 'errors', {}))
+        return result
+
+    def get_local_path(self, key, **kwargs):
+        if not self.is_resident(key):
+            self.get(key, **kwargs)
+            if not self.is_resident(key):
+                return self.cold.get_local_path(key, **kwargs)
+        return self.hot.get_local_path(key)
+
+    def get_ranges(self, ranges, **kwargs):
+        # Byte ranges do not promote keys (e.g., a large pack file read one member at a time)
+        hot_indices = [ii for ii, (key, _, _) in enumerate(ranges) if self.is_resident(key)]
+        hot_set = set(hot_indices)
+        cold_indices = [ii for ii in range(len(ranges)) if ii not in hot_set]
+        result = [None] * len(ranges)
+        if hot_indices:
+            for ii, data in zip(hot_indices, self.hot.get_ranges([ranges[ii] for ii in hot_indices])):
+                result[ii] = data
+        if cold_indices:
+            for ii, data in zip(cold_indices, self.cold.get_ranges([ranges[ii] for ii in cold_indices], **kwargs)):
+                result[ii] = data
+        return result
+
+    def download_file(self, key, filename, **kwargs):
+        if self.is_resident(key):
+            link_kwargs = {'link_mode': kwargs['link_mode']} if 'link_mode' in kwargs else {}
+            try:
+                return self.hot.download_file(key, filename, **link_kwargs)
+            except FileNotFoundError:
+                pass
+        return self.cold.download_file(key, filename, **kwargs)
+
+    def delete(self, key, **kwargs):
+        with self.key_lock(key):
+            was_dirty = self.drop_hot_copy(key)
+            # A dirty key may not have reached the cold tier yet
+            if not was_dirty or self.cold.exists(key):
+                self.cold.delete(key, **kwargs)
+
+    def delete_multiple(self, keys, **kwargs):
+        on_error, deadline = pop_bulk_options(kwargs)
+        return run_sequential(lambda key: self.delete(key, **kwargs), keys, on_error=on_error, deadline=deadline).errors
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+from timeit import default_timer as timer
+
+
+# Holds the time a task waited in the thread pool queue before the current thread started running it
+task_context = threading.local()
+
+
+def run_with_queue_time(submit_time, fn, *args, **kwargs):
+    task_context.queue_wait = timer() - submit_time
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        task_context.queue_wait = None
+
+
+def submit_traced(executor, fn, *args, **kwargs):
+    # Like executor.submit, but makes the queue wait of the task visible to trace events
+    return executor.submit(run_with_queue_time, timer(), fn, *args, **kwargs)
+
+
+def current_queue_wait():
+    return getattr(task_context, 'queue_wait', None)
+
+
+class TraceEvent:
+    """Describes one back-end call (e.g., one attempt of an S3 get_object or one file read)."""
+    __slots__ = ['operation', 'key', 'attempt', 'thread_id', 'thread_name', 'start_time', 'end_time',
+                 'queue_wait', 'bytes_in', 'bytes_out', 'error']
+
+    def __init__(self, operation, key=None, attempt=1):
+        self.operation = operation
+        self.key = key
+        self.attempt = attempt
+        current = threading.current_thread()
+        self.thread_id = current.ident
+        self.thread_name = current.name
+        self.start_time = None
+        self.end_time = None
+        self.queue_wait = current_queue_wait()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.error = None
+
+    @property
+    def service_time(self):
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+
+class TraceHook:
+    """Base class for hooks that observe every back-end call of an adapter.
+
+    on_start is called right before the call and on_end right after it (also if the call failed, in which case
+    event.error is set). Hooks are called on the thread making the call, so they must be thread-safe and fast.
+    """
+    def on_start(self, event):
+        pass
+
+    def on_end(self, event):
+        pass
+
+
+class ChromeTraceSink(TraceHook):
+    """Collects trace events and writes them in the Chrome trace-event JSON format.
+
+    The resulting file can be opened in chrome://tracing or https://ui.perfetto.dev to see the concurrency of
+    the back-end calls (one row per thread) on a timeline.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.thread_names = {}
+        self.origin = timer()
+
+    def on_end(self, event):
+        args = {'attempt': event.attempt,
+                'bytes_in': event.bytes_in,
+                'bytes_out': event.bytes_out}
+        if event.key is not None:
+            args['key'] = event.key
+        if event.queue_wait is not None:
+            args['queue_wait_ms'] = event.queue_wait * 1e3
+        if event.error is not None:
+            args['error'] = repr(event.error)
+        trace_event = {'name': event.operation,
+                       'cat': 'objectstash',
+                       'ph': 'X',
+                       'ts': (event.start_time - self.origin) * 1e6,
+                       'dur': event.service_time * 1e6,
+                       'pid': os.getpid(),
+                       'tid': event.thread_id,
+                       'args': args}
+        with self.lock:
+            self.events.append(trace_event)
+            self.thread_names[event.thread_id] = event.thread_name
+
+    def to_json(self):
+        with self.lock:
+            events = list(self.events)
+            events += [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                       for tid, name in self.thread_names.items()]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_json(), f)
@@ -0,0 +1,136 @@
+import collections
+import threading
+
+
+class WriteBehindError(Exception):
+    """Raised when background uploads of a write-behind buffer failed.
+
+    The attribute errors maps the affected keys to the exceptions raised while uploading them.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        keys = ', '.join(sorted(errors.keys())[:5])
+        super().__init__(f'Background upload failed for {len(errors)} key(s): {keys}')
+
+
+class WriteBehindBuffer:
+    """Uploads data on background threads so that put returns immediately.
+
+    The buffer holds at most max_bytes of data that is queued or being uploaded; put blocks until enough
+    data has been uploaded (backpressure). A key that is put again before its upload started is replaced
+    in the queue, and a new value for a key that is currently being uploaded waits until that upload
+    finished, so the last value put for a key is always the one that ends up in the stash.
+    Upload errors are collected and raised as a WriteBehindError by the next call into the buffer.
+
+    Writable buffers (e.g., bytearrays or NumPy arrays) are copied when they are put, so the caller may reuse
+    them right away; read-only buffers such as bytes are queued without a copy.
+    """
+    def __init__(self, put_function, max_bytes=256 * 2 ** 20, num_threads=8):
+        assert max_bytes > 0
+        assert num_threads >= 1
+        self.put_function = put_function
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+        self.queue = collections.deque()
+        # Maps keys to (data, size in bytes, kwargs) for queued and in-flight uploads respectively
+        self.queued = {}
+        self.in_flight = {}
+        self.num_bytes = 0
+        self.errors = {}
+        self.closed = False
+        self.threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def raise_errors(self):
+        # Must be called with the condition held
+        if self.errors:
+            errors = self.errors
+            self.errors = {}
+            raise WriteBehindError(errors)
+
+    def put(self, key, data, **kwargs):
+        view = memoryview(data)
+        if not view.readonly:
+            data = view.tobytes()
+        # len() counts elements, not bytes, for views of other types and for NumPy arrays
+        size = view.nbytes
+        with self.condition:
+            assert not self.closed, 'Write-behind buffer is closed'
+            self.raise_errors()
+            # A single value larger than the limit is admitted once the buffer is otherwise empty
+            while True:
+                other_bytes = self.num_bytes - (self.queued[key][1] if key in self.queued else 0)
+                if other_bytes == 0 or other_bytes + size <= self.max_bytes:
+                    break
+                self.condition.wait()
+            if key in self.queued:
+                self.num_bytes -= self.queued[key][1]
+            else:
+                self.queue.append(key)
+            self.queued[key] = (data, size, kwargs)
+            self.num_bytes += size
+            self.condition.notify_all()
+
+    def get_pending(self, key):
+        # Returns the newest value that has not been uploaded yet, or None
+        with self.condition:
+            self.raise_errors()
+            if key in self.queued:
+                return self.queued[key][0]
+            if key in self.in_flight:
+                return self.in_flight[key][0]
+            return None
+
+    def pending_keys(self):
+        with self.condition:
+            self.raise_errors()
+            return set(self.queued.keys()) | set(self.in_flight.keys())
+
+    def next_key(self):
+        # Must be called with the condition held. Skips keys whose previous value is still being uploaded.
+        for ii, key in enumerate(self.queue):
+            if key not in self.in_flight:
+                del self.queue[ii]
+                return key
+        return None
+
+    def worker(self):
+        while True:
+            with self.condition:
+                key = self.next_key()
+                while key is None:
+                    if self.closed and not self.queue:
+                        return
+                    self.condition.wait()
+                    key = self.next_key()
+                data, size, kwargs = self.queued.pop(key)
+                self.in_flight[key] = (data, size, kwargs)
+            try:
+                self.put_function(key, data, **kwargs)
+            except Exception as exc:
+                with self.condition:
+                    self.errors[key] = exc
+            with self.condition:
+                del self.in_flight[key]
+                self.num_bytes -= size
+                self.condition.notify_all()
+
+    def flush(self):
+        """Blocks until all queued data has been uploaded, then raises any upload errors."""
+        with self.condition:
+            while self.queued or self.in_flight:
+                self.condition.wait()
+            self.raise_errors()
+
+    def close(self):
+        """Flushes the buffer and stops the background threads."""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        with self.condition:
+            self.raise_errors()
@@ -1,12 +1,24 @@
+import array
+import concurrent.futures
+import io
 import json
 import os
 import random
+import threading
 import time
 
 import boto3
 from moto import mock_s3
+import pytest
 
-from objectstash import __version__, ObjectStash
+from objectstash import __version__, ObjectStash, WriteBehindError, BulkOperationError, DeadlineExceeded, ChromeTraceSink, FSAdapter, S3Adapter, TieredAdapter, ShardedAdapter, HedgedAdapter
+from objectstash.bulk import BulkCancelled, backoff_sleep, run_bulk
+from objectstash.cli import main as cli_main
+from objectstash import s3_adapter
+from objectstash.prefetch import Prefetcher
+from objectstash.process_pool import default_mp_context, get_multiple_transformed
+from objectstash.shared_cache import SharedMemoryCache
+from objectstash.storage_adapter import StorageAdapter
 
 
 def test_version():
@@ -101,6 +113,221 @@ def large_parallel_test(stash):
         assert res[key] == data[key]
 
 
+def generic_obj_test(stash):
+    np = pytest.importorskip('numpy')
+    arr = np.arange(1000, dtype=np.float32).reshape(10, 100)
+    stash.put_obj('obj/array', arr)
+    res = stash.get_obj('obj/array')
+    assert res.dtype == arr.dtype
+    assert np.array_equal(res, arr)
+
+    arr_f = np.asfortranarray(arr)
+    stash.put_obj('obj/array_f', arr_f)
+    assert np.array_equal(stash.get_obj('obj/array_f', use_mmap=False), arr_f)
+    assert np.array_equal(stash.get_obj('obj/array_f'), arr_f)
+    stash.put_obj('obj/strided', arr[:, ::3])
+    assert np.array_equal(stash.get_obj('obj/strided'), arr[:, ::3])
+
+    obj = {'name': 'test', 'weights': [np.ones(500), np.zeros((3, 7), dtype=np.int64)]}
+    stash.put_obj('obj/pickled', obj)
+    res = stash.get_obj('obj/pickled')
+    assert res['name'] == 'test'
+    assert np.array_equal(res['weights'][0], obj['weights'][0])
+    assert np.array_equal(res['weights'][1], obj['weights'][1])
+
+    stash.put_obj('obj/bytes', b'hello')
+    assert stash.get_obj('obj/bytes') == b'hello'
+    assert stash.get_obj('obj/bytes', use_mmap=False) == b'hello'
+
+    stash.put('obj/raw', b'not serialized')
+    with pytest.raises(ValueError):
+        stash.get_obj('obj/raw')
+
+
+def generic_packed_test(stash):
+    members = {f'item{ii}': bytes(random.getrandbits(8) for _ in range(random.randint(0, 300))) for ii in range(50)}
+    stash.put_packed('packs/shard0', members)
+    assert stash.get('packs/shard0/item3') == members['item3']
+    assert stash.get('packs/shard0/item0') == members['item0']
+
+    requested_ranges = []
+    original_get_ranges = stash.adapter.get_ranges
+    def recording_get_ranges(ranges, **kwargs):
+        requested_ranges.extend(ranges)
+        return original_get_ranges(ranges, **kwargs)
+    stash.adapter.get_ranges = recording_get_ranges
+
+    stash.put('plain_key', b'plain')
+    keys = [f'packs/shard0/item{ii}' for ii in [7, 5, 6, 20, 21]] + ['plain_key']
+    res = stash.get(keys)
+    assert len(res) == len(keys)
+    assert res['plain_key'] == b'plain'
+    for ii in [5, 6, 7, 20, 21]:
+        assert res[f'packs/shard0/item{ii}'] == members[f'item{ii}']
+    assert len(requested_ranges) == 2
+
+    stash.pack_indices = {}
+    assert set(stash.open_packed('packs/shard0')) == set(members.keys())
+    assert stash.get('packs/shard0/item49') == members['item49']
+
+
+def generic_content_addressed_test(stash, tmp_path):
+    shared = bytes(random.getrandbits(8) for _ in range(5000))
+    other = b'other data'
+    stash.put({'ckpt/1': shared, 'ckpt/2': shared, 'ckpt/3': other})
+    stash.put('ckpt/4', shared)
+    blobs = [x for x in stash.list_keys('.cas/sha256/') if x.endswith('/')]
+    blob_keys = []
+    for shard_prefix in blobs:
+        blob_keys += stash.list_keys(shard_prefix)
+    assert len(blob_keys) == 2
+
+    assert stash.get('ckpt/1') == shared
+    assert stash.get('ckpt/4') == shared
+    res = stash.get(['ckpt/1', 'ckpt/2', 'ckpt/3'])
+    assert res == {'ckpt/1': shared, 'ckpt/2': shared, 'ckpt/3': other}
+
+    stash.download_file('ckpt/1', tmp_path / 'ckpt_1')
+    assert (tmp_path / 'ckpt_1').read_bytes() == shared
+    targets = {key: tmp_path / key.replace('/', '_') for key in ['ckpt/2', 'ckpt/3', 'ckpt/4']}
+    stash.download_file(targets)
+    assert {key: target.read_bytes() for key, target in targets.items()} == \
+        {'ckpt/2': shared, 'ckpt/3': other, 'ckpt/4': shared}
+
+    assert stash.list_sizes('ckpt/') == {'ckpt/1': 5000, 'ckpt/2': 5000, 'ckpt/3': 10, 'ckpt/4': 5000}
+    assert stash.list_keys('') == ['ckpt/']
+    assert sum(stash.list_sizes('').values()) == 3 * 5000 + 10
+
+    uploaded = []
+    original_put_multiple = stash.adapter.put_multiple
+    def recording_put_multiple(data_dict, **kwargs):
+        uploaded.extend(data_dict.keys())
+        return original_put_multiple(data_dict, **kwargs)
+    stash.adapter.put_multiple = recording_put_multiple
+    stash.put('ckpt/5', other)
+    assert uploaded == ['ckpt/5']
+    assert stash.get('ckpt/5') == other
+
+
+def reverse_and_measure(data):
+    return len(data), data[::-1]
+
+
+def generic_transformed_test(stash):
+    data = {f'blob/{ii}': bytes(random.getrandbits(8) for _ in range(random.randint(1, 3000))) for ii in range(40)}
+    stash.put(data)
+    res = stash.get_transformed(list(data.keys()), reverse_and_measure, num_processes=2, chunk_size=16)
+    assert set(res.keys()) == set(data.keys())
+    for key, value in data.items():
+        assert res[key] == (len(value), value[::-1])
+
+
+def generic_get_into_test(stash):
+    data = {f'into/{ii}': bytes(random.getrandbits(8) for _ in range(100 * ii + 1)) for ii in range(10)}
+    stash.put(data)
+    buffer = bytearray(2000)
+    assert stash.get_into('into/5', buffer) == 501
+    assert buffer[:501] == data['into/5']
+
+    # One preallocated batch buffer, one slice per key
+    batch = bytearray(10 * 1000)
+    view = memoryview(batch)
+    buffers = {key: view[ii * 1000:(ii + 1) * 1000] for ii, key in enumerate(data.keys())}
+    sizes = stash.get_into(buffers)
+    for ii, (key, value) in enumerate(data.items()):
+        assert sizes[key] == len(value)
+        assert batch[ii * 1000:ii * 1000 + len(value)] == value
+
+    with pytest.raises(ValueError):
+        stash.get_into('into/9', bytearray(100))
+
+
+def generic_stream_test(stash):
+    chunk = bytes(random.getrandbits(8) for _ in range(2 ** 16))
+    def generate_chunks(num_chunks, fail=False):
+        for ii in range(num_chunks):
+            if fail and ii == num_chunks // 2:
+                raise IOError('simulated producer failure')
+            yield chunk
+    stash.put('stream/large', generate_chunks(200))
+    assert stash.get('stream/large') == chunk * 200
+    stash.put({'stream/small': generate_chunks(3), 'stream/bytes': b'plain'})
+    assert stash.get('stream/small') == chunk * 3
+    assert stash.get('stream/bytes') == b'plain'
+    stash.put('stream/file', io.BytesIO(chunk * 5))
+    assert stash.get('stream/file') == chunk * 5
+    stash.put('stream/empty', iter([]))
+    assert stash.get('stream/empty') == b''
+    # Buffers are iterable, but are stored in one piece
+    values = array.array('i', range(100))
+    stash.put({'stream/array': values})
+    assert stash.get('stream/array') == values.tobytes()
+    np = pytest.importorskip('numpy')
+    stash.put({'stream/numpy': np.arange(10, dtype=np.uint8)})
+    assert stash.get('stream/numpy') == bytes(range(10))
+
+    # A failed stream leaves the previous data in place
+    with pytest.raises(IOError):
+        stash.put('stream/small', generate_chunks(200, fail=True))
+    assert stash.get('stream/small') == chunk * 3
+
+
+def generic_copy_test(stash):
+    data = {f'models/v1/{name}': bytes(random.getrandbits(8) for _ in range(random.randint(1, 2000)))
+            for name in ['weights', 'config', 'shards/0', 'shards/1']}
+    stash.put(data)
+    stash.copy('models/v1/config', 'models/latest/config')
+    assert stash.get('models/latest/config') == data['models/v1/config']
+    # Overwriting the source must not change the copy
+    stash.put('models/v1/config', b'changed')
+    assert stash.get('models/latest/config') == data['models/v1/config']
+    stash.put('models/v1/config', data['models/v1/config'])
+
+    assert stash.copy_prefix('models/v1/', 'models/v2/') == 4
+    assert stash.get([key.replace('v1', 'v2') for key in data]) == {key.replace('v1', 'v2'): value
+                                                                    for key, value in data.items()}
+    stash.copy({'models/v1/weights': 'backup/weights', 'models/v1/shards/0': 'backup/shard0'})
+    assert stash.get('backup/shard0') == data['models/v1/shards/0']
+
+    stash.move('models/v2/weights', 'models/v3/weights')
+    assert not stash.exists('models/v2/weights')
+    assert stash.get('models/v3/weights') == data['models/v1/weights']
+    stash.move({'backup/weights': 'backup/w', 'backup/shard0': 'backup/s0'})
+    assert set(stash.list_keys('backup/')) == {'backup/w', 'backup/s0'}
+    # The destination of a copy is overwritten
+    stash.copy('models/v1/config', 'backup/w')
+    assert stash.get('backup/w') == data['models/v1/config']
+
+
+def generic_download_link_test(stash, tmp_path):
+    data = {f'dl/{ii}': bytes(random.getrandbits(8) for _ in range(1000 + ii)) for ii in range(5)}
+    stash.put(data)
+    for link_mode in ['copy', 'hardlink', 'reflink', 'symlink']:
+        target = tmp_path / f'target_{link_mode}'
+        stash.download_file('dl/0', target, link_mode=link_mode)
+        with open(target, 'rb') as f:
+            assert f.read() == data['dl/0']
+    assert (tmp_path / 'target_symlink').is_symlink()
+    # Shared files are read-only so that writes to the target cannot change the stored copy
+    assert os.stat(tmp_path / 'target_hardlink').st_mode & 0o222 == 0
+
+    # Downloading over a link replaces the link instead of writing through it
+    stash.put('dl/0', b'new data')
+    stash.download_file('dl/0', tmp_path / 'target_symlink', link_mode='copy')
+    assert not (tmp_path / 'target_symlink').is_symlink()
+    with open(tmp_path / 'target_symlink', 'rb') as f:
+        assert f.read() == b'new data'
+    with open(tmp_path / 'target_hardlink', 'rb') as f:
+        assert f.read() == data['dl/0']
+
+    targets = {key: tmp_path / 'bulk' / key.replace('/', '_') for key in data}
+    (tmp_path / 'bulk').mkdir()
+    stash.download_file(targets, link_mode='hardlink')
+    for key, target in targets.items():
+        with open(target, 'rb') as f:
+            assert f.read() == (b'new data' if key == 'dl/0' else data[key])
+
+
 def generic_s3_setup(bucket_name='test_bucket'):
     os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
     os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
@@ -111,6 +338,70 @@ def generic_s3_setup(bucket_name='test_bucket'):
     conn.create_bucket(Bucket=bucket_name)
 
 
+def generic_manifest_test(stash, tmp_path):
+    data = {f'data/{ii:04d}': bytes(ii) for ii in range(50)}
+    data.update({'data/sub/a': b'a', 'data/sub/b': b'bb', 'data/zz/x': b'x', 'other/k': b'k'})
+    stash.put(data)
+    expected_keys = set(stash.list_keys('data/'))
+    assert stash.open_manifest('data/', tmp_path / 'manifests' / 'data.idx') == 53
+    stash.stats(reset=True)
+    assert set(stash.list_keys('data/')) == expected_keys
+    assert set(stash.list_keys('data/sub/')) == {'data/sub/a', 'data/sub/b'}
+    assert set(stash.list_keys('data/00')) == {f'data/{ii:04d}' for ii in range(50)}
+    assert stash.exists('data/0003')
+    assert not stash.exists('data/0050')
+    assert stash.list_sizes('data/s') == {'data/sub/a': 1, 'data/sub/b': 2}
+    assert stash.manifests['data/'].size('data/0042') == 42
+    assert stash.stats()['operations'] == {}
+    assert stash.exists('other/k')
+    assert stash.stats()['operations']['head']['count'] == 1
+
+    # Appended keys after the last key are found by the incremental refresh, other changes by the full one
+    stash.put({'data/zz/y': b'new', 'data/zzz': b'new'})
+    assert not stash.exists('data/zzz')
+    assert stash.refresh_manifest('data/') == 2
+    assert stash.exists('data/zzz')
+    assert set(stash.list_keys('data/zz/')) == {'data/zz/x', 'data/zz/y'}
+    assert stash.refresh_manifest('data/') == 0
+    stash.put('data/0050', b'new')
+    stash.delete('data/0001')
+    assert stash.refresh_manifest('data/') == 0
+    assert stash.exists('data/0001')
+    assert stash.refresh_manifest('data/', full=True) == 55
+    assert not stash.exists('data/0001')
+    assert stash.exists('data/0050')
+
+    stash.stats(reset=True)
+    assert stash.open_manifest('data/', tmp_path / 'manifests' / 'data.idx') == 55
+    assert 'list' not in stash.stats()['operations']
+    with pytest.raises(ValueError):
+        stash.open_manifest('other/', tmp_path / 'manifests' / 'data.idx')
+    stash.close()
+
+
+def test_fs_adapter_manifest(tmp_path):
+    stash = ObjectStash(rootdir=tmp_path / 'fs_stash')
+    generic_manifest_test(stash, tmp_path)
+    assert ObjectStash(rootdir=tmp_path / 'fs_stash').adapter.list_metadata('data/sub/') == {
+        'data/sub/a': {'Size': 1, 'ETag': None}, 'data/sub/b': {'Size': 2, 'ETag': None}}
+    # Manifests get the usual permissions, so that other users can open them
+    (tmp_path / 'plain_file').write_bytes(b'')
+    assert (tmp_path / 'manifests' / 'data.idx').stat().st_mode == (tmp_path / 'plain_file').stat().st_mode
+
+
+@mock_s3
+def test_s3_adapter_manifest(tmp_path):
+    generic_s3_setup(bucket_name='test_bucket')
+    stash = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=False)
+    generic_manifest_test(stash, tmp_path)
+    stash = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=False)
+    stash.open_manifest('data/', tmp_path / 'manifests' / 'data.idx')
+    assert stash.manifests['data/'].metadata('data/0042')['ETag'] == \
+        stash.adapter.list_metadata('data/0042')['data/0042']['ETag'] != None
+    assert list(stash.adapter.list_metadata('data/', start_after='data/0049').keys()) == [
+        'data/0050', 'data/sub/a', 'data/sub/b', 'data/zz/x', 'data/zz/y', 'data/zzz']
+
+
 def test_fs_adapter(tmp_path):
     stash_path = tmp_path / 'fs_stash'
     stash_path.mkdir()
@@ -119,6 +410,867 @@ def test_fs_adapter(tmp_path):
     tmp_data_path.mkdir()
     generic_test(stash, tmp_data_path)
 
+
+@pytest.mark.parametrize('durability', ['none', 'file', 'directory'])
+def test_fs_adapter_atomic_writes(tmp_path, durability):
+    stash_path = tmp_path / 'fs_stash'
+    stash = ObjectStash(rootdir=stash_path, durability=durability, max_num_threads=4)
+    tmp_data_path = tmp_path / 'tmp_data'
+    tmp_data_path.mkdir()
+    generic_test(stash, tmp_data_path)
+    large_parallel_test(stash)
+    assert [x for x in stash_path.rglob('*') if x.name.startswith('.')] == []
+    (tmp_path / 'plain_file').write_bytes(b'')
+    assert (stash_path / 'test_key').stat().st_mode == (tmp_path / 'plain_file').stat().st_mode
+    # The current umask applies to new objects
+    old_umask = os.umask(0o027)
+    try:
+        stash.put('umask_key', b'data')
+    finally:
+        os.umask(old_umask)
+    assert (stash_path / 'umask_key').stat().st_mode & 0o777 == 0o640
+    stash.delete('umask_key')
+
+    # A failed write leaves the previous data in place
+    def failing_write(f):
+        f.write(b'partial')
+        raise IOError('simulated failure')
+    with pytest.raises(IOError):
+        stash.adapter.atomic_write(stash.adapter.key_path('test_key'), failing_write)
+    assert stash.get('test_key') == b'world'
+    assert stash.list_keys('test_') == ['test_key']
+
+    with pytest.raises(ValueError):
+        ObjectStash(rootdir=stash_path, durability='always')
+
+
+def test_fs_adapter_get_into(tmp_path):
+    stash = ObjectStash(rootdir=tmp_path / 'fs_stash')
+    generic_get_into_test(stash)
+
+
+@mock_s3
+def test_s3_adapter_get_into(tmp_path):
+    generic_s3_setup()
+    generic_get_into_test(ObjectStash(s3_bucket='test_bucket'))
+    cache_path = tmp_path / 'cache'
+    generic_get_into_test(ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=True, cache_root_path=cache_path,
+                                      num_tries=1))
+
+
+def test_fs_adapter_stream(tmp_path):
+    generic_stream_test(ObjectStash(rootdir=tmp_path / 'fs_stash'))
+
+
+@mock_s3
+def test_s3_adapter_stream(monkeypatch):
+    # Recent botocore versions send parts with trailing checksums (aws-chunked), which moto does not decode
+    monkeypatch.setenv('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+    generic_s3_setup()
+    stash = ObjectStash(s3_bucket='test_bucket', multipart_part_size=5 * 2 ** 20, max_in_flight_parts=2,
+                        num_tries=1)
+    generic_stream_test(stash)
+    operations = stash.stats()['operations']
+    assert operations['put_part']['count'] == 3
+    assert operations['put_multipart_complete']['count'] == 1
+
+
+def test_fs_adapter_copy(tmp_path):
+    stash = ObjectStash(rootdir=tmp_path / 'fs_stash')
+    generic_copy_test(stash)
+    stash.copy('models/v1/weights', 'linked')
+    assert os.stat(tmp_path / 'fs_stash' / 'linked').st_ino == os.stat(tmp_path / 'fs_stash' / 'models/v1/weights').st_ino
+    operations = stash.stats()['operations']
+    assert operations['copy']['count'] == 9
+    assert operations['move']['count'] == 3
+
+
+@mock_s3
+def test_s3_adapter_copy(tmp_path, monkeypatch):
+    monkeypatch.setenv('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+    generic_s3_setup()
+    stash = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=True, cache_root_path=tmp_path / 'cache',
+                        copy_part_size=5 * 2 ** 20, max_num_threads=4)
+    generic_copy_test(stash)
+    operations = stash.stats(reset=True)['operations']
+    assert operations['copy']['count'] == 11
+    assert operations['put']['count'] == 6
+
+    large = bytes(random.getrandbits(8) for _ in range(6 * 2 ** 20))
+    stash.put('large', large)
+    stash.move('large', 'large_moved')
+    assert stash.get('large_moved') == large
+    assert not stash.exists('large')
+    operations = stash.stats()['operations']
+    assert operations['copy_part']['count'] == 2
+    assert operations['copy_multipart_complete']['count'] == 1
+
+
+def test_bulk_fail_fast():
+    cancelled = []
+    def fetch(key):
+        if key == 'bad':
+            raise IOError('bad key')
+        try:
+            backoff_sleep(10.0)
+        except BulkCancelled:
+            cancelled.append(key)
+            raise
+        return key
+    start = time.time()
+    with pytest.raises(BulkOperationError) as excinfo:
+        run_bulk(fetch, ['slow1', 'slow2', 'bad', 'slow3'], max_num_threads=3)
+    assert time.time() - start < 5
+    assert list(excinfo.value.errors.keys()) == ['bad']
+    assert excinfo.value.results == {}
+    time.sleep(0.1)
+    assert set(cancelled) == {'slow1', 'slow2'}
+
+    result = run_bulk(lambda key: key * 2, ['a', 'b', 'bad'], max_num_threads=4, on_error='collect',
+                      callback=lambda num: cancelled.append(num))
+    assert result == {'a': 'aa', 'b': 'bb', 'bad': 'badbad'}
+    assert result.errors == {}
+    with pytest.raises(ValueError):
+        run_bulk(fetch, ['a'], max_num_threads=1, on_error='ignore')
+
+
+@mock_s3
+def test_s3_adapter_bulk_errors(tmp_path):
+    generic_s3_setup(bucket_name='test_bucket')
+    options = {'s3_bucket': 'test_bucket', 'max_num_threads': 8}
+    stash = ObjectStash(cache_on_local_disk=False, num_tries=2, initial_delay=0.01, **options)
+    cached_stash = ObjectStash(cache_on_local_disk=True, cache_root_path=tmp_path / 'cache', num_tries=2,
+                               initial_delay=0.01, **options)
+    tiered_stash = ObjectStash(adapter=TieredAdapter(FSAdapter(tmp_path / 'hot'),
+                                                     S3Adapter('test_bucket', cache_on_local_disk=False, num_tries=2,
+                                                               initial_delay=0.01, max_num_threads=8)))
+    data = {f'sample/{ii}': str(ii).encode() * 10 for ii in range(20)}
+    stash.put(data)
+    keys = list(data.keys()) + ['missing/1', 'missing/2']
+    for cur_stash in [stash, cached_stash, tiered_stash]:
+        result = cur_stash.get(keys, on_error='collect')
+        assert result == data
+        assert set(result.errors.keys()) == {'missing/1', 'missing/2'}
+        with pytest.raises(BulkOperationError) as excinfo:
+            cur_stash.get(keys)
+        assert 'missing/1' in excinfo.value.errors or 'missing/2' in excinfo.value.errors
+        buffers = {key: bytearray(100) for key in keys}
+        assert set(cur_stash.get_into(buffers, on_error='collect').errors.keys()) == {'missing/1', 'missing/2'}
+
+    # Keys that keep failing stop retrying at the deadline instead of sleeping through their backoff
+    slow_stash = ObjectStash(cache_on_local_disk=False, num_tries=5, initial_delay=10.0, **options)
+    get_client = slow_stash.adapter.get_client
+    def get_throttled_client():
+        client = get_client()
+        get_object = client.get_object
+        def throttled_get_object(**kwargs):
+            if kwargs['Key'] in ['sample/3', 'sample/4']:
+                raise IOError('throttled')
+            return get_object(**kwargs)
+        client.get_object = throttled_get_object
+        return client
+    slow_stash.adapter.get_client = get_throttled_client
+    start = time.time()
+    result = slow_stash.get(list(data.keys()), on_error='collect', timeout=3.0)
+    assert time.time() - start < 5
+    assert set(result.errors.keys()) == {'sample/3', 'sample/4'}
+    assert all(isinstance(exc, DeadlineExceeded) for exc in result.errors.values())
+    assert len(result) == 18
+
+    assert stash.delete(list(data.keys())[:10]) == {}
+    assert sorted(stash.list_keys('sample/')) == sorted(list(data.keys())[10:])
+
+
+def test_local_bulk_errors(tmp_path):
+    adapters = {'fs': FSAdapter(tmp_path / 'fs'),
+                'hedged': HedgedAdapter([FSAdapter(tmp_path / 'replica0'), FSAdapter(tmp_path / 'replica1')]),
+                'sharded': ShardedAdapter({name: FSAdapter(tmp_path / name) for name in ['shard0', 'shard1']}),
+                'tiered': TieredAdapter(FSAdapter(tmp_path / 'hot'), FSAdapter(tmp_path / 'cold'))}
+    data = {f'sample/{ii}': str(ii).encode() * 10 for ii in range(10)}
+    keys = list(data.keys()) + ['missing/1', 'missing/2']
+    for name, adapter in adapters.items():
+        stash = ObjectStash(adapter=adapter)
+        stash.put(data)
+        result = stash.get(keys, on_error='collect', timeout=60.0)
+        assert result == data
+        assert set(result.errors.keys()) == {'missing/1', 'missing/2'}
+        with pytest.raises(BulkOperationError):
+            stash.get(keys)
+        buffers = {key: bytearray(100) for key in keys}
+        assert set(stash.get_into(buffers, on_error='collect').errors.keys()) == {'missing/1', 'missing/2'}
+        targets = {key: tmp_path / f'{name}_{ii}' for ii, key in enumerate(keys)}
+        assert set(stash.download_file(targets, on_error='collect').keys()) == {'missing/1', 'missing/2'}
+        assert (tmp_path / f'{name}_0').read_bytes() == data['sample/0']
+        pairs = {key: 'copy/' + key for key in keys}
+        assert set(stash.copy(pairs, on_error='collect', timeout=60.0).keys()) == {'missing/1', 'missing/2'}
+        assert stash.get('copy/sample/3') == data['sample/3']
+        assert set(stash.delete(keys, on_error='collect').keys()) == {'missing/1', 'missing/2'}
+        assert stash.list_keys('sample/') == []
+
+
+def test_fs_adapter_download_links(tmp_path):
+    stash = ObjectStash(rootdir=tmp_path / 'fs_stash')
+    generic_download_link_test(stash, tmp_path)
+    assert os.stat(tmp_path / 'fs_stash' / 'dl/1').st_ino == os.stat(tmp_path / 'bulk' / 'dl_1').st_ino
+    with pytest.raises(ValueError):
+        stash.download_file('dl/1', tmp_path / 'fs_stash' / 'dl/1', link_mode='hardlink')
+
+
+@mock_s3
+def test_s3_adapter_download_links(tmp_path):
+    generic_s3_setup()
+    stash = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=True, cache_root_path=tmp_path / 'cache',
+                        max_num_threads=4)
+    generic_download_link_test(stash, tmp_path)
+    assert os.stat(tmp_path / 'cache' / 'dl/1').st_ino == os.stat(tmp_path / 'bulk' / 'dl_1').st_ino
+    stash_without_cache = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=False, max_num_threads=4)
+    stash_without_cache.download_file({'dl/2': tmp_path / 'direct'}, link_mode='hardlink')
+    with open(tmp_path / 'direct', 'rb') as f:
+        assert f.read() == stash.get('dl/2')
+
+
+def write_local_tree(root, files):
+    for name, data in files.items():
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        with open(root / name, 'wb') as f:
+            f.write(data)
+
+
+def test_cli(tmp_path, capsys):
+    files = {'a.bin': b'a' * 100, 'sub/b.bin': b'b' * 2000, 'sub/deep/c.bin': b'c' * 30}
+    write_local_tree(tmp_path / 'local', files)
+    stash_args = ['--rootdir', str(tmp_path / 'stash'), '--threads', '4', '-q']
+    assert cli_main(stash_args + ['cp', '-r', str(tmp_path / 'local'), 'stash:data']) == 0
+    stash = ObjectStash(rootdir=tmp_path / 'stash')
+    assert stash.get(['data/a.bin', 'data/sub/b.bin', 'data/sub/deep/c.bin']) == {
+        'data/' + name: value for name, value in files.items()}
+
+    capsys.readouterr()
+    cli_main(stash_args + ['ls', 'stash:data/'])
+    assert capsys.readouterr().out.split() == ['data/a.bin', 'data/sub/']
+    cli_main(stash_args + ['du', 'stash:data/'])
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[-1].split()[2] == '3'
+    assert lines[1].split()[-1] == 'data/sub/' and lines[1].split()[2] == '2'
+
+    # Stash to local, then sync only the changed file back
+    cli_main(stash_args + ['cp', '-r', 'stash:data', str(tmp_path / 'copy')])
+    with open(tmp_path / 'copy' / 'sub' / 'deep' / 'c.bin', 'rb') as f:
+        assert f.read() == files['sub/deep/c.bin']
+    write_local_tree(tmp_path / 'local', {'a.bin': b'changed', 'new.bin': b'new'})
+    stash.reset_stats()
+    cli_main(stash_args + ['sync', str(tmp_path / 'local'), 'stash:data'])
+    assert stash.get('data/a.bin') == b'changed'
+    assert stash.get('data/new.bin') == b'new'
+
+    # A manifest from an interrupted run skips the transfers that finished
+    manifest = tmp_path / 'manifest.jsonl'
+    with open(manifest, 'w') as f:
+        f.write(json.dumps({'src': 'data/a.bin', 'dst': 'backup/a.bin'}) + '\n{"src": "data/sub')
+    cli_main(stash_args + ['cp', '-r', 'stash:data/', 'stash:backup/', '--manifest', str(manifest)])
+    assert not stash.exists('backup/a.bin')
+    assert stash.get('backup/sub/b.bin') == files['sub/b.bin']
+    with open(manifest, 'r') as f:
+        assert [json.loads(line)['dst'] for line in f] == ['backup/a.bin', 'backup/new.bin', 'backup/sub/b.bin',
+                                                           'backup/sub/deep/c.bin']
+
+    cli_main(stash_args + ['rm', '-r', 'stash:backup'])
+    assert stash.list_sizes('backup/') == {}
+    with pytest.raises(SystemExit):
+        cli_main(stash_args + ['cp', 'stash:data', str(tmp_path / 'x')])
+
+
+@mock_s3
+def test_cli_s3(tmp_path, capsys):
+    generic_s3_setup()
+    files = {f'part{ii}': bytes(random.getrandbits(8) for _ in range(500)) for ii in range(10)}
+    write_local_tree(tmp_path / 'local', files)
+    cli_main(['-q', 'cp', '-r', str(tmp_path / 'local'), 's3://test_bucket/dataset/'])
+    stash = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=False)
+    assert stash.get('dataset/part3') == files['part3']
+    cli_main(['-q', '--rootdir', str(tmp_path / 'stash'), 'sync', 's3://test_bucket/dataset', 'stash:mirror'])
+    assert ObjectStash(rootdir=tmp_path / 'stash').get('mirror/part7') == files['part7']
+    cli_main(['-q', 'cp', 's3://test_bucket/dataset/part1', 's3://test_bucket/single'])
+    assert stash.get('single') == files['part1']
+    capsys.readouterr()
+    cli_main(['ls', '-r', '-l', 's3://test_bucket/dataset/'])
+    assert len(capsys.readouterr().out.splitlines()) == 10
+    cli_main(['-q', 'rm', '-r', 's3://test_bucket/dataset/'])
+    assert stash.list_keys('dataset/') == []
+
+
+def test_fs_adapter_objects(tmp_path):
+    stash = ObjectStash(rootdir=tmp_path / 'fs_stash')
+    generic_obj_test(stash)
+
+
+def test_fs_adapter_write_behind(tmp_path):
+    stash_path = tmp_path / 'fs_stash'
+    stash = ObjectStash(rootdir=stash_path, write_behind=True, write_behind_max_bytes=5000)
+    tmp_data_path = tmp_path / 'tmp_data'
+    tmp_data_path.mkdir()
+    generic_test(stash, tmp_data_path)
+    large_parallel_test(stash)
+
+    release = threading.Event()
+    original_put = stash.adapter.put
+    def slow_put(key, data, **kwargs):
+        release.wait()
+        if key == 'bad_key':
+            raise IOError('simulated upload failure')
+        return original_put(key, data, **kwargs)
+    stash.adapter.put = slow_put
+    stash.put('pending_key', b'pending data')
+    assert stash.exists('pending_key')
+    assert stash.get('pending_key') == b'pending data'
+    assert stash.get(['pending_key', 'test_key'])['pending_key'] == b'pending data'
+    stash.put('bad_key', b'x')
+    # Mutable buffers are copied, and views of other types count their size in bytes
+    mutable = bytearray(b'mutable data')
+    stash.put('mutable_key', mutable)
+    mutable[:] = b'changed data'
+    num_bytes = stash.write_behind.num_bytes
+    doubles = memoryview(array.array('d', [1.0] * 10)).toreadonly()
+    stash.put('doubles_key', doubles)
+    assert stash.write_behind.num_bytes - num_bytes == 80
+    release.set()
+    with pytest.raises(WriteBehindError):
+        stash.flush()
+    stash.close()
+    assert (stash_path / 'pending_key').read_bytes() == b'pending data'
+    assert (stash_path / 'mutable_key').read_bytes() == b'mutable data'
+    assert (stash_path / 'doubles_key').read_bytes() == doubles.tobytes()
+    assert not (stash_path / 'bad_key').exists()
+
+
+@pytest.mark.parametrize('write_policy', ['write_through', 'write_back'])
+def test_tiered_adapter(tmp_path, write_policy):
+    hot = FSAdapter(tmp_path / 'hot')
+    cold = FSAdapter(tmp_path / 'cold')
+    adapter = TieredAdapter(hot, cold, write_policy=write_policy, max_hot_bytes=20000)
+    stash = ObjectStash(adapter=adapter)
+    tmp_data_path = tmp_path / 'tmp_data'
+    tmp_data_path.mkdir()
+    generic_test(stash, tmp_data_path)
+    assert adapter.hot_bytes <= 20000
+
+    data = {f'tiered/{ii}': bytes([ii]) * 1000 for ii in range(50)}
+    stash.put(data)
+    assert adapter.hot_bytes <= 20000
+    if write_policy == 'write_back':
+        assert not (tmp_path / 'cold' / 'tiered' / '49').exists()
+    assert set(stash.list_keys('tiered/')) == set(data.keys())
+    assert stash.get(list(data.keys())) == data
+    stash.close()
+    assert (tmp_path / 'cold' / 'tiered' / '49').read_bytes() == data['tiered/49']
+
+    # Keys read from the cold tier are promoted, and least recently used keys are demoted
+    cold.put('direct', b'direct data')
+    assert stash.get('direct') == b'direct data'
+    assert (tmp_path / 'hot' / 'direct').exists()
+    stats = stash.stats()['counters']
+    assert stats['promotions'] > 0 and stats['demotions'] > 0
+    assert adapter.demote(max_age=0) != []
+    assert adapter.hot_bytes == 0
+    assert stash.get('direct') == b'direct data'
+
+
+@mock_s3
+def test_tiered_adapter_s3(tmp_path):
+    generic_s3_setup()
+    cold = S3Adapter('test_bucket', cache_on_local_disk=False)
+    stash = ObjectStash(adapter=TieredAdapter(FSAdapter(tmp_path / 'hot'), cold, write_policy='write_back'))
+    tmp_data_path = tmp_path / 'tmp_data'
+    tmp_data_path.mkdir()
+    generic_test(stash, tmp_data_path)
+    large_parallel_test(stash)
+    stash.close()
+    assert cold.get('test1.txt') == b'hello objectstash\n'
+
+
+def test_sharded_adapter(tmp_path):
+    shards = [FSAdapter(tmp_path / f'shard{ii}') for ii in range(3)]
+    adapter = ShardedAdapter(shards)
+    stash = ObjectStash(adapter=adapter)
+    tmp_data_path = tmp_path / 'tmp_data'
+    tmp_data_path.mkdir()
+    generic_test(stash, tmp_data_path)
+
+    data = {f'sharded/{ii}': str(ii).encode() * 10 for ii in range(300)}
+    stash.put(data)
+    for shard in shards:
+        assert 50 < len(shard.list_keys('sharded/')) < 150
+    assert set(stash.list_keys('sharded/')) == set(data.keys())
+
+    # Without rebalancing, keys that now belong to the new shard are read from their previous shard
+    assert adapter.add_shard(FSAdapter(tmp_path / 'shard3'), rebalance=False) == 0
+    assert stash.get(list(data.keys())) == data
+    assert all(stash.exists(key) for key in data.keys())
+    paths = adapter.get_local_paths(list(data.keys()))
+    assert all(paths[key].read_bytes() == value for key, value in data.items())
+    assert all(adapter.get_local_path(key).read_bytes() == value for key, value in data.items())
+    assert adapter.get_ranges([(key, 1, 3) for key in data.keys()]) == [value[1:4] for value in data.values()]
+    # Writes before the rebalance are not overwritten by the stale copies on the previous shards
+    new_keys = [key for key in data.keys() if adapter.previous_shard_for(key) is not None][:4]
+    stash.put({key: b'new' for key in new_keys[:2]})
+    stash.put(new_keys[2], b'new')
+    stash.copy(new_keys[0], new_keys[3])
+    for key in new_keys:
+        data[key] = b'new'
+    assert stash.get(new_keys) == {key: b'new' for key in new_keys}
+    moved = adapter.rebalance()
+    assert 30 < moved < 150
+    assert 30 < len(adapter.shards['shard3'].list_keys('sharded/')) < 150
+    assert stash.get(list(data.keys())) == data
+    assert set(stash.list_keys('sharded/')) == set(data.keys())
+    stash.delete(list(data.keys()))
+    assert stash.list_keys('sharded/') == []
+
+
+@mock_s3
+def test_sharded_adapter_s3_rebalance():
+    for name in ['shard0', 'shard1', 'shard2']:
+        generic_s3_setup(bucket_name=name)
+    adapter = ShardedAdapter({name: S3Adapter(name) for name in ['shard0', 'shard1']})
+    stash = ObjectStash(adapter=adapter)
+    data = {f'sharded/{ii}': str(ii).encode() * 10 for ii in range(40)}
+    stash.put(data)
+    adapter.add_shard(S3Adapter('shard2'), name='shard2', rebalance=False)
+    assert stash.get(list(data.keys())) == data
+    # Keys move between buckets with server-side copies
+    moved = adapter.rebalance()
+    assert moved > 0
+    operations = adapter.shards['shard2'].metrics.snapshot()['operations']
+    assert operations['copy']['count'] == moved
+    assert 'put' not in operations
+    assert len(adapter.shards['shard2'].list_keys('sharded/')) == moved
+    assert stash.get(list(data.keys())) == data
+
+
+def test_hedged_adapter(tmp_path):
+    replicas = [FSAdapter(tmp_path / 'replica0'), FSAdapter(tmp_path / 'replica1')]
+    adapter = HedgedAdapter(replicas, hedge_after=0.05)
+    stash = ObjectStash(adapter=adapter)
+    tmp_data_path = tmp_path / 'tmp_data'
+    tmp_data_path.mkdir()
+    generic_test(stash, tmp_data_path)
+    assert replicas[1].get('test_key') == stash.get('test_key')
+
+    # A straggler on the first replica is hedged on the second one
+    original_get = replicas[0].get
+    def slow_get(key, **kwargs):
+        if key.startswith('slow'):
+            time.sleep(1.0)
+        if key.startswith('broken'):
+            raise IOError('simulated failure')
+        return original_get(key, **kwargs)
+    replicas[0].get = slow_get
+    stash.put({'slow1': b'slow data', 'broken1': b'broken data'})
+    start = time.time()
+    assert stash.get('slow1') == b'slow data'
+    assert time.time() - start < 0.5
+    assert stash.get(['slow1', 'broken1', 'test_key'])['broken1'] == b'broken data'
+    counters = stash.stats()['counters']
+    assert counters['hedge_wins'] >= 2
+    assert counters['failovers'] >= 1
+
+    # The threshold adapts to the observed latencies
+    adapter = HedgedAdapter(replicas, hedge_percentile=90, min_samples=10)
+    assert adapter.hedge_threshold() is None
+    for _ in range(20):
+        adapter.get('test_key')
+    assert adapter.hedge_threshold() < 0.5
+    replicas[0].delete('broken1')
+    replicas[1].delete('broken1')
+    with pytest.raises(IOError):
+        adapter.get('broken1')
+    adapter.close()
+
+
+@mock_s3
+def test_hedged_adapter_s3_failover():
+    for name in ['replica0', 'replica1']:
+        generic_s3_setup(bucket_name=name)
+    replicas = [S3Adapter(name, num_tries=3, initial_delay=1.0) for name in ['replica0', 'replica1']]
+    adapter = HedgedAdapter(replicas)
+    replicas[1].put('only_second', b'second data')
+    # The first replica fails without waiting for the backoff of its retries
+    start = time.time()
+    assert adapter.get('only_second') == b'second data'
+    assert adapter.get_multiple(['only_second']) == {'only_second': b'second data'}
+    assert time.time() - start < 1.0
+    assert adapter.metrics.snapshot()['counters']['failovers'] == 2
+    assert replicas[0].metrics.snapshot()['operations']['get']['count'] == 2
+    # The last replica still retries
+    with pytest.raises(Exception):
+        adapter.get('missing')
+    assert replicas[1].metrics.snapshot()['counters']['retries'] == 2
+    adapter.close()
+
+
+def test_fs_adapter_prefetch(tmp_path):
+    stash = ObjectStash(rootdir=tmp_path / 'fs_stash')
+    data = {f'sample/{ii}': str(ii).encode() * 100 for ii in range(200)}
+    stash.put(data)
+    order = list(data.keys())
+    random.shuffle(order)
+    order += order[:10]
+
+    original_get_multiple = stash.adapter.get_multiple
+    def slow_get_multiple(keys, **kwargs):
+        time.sleep(0.01)
+        return original_get_multiple(keys, **kwargs)
+    stash.adapter.get_multiple = slow_get_multiple
+
+    prefetcher = stash.prefetch_iter(order, window=2, max_bytes=20000)
+    res = [(key, value) for key, value in prefetcher]
+    assert [key for key, _ in res] == order
+    for key, value in res:
+        assert value == data[key]
+    assert prefetcher.stall_time > 0
+    assert prefetcher.window > 2
+
+
+def test_prefetch_max_bytes():
+    data = {f'sample/{ii}': bytes([ii]) * 1000 for ii in range(100)}
+    num_requested = []
+    num_consumed = []
+    max_outstanding = []
+    def fetch_multiple(keys):
+        num_requested.append(len(keys))
+        max_outstanding.append(sum(num_requested) - len(num_consumed))
+        time.sleep(0.01)
+        return {key: data[key] for key in keys}
+    prefetcher = Prefetcher(fetch_multiple, list(data.keys()), window=64, max_bytes=4000, batch_size=2,
+                            adaptive=False)
+    for key, value in prefetcher:
+        assert value == data[key]
+        num_consumed.append(key)
+        time.sleep(0.002)
+    assert len(num_consumed) == 100
+    # The batches in flight count towards max_bytes, so the window of 64 keys is never filled
+    assert max(max_outstanding) <= 8
+    with pytest.raises(RuntimeError):
+        list(prefetcher)
+
+
+def test_fs_adapter_transformed(tmp_path):
+    generic_transformed_test(ObjectStash(rootdir=tmp_path / 'fs_stash'))
+
+
+def test_transformed_bounded_chunks():
+    data = {f'blob/{ii}': bytes([ii]) * 100 for ii in range(40)}
+    num_fetched = []
+    num_done = []
+    def fetch_data(keys):
+        # One process may have two chunks in flight, each with chunk_size keys
+        num_fetched.append(len(keys))
+        assert sum(num_fetched) - len(num_done) <= 2 * 4
+        return {key: data[key] for key in keys}
+    res = get_multiple_transformed(list(data.keys()), reverse_and_measure,
+                                   fetch_local_paths=lambda keys: {}, fetch_data=fetch_data,
+                                   num_processes=1, chunk_size=4, callback=num_done.append)
+    assert res == {key: (100, value[::-1]) for key, value in data.items()}
+    assert len(num_fetched) == 10
+
+
+def read_shared_cache_entry(cache, key):
+    return bytes(cache.get_view(key))
+
+
+class UnmeteredAdapter(StorageAdapter):
+    # An adapter that records no metrics, as third-party adapters may
+    def __init__(self, adapter):
+        self.adapter = adapter
+
+    def list_keys(self, prefix, **kwargs):
+        return self.adapter.list_keys(prefix, **kwargs)
+
+    def exists(self, key, **kwargs):
+        return self.adapter.exists(key, **kwargs)
+
+    def put(self, key, data, **kwargs):
+        return self.adapter.put(key, data, **kwargs)
+
+    def put_multiple(self, data_dict, **kwargs):
+        return self.adapter.put_multiple(data_dict, **kwargs)
+
+    def upload_file(self, key, filename, **kwargs):
+        return self.adapter.upload_file(key, filename, **kwargs)
+
+    def get(self, key, **kwargs):
+        return self.adapter.get(key, **kwargs)
+
+    def get_multiple(self, keys, **kwargs):
+        return self.adapter.get_multiple(keys, **kwargs)
+
+    def download_file(self, key, filename, **kwargs):
+        return self.adapter.download_file(key, filename, **kwargs)
+
+    def delete(self, key, **kwargs):
+        return self.adapter.delete(key, **kwargs)
+
+    def delete_multiple(self, keys, **kwargs):
+        return self.adapter.delete_multiple(keys, **kwargs)
+
+
+def test_shared_memory_cache(tmp_path):
+    shm_dir = tmp_path / 'shm'
+    reader = ObjectStash(rootdir=tmp_path / 'fs_stash', shared_cache=shm_dir)
+    writer = ObjectStash(rootdir=tmp_path / 'fs_stash', shared_cache=shm_dir)
+    data = {f'sample/{ii}': str(ii).encode() * 100 for ii in range(10)}
+    writer.put(data)
+    assert writer.get('sample/1') == data['sample/1']
+    view = reader.get_view('sample/1')
+    assert view.readonly
+    assert view == data['sample/1']
+    assert reader.stats()['counters']['shared_cache_hits'] == 1
+    assert 'get' not in reader.stats()['operations']
+    views = reader.get_view(list(data.keys()))
+    assert {key: bytes(value) for key, value in views.items()} == data
+    assert reader.stats(reset=True)['counters']['shared_cache_misses'] == 9
+    reader.get(list(data.keys()))
+    assert reader.stats(reset=True)['counters']['shared_cache_hits'] == 10
+    buffer = bytearray(100)
+    assert reader.get_into('sample/7', buffer) == 100
+    assert buffer == data['sample/7']
+    # Entries get the usual permissions, so that processes of other users can read them
+    (tmp_path / 'plain_file').write_bytes(b'')
+    entry_path = reader.adapter.cache.entry_path(reader.adapter.cache_key('sample/7'))
+    assert entry_path.stat().st_mode == (tmp_path / 'plain_file').stat().st_mode
+
+    # Writes through any stash remove the old entry for all of them, and earlier views stay valid
+    writer.put('sample/1', b'new')
+    assert reader.get('sample/1') == b'new'
+    assert view == data['sample/1']
+    writer.delete('sample/2')
+    assert not reader.exists('sample/2')
+    with pytest.raises(IOError):
+        reader.get('sample/2')
+
+    # Other processes see the same entries
+    cache = SharedMemoryCache(shm_dir)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=default_mp_context()) as executor:
+        assert executor.submit(read_shared_cache_entry, cache,
+                               reader.adapter.cache_key('sample/3')).result() == data['sample/3']
+
+    # Stashes of different back-ends keep separate entries in the same cache directory
+    other = ObjectStash(rootdir=tmp_path / 'other_fs_stash', shared_cache=shm_dir)
+    other.put('sample/3', b'other data')
+    assert other.get('sample/3') == b'other data'
+    assert reader.get('sample/3') == data['sample/3']
+
+    small = ObjectStash(rootdir=tmp_path / 'fs_stash', shared_cache=tmp_path / 'small_shm', shared_cache_max_bytes=10000)
+    small.put({f'large/{ii}': bytes([ii]) * 1000 for ii in range(20)})
+    for ii in range(20):
+        assert small.get_view(f'large/{ii}') == bytes([ii]) * 1000
+        assert small.adapter.cache.total_bytes() <= 10000
+    assert small.adapter.cache.total_bytes() >= 8000
+    assert small.get_view('large/19') == bytes([19]) * 1000
+    assert small.stats()['counters']['shared_cache_hits'] == 1
+    small.adapter.cache.clear()
+    assert small.adapter.cache.total_bytes() == 0
+
+    # Adapters without metrics get their own counters
+    unmetered = ObjectStash(adapter=UnmeteredAdapter(FSAdapter(tmp_path / 'fs_stash')), shared_cache=shm_dir)
+    assert unmetered.get('sample/4') == data['sample/4']
+    assert unmetered.get('sample/4') == data['sample/4']
+    unmetered.put('sample/4', b'new')
+    assert unmetered.get('sample/4') == b'new'
+    counters = unmetered.adapter.metrics.snapshot()['counters']
+    assert counters['shared_cache_hits'] == 1
+    assert counters['shared_cache_evictions'] == 1
+
+
+@mock_s3
+def test_s3_adapter_transformed(tmp_path):
+    generic_s3_setup(bucket_name='test_bucket')
+    generic_transformed_test(ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=False))
+    generic_transformed_test(ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=True,
+                                         cache_root_path=tmp_path / 'cache'))
+
+
+def test_fs_adapter_stats(tmp_path):
+    stash = ObjectStash(rootdir=tmp_path / 'fs_stash')
+    stash.put({'a': b'12345', 'b': b'678'})
+    stash.get(['a', 'b'])
+    stash.get('a')
+    assert stash.exists('a')
+    stats = stash.stats(reset=True)
+    assert stats['operations']['put']['count'] == 2
+    assert stats['operations']['get']['count'] == 3
+    assert stats['operations']['head']['count'] == 1
+    assert stats['counters']['bytes_out'] == 8
+    assert stats['counters']['bytes_in'] == 13
+    assert stats['operations']['get']['p99'] >= stats['operations']['get']['p50'] > 0
+    assert stash.stats()['operations'] == {}
+
+
+@mock_s3
+def test_s3_adapter_stats(tmp_path):
+    generic_s3_setup(bucket_name='test_bucket')
+    stash = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=True, cache_root_path=tmp_path / 'cache',
+                        skip_modification_time_check=True)
+    stash.put('a', b'12345')
+    stash.get('a')
+    stash.get('a')
+    stash.get(['a'])
+    stats = stash.stats()
+    assert stats['operations']['put']['count'] == 1
+    assert stats['operations']['download']['count'] == 1
+    assert stats['counters']['cache_misses'] == 1
+    assert stats['counters']['cache_hits'] == 2
+    assert abs(stats['cache_hit_rate'] - 2 / 3) < 1e-9
+    stash.delete('a')
+    stats = stash.stats()
+    assert stats['counters']['cache_evictions'] == 1
+    assert stats['operations']['delete']['count'] == 1
+
+
+@mock_s3
+def test_s3_adapter_cache_revalidation(tmp_path):
+    generic_s3_setup(bucket_name='test_bucket')
+    stash = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=True, cache_root_path=tmp_path / 'cache',
+                        max_num_threads=4)
+    data = {f'data/k{ii:03d}': b'x' * ii for ii in range(1, 51)}
+    stash.put(data)
+    stash.put('other/a', b'abc')
+    # The local copies only count as current if they are more than two seconds newer than the objects
+    time.sleep(2.5)
+    stash.get(list(data.keys()))
+    stash.stats(reset=True)
+    assert stash.get(list(data.keys())) == data
+    stats = stash.stats(reset=True)
+    assert stats['operations']['list']['count'] == 1
+    assert 'head' not in stats['operations']
+    assert stats['counters']['cache_hits'] == 50
+    # A single key is still checked with a HEAD request
+    stash.get('data/k001')
+    stats = stash.stats(reset=True)
+    assert stats['operations']['head']['count'] == 1
+
+    # Another writer's update is detected as a stale local copy
+    writer = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=False)
+    writer.put('data/k002', b'updated')
+    time.sleep(2.5)
+    assert stash.get(['data/k001', 'data/k002']) == {'data/k001': b'x', 'data/k002': b'updated'}
+    stats = stash.stats(reset=True)
+    assert stats['counters']['cache_stale'] == 1
+
+    fresh_stash = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=True, cache_root_path=tmp_path / 'cache',
+                              max_num_threads=4, cache_freshness_ttl=60.0)
+    assert fresh_stash.get(list(data.keys()))['data/k010'] == data['data/k010']
+    fresh_stash.stats(reset=True)
+    fresh_stash.get(list(data.keys()))
+    stats = fresh_stash.stats()
+    assert stats['operations'] == {}
+    assert stats['counters']['cache_fresh'] == 50
+    # Writes evict the cached copies, which would otherwise count as fresh
+    fresh_stash.put('data/k003', b'new')
+    assert fresh_stash.get('data/k003') == b'new'
+    fresh_stash.put('data/k004', b'new')
+    assert fresh_stash.get(['data/k004', 'data/k005'])['data/k004'] == b'new'
+    fresh_stash.put('fresh/k', b'old')
+    assert fresh_stash.get('fresh/k') == b'old'
+    fresh_stash.put('fresh/k', b'new')
+    assert fresh_stash.get('fresh/k') == b'new'
+    assert fresh_stash.get(['fresh/k']) == {'fresh/k': b'new'}
+
+
+@mock_s3
+def test_s3_adapter_revalidation_fallback(tmp_path, monkeypatch):
+    generic_s3_setup(bucket_name='test_bucket')
+    stash = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=True, cache_root_path=tmp_path / 'cache',
+                        max_num_threads=4)
+    data = {f'sparse/k{ii}': b'x' * ii for ii in range(10)}
+    stash.put(data)
+    time.sleep(2.5)
+    stash.get(list(data.keys()))
+    # Without an observed density, a few keys are checked with HEAD requests
+    stash.stats(reset=True)
+    assert stash.get(['sparse/k0', 'sparse/k9']) == {'sparse/k0': data['sparse/k0'], 'sparse/k9': data['sparse/k9']}
+    stats = stash.stats(reset=True)
+    assert 'list' not in stats['operations']
+    assert stats['operations']['head']['count'] == 2
+
+    # Credentials without the ListBucket permission fall back to HEAD requests
+    num_listings = []
+    def failing_listing(prefix, keys, **kwargs):
+        num_listings.append(prefix)
+        raise Exception('AccessDenied')
+    monkeypatch.setattr(s3_adapter, 'list_s3_object_metadata_with_backoff', failing_listing)
+    assert stash.get(list(data.keys())) == data
+    assert stash.stats(reset=True)['operations']['head']['count'] == 10
+    assert stash.get(list(data.keys())) == data
+    assert num_listings == ['sparse/']
+
+
+@mock_s3
+def test_s3_adapter_tracing(tmp_path):
+    generic_s3_setup(bucket_name='test_bucket')
+    stash = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=False, max_num_threads=4)
+    sink = ChromeTraceSink()
+    stash.add_trace_hook(sink)
+    data = {f'k{ii}': b'x' * ii for ii in range(1, 21)}
+    stash.put(data)
+    stash.get(list(data.keys()))
+    trace_filename = tmp_path / 'trace.json'
+    sink.write(trace_filename)
+    with open(trace_filename, 'r') as f:
+        trace = json.load(f)
+    get_events = [x for x in trace['traceEvents'] if x['ph'] == 'X' and x['name'] == 'get']
+    assert len(get_events) == 20
+    assert set(x['args']['key'] for x in get_events) == set(data.keys())
+    assert all('queue_wait_ms' in x['args'] for x in get_events)
+    assert sum(x['args']['bytes_in'] for x in get_events) == sum(len(x) for x in data.values())
+    assert len([x for x in trace['traceEvents'] if x['ph'] == 'X' and x['name'] == 'put']) == 20
+    stash.remove_trace_hook(sink)
+    stash.get('k1')
+    assert len(sink.to_json()['traceEvents']) == len(trace['traceEvents'])
+
+
+def test_fs_adapter_content_addressed(tmp_path):
+    stash = ObjectStash(rootdir=tmp_path / 'fs_stash', content_addressed=True)
+    generic_content_addressed_test(stash, tmp_path)
+
+
+@mock_s3
+def test_s3_adapter_content_addressed(tmp_path):
+    generic_s3_setup(bucket_name='test_bucket')
+    stash = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=False, content_addressed=True)
+    generic_content_addressed_test(stash, tmp_path)
+
+
+def test_fs_adapter_packed(tmp_path):
+    stash = ObjectStash(rootdir=tmp_path / 'fs_stash')
+    generic_packed_test(stash)
+
+
+@mock_s3
+def test_s3_adapter_packed(tmp_path):
+    generic_s3_setup(bucket_name='test_bucket')
+    stash = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=False)
+    generic_packed_test(stash)
+    stash = ObjectStash(s3_bucket='test_bucket', cache_root_path=tmp_path / 'cache', cache_on_local_disk=True)
+    generic_packed_test(stash)
+    # Member reads use ranged requests instead of downloading the pack, unless it is already cached
+    assert not (tmp_path / 'cache' / 'packs' / 'shard0.pack').exists()
+    member = stash.get('packs/shard0/item49')
+    stash.get('packs/shard0.pack')
+    time.sleep(2.5)
+    stash.stats(reset=True)
+    assert stash.get('packs/shard0/item49') == member
+    assert 'get_range' not in stash.stats()['operations']
+
+
+@mock_s3
+def test_s3_adapter_objects(tmp_path):
+    generic_s3_setup(bucket_name='test_bucket')
+    stash = ObjectStash(s3_bucket='test_bucket', cache_on_local_disk=False)
+    generic_obj_test(stash)
+    stash = ObjectStash(s3_bucket='test_bucket', cache_root_path=tmp_path / 'cache', cache_on_local_disk=True)
+    generic_obj_test(stash)
+
 @mock_s3
 def test_s3_adapter_without_local_cache(tmp_path):
     # TODO: add a test that interfaces with real S3